@@ -0,0 +1,14 @@
+import sys
+from pathlib import Path
+
+# Benchmarks for the pipeline stages, run from pipeline/:
+#
+#   python -m benchmarks.run --sizes 10000 --sizes 100000
+#
+# The pipeline scripts import each other as siblings and the scraper is its
+# own project, so both go on the path here rather than in every module.
+PIPELINE_DIR = Path(__file__).resolve().parent.parent
+
+for path in [PIPELINE_DIR / "scripts", PIPELINE_DIR / "scraper"]:
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
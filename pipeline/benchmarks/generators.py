@@ -0,0 +1,501 @@
+import json
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+
+from report_schema import REPORT_SCHEMA
+from extract_locations_from_kml import geo_to_h3
+from pull_weather import WEATHER_CACHE_SCHEMA, parse_weather_data
+
+# Synthetic inputs for the benchmarks, shaped like the real thing: the GDB
+# pages the spider crawls, the KML map, the scraped report histories, the
+# geocoded reports, and the weather cache. Everything is seeded so the same
+# size gives the same data from run to run. The text columns are drawn from
+# small pools so generating a million rows doesn't take longer than the
+# benchmarks themselves.
+
+GDB_URL = "http://www.bfro.net/GDB/"
+
+WORDS = (
+    "the a creek ridge road trail tree woods large dark figure walking "
+    "upright tall hair smell strong heard loud scream whoop knock wood "
+    "night morning evening camping hunting driving fishing saw crossed "
+    "behind stopped turned ran quickly slowly toward away from across "
+    "near far hill mountain river lake swamp field fence cabin truck dog "
+    "barking silent footprints tracks mud snow rain moon bright clear"
+).split()
+
+STATES = [
+    "Alabama",
+    "Arkansas",
+    "California",
+    "Colorado",
+    "Florida",
+    "Georgia",
+    "Idaho",
+    "Illinois",
+    "Michigan",
+    "Ohio",
+    "Oregon",
+    "Pennsylvania",
+    "Texas",
+    "Washington",
+    "Wisconsin",
+]
+SEASONS = ["Fall", "Winter", "Spring", "Summer", "Unknown"]
+MONTHS = [
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+]
+CLASSES = ["Class A", "Class B", "Class C"]
+
+# The report page fields, in page order, and the report column each one
+# ends up in.
+REPORT_PAGE_FIELDS = [
+    ("YEAR", "year"),
+    ("SEASON", "season"),
+    ("MONTH", "month"),
+    ("DATE", "date"),
+    ("STATE", "state"),
+    ("COUNTY", "county"),
+    ("LOCATION DETAILS", "location_details"),
+    ("NEAREST TOWN", "nearest_town"),
+    ("NEAREST ROAD", "nearest_road"),
+    ("OBSERVED", "observed"),
+    ("ALSO NOTICED", "also_noticed"),
+    ("OTHER WITNESSES", "other_witnesses"),
+    ("OTHER STORIES", "other_stories"),
+    ("TIME AND CONDITIONS", "time_and_conditions"),
+    ("ENVIRONMENT", "environment"),
+    ("A & G References", "a_&_g_references"),
+]
+
+
+def _sentences(rng: np.random.Generator, count: int, words: int) -> List[str]:
+    return [
+        " ".join(rng.choice(WORDS, size=rng.integers(words // 2, words)))
+        .capitalize()
+        .rstrip()
+        + "."
+        for _ in range(count)
+    ]
+
+
+def _narratives(
+    rng: np.random.Generator, count: int, sentences: int
+) -> List[str]:
+    # Narrative fields run from a sentence to a few paragraphs.
+    pool = _sentences(rng, 200, 20)
+    return [
+        " ".join(rng.choice(pool, size=rng.integers(1, sentences)))
+        for _ in range(count)
+    ]
+
+
+def generate_report_values(
+    num_reports: int, seed: int = 42, first_report_number: int = 1
+) -> Dict[str, np.ndarray]:
+    # The report columns (everything but pulled_datetime) as arrays.
+    rng = np.random.default_rng(seed)
+    pool_size = min(num_reports, 1000)
+    years = rng.integers(1950, 2024, size=num_reports)
+    months = rng.integers(0, 12, size=num_reports)
+    states = rng.integers(0, len(STATES), size=num_reports)
+    long_text = np.array(_narratives(rng, pool_size, 12), dtype=object)
+    short_text = np.array(_narratives(rng, pool_size, 3), dtype=object)
+    counties = np.array(
+        [f"{w.capitalize()} County" for w in WORDS], dtype=object
+    )
+
+    def text(pool: np.ndarray, blank_fraction: float = 0.0) -> np.ndarray:
+        values = pool[rng.integers(0, len(pool), size=num_reports)]
+        values[rng.random(num_reports) < blank_fraction] = None
+        return values
+
+    return {
+        "year": years.astype(str).astype(object),
+        "season": np.array(SEASONS, dtype=object)[
+            rng.integers(0, len(SEASONS), size=num_reports)
+        ],
+        "month": np.array(MONTHS, dtype=object)[months],
+        "date": rng.integers(1, 29, size=num_reports)
+        .astype(str)
+        .astype(object),
+        "state": np.array(STATES, dtype=object)[states],
+        "county": text(counties),
+        "location_details": text(short_text, 0.1),
+        "nearest_town": text(counties),
+        "nearest_road": text(short_text, 0.2),
+        "observed": text(long_text),
+        "also_noticed": text(short_text, 0.3),
+        "other_witnesses": text(short_text, 0.3),
+        "other_stories": text(short_text, 0.5),
+        "time_and_conditions": text(short_text, 0.1),
+        "environment": text(short_text, 0.1),
+        "report_number": np.arange(
+            first_report_number, first_report_number + num_reports
+        ),
+        "report_class": np.array(CLASSES, dtype=object)[
+            rng.integers(0, len(CLASSES), size=num_reports)
+        ],
+        "a_&_g_references": text(short_text, 0.9),
+    }
+
+
+def generate_reports(
+    num_reports: int,
+    seed: int = 42,
+    first_report_number: int = 1,
+    pulled_datetime: datetime = datetime(2023, 1, 1),
+) -> pa.Table:
+    # Scraped reports, typed like the scraper's parquet output.
+    values = generate_report_values(num_reports, seed, first_report_number)
+    values["pulled_datetime"] = np.full(
+        num_reports, np.datetime64(pulled_datetime, "us")
+    )
+    return pa.Table.from_arrays(
+        [
+            pa.array(values[field.name], type=field.type)
+            for field in REPORT_SCHEMA
+        ],
+        schema=REPORT_SCHEMA,
+    )
+
+
+def write_reports(reports: pa.Table, file: Path):
+    # A report history (csv / parquet) or a new report feed (.json, the
+    # scraper's jsonlines output with pulled_datetime as a string).
+    frame = pl.from_arrow(reports)
+    if file.suffix == ".json":
+        frame.with_columns(
+            pl.col("pulled_datetime").dt.strftime("%Y-%m-%dT%H:%M:%S")
+        ).write_ndjson(file)
+    elif file.suffix == ".parquet":
+        frame.write_parquet(file, compression="zstd")
+    else:
+        frame.write_csv(file)
+
+
+def generate_report_page(values: Dict[str, str]) -> bytes:
+    # A GDB report page. STATE and COUNTY are links, like on the site, so
+    # the extractor has to fall back to the anchor text for them.
+    fields = []
+    for label, column in REPORT_PAGE_FIELDS:
+        value = values.get(column) or ""
+        if column in ("state", "county"):
+            value = f"<a href='/GDB/#'>{value}</a>"
+        else:
+            # Long fields are broken up with <BR>s.
+            value = "<BR>".join(value.split(". "))
+        fields.append(f"<p><span class='field'>{label}:</span> {value}</p>")
+    return (
+        "<html><head><title>BFRO Report</title></head><body>"
+        "<div class='content'>"
+        "<span class='reportheader'>"
+        f"Report # {values['report_number']}</span>"
+        f"<span class='reportclassification'>({values['report_class']})"
+        "</span>" + "".join(fields) + "</div></body></html>"
+    ).encode("utf-8")
+
+
+def generate_report_pages(num_pages: int, seed: int = 42) -> List[bytes]:
+    values = generate_report_values(num_pages, seed)
+    return [
+        generate_report_page({column: values[column][i] for column in values})
+        for i in range(num_pages)
+    ]
+
+
+def _listing_page(links: List[str], cell_class: str = "cs") -> bytes:
+    cells = "".join(
+        f"<tr><td class='{cell_class}'>{link}</td></tr>" for link in links
+    )
+    return (
+        f"<html><body><table class='countytbl'>{cells}</table></body></html>"
+    ).encode("utf-8")
+
+
+def generate_gdb_site(
+    num_reports: int,
+    reports_per_county: int = 50,
+    counties_per_state: int = 20,
+    seed: int = 42,
+) -> Dict[str, bytes]:
+    # The GDB index tree: the index page linking the state pages, the state
+    # pages linking the county pages, and the county pages linking
+    # num_reports reports in total. Keyed by url. The report pages
+    # themselves come from generate_report_pages.
+    rng = np.random.default_rng(seed)
+    site: Dict[str, bytes] = {}
+    num_counties = max(1, -(-num_reports // reports_per_county))
+    num_states = max(1, -(-num_counties // counties_per_state))
+    titles = _sentences(rng, 100, 10)
+    state_links = []
+    report_number = 1
+    for state in range(num_states):
+        state_url = f"{GDB_URL}state_listing.asp?state=s{state}"
+        state_links.append(f"<a href='{state_url}'>State {state}</a>")
+        county_links = []
+        for county in range(counties_per_state):
+            if report_number > num_reports:
+                break
+            county_url = (
+                f"{GDB_URL}show_county_reports.asp?state=s{state}"
+                f"&county=c{county}"
+            )
+            county_links.append(f"<a href='{county_url}'>County {county}</a>")
+            captions = []
+            for _ in range(reports_per_county):
+                if report_number > num_reports:
+                    break
+                captions.append(
+                    "<li><span class='reportcaption'>"
+                    f"<a href='show_report.asp?id={report_number}'>"
+                    f"{titles[report_number % len(titles)]}</a>"
+                    "</span></li>"
+                )
+                report_number += 1
+            site[county_url] = (
+                f"<html><body><ul>{''.join(captions)}</ul></body></html>"
+            ).encode("utf-8")
+        site[state_url] = _listing_page(county_links)
+    site[GDB_URL] = _listing_page(state_links)
+    return site
+
+
+def write_kml(file: Path, num_placemarks: int, seed: int = 42):
+    # A KML shaped like the BFRO map: one Placemark per Folder with the
+    # title and classification in the description. Written as it's
+    # generated so a million placemarks doesn't need the whole file in
+    # memory.
+    rng = np.random.default_rng(seed)
+    titles = _sentences(rng, 100, 10)
+    with open(file, "w", encoding="utf-8") as kml:
+        kml.write("<?xml version='1.0' encoding='UTF-8'?><kml><Document>")
+        for start in range(0, num_placemarks, 10_000):
+            count = min(10_000, num_placemarks - start)
+            latitudes = rng.uniform(25.0, 60.0, size=count)
+            longitudes = rng.uniform(-160.0, -65.0, size=count)
+            days = rng.integers(0, 365 * 70, size=count)
+            classes = rng.integers(0, len(CLASSES), size=count)
+            kml.write(
+                "".join(
+                    "<Folder><Placemark><description>"
+                    f"<b>Report {start + i + 1}: "
+                    f"{titles[(start + i) % len(titles)]} </b><br/>"
+                    "<a href='http://www.bfro.net/GDB/show_report.asp?"
+                    f"id={start + i + 1}'>{CLASSES[classes[i]]}</a>"
+                    "</description><TimeStamp><when>"
+                    f"{date(1950, 1, 1) + timedelta(days=int(days[i]))}"
+                    "T12:00:00Z</when></TimeStamp>"
+                    f"<LookAt><longitude>{longitudes[i]}</longitude>"
+                    f"<latitude>{latitudes[i]}</latitude></LookAt>"
+                    "<Point><coordinates>"
+                    f"{longitudes[i]},{latitudes[i]}</coordinates></Point>"
+                    "</Placemark></Folder>"
+                    for i in range(count)
+                )
+            )
+        kml.write("</Document></kml>")
+
+
+def generate_geocoded_reports(
+    num_reports: int,
+    seed: int = 42,
+    first_report_number: int = 1,
+    extraction_date: str = "2023-01-01",
+) -> pl.DataFrame:
+    # The same columns extract_geocoded_reports produces.
+    rng = np.random.default_rng(seed)
+    titles = np.array(_sentences(rng, 100, 10), dtype=object)
+    numbers = np.arange(first_report_number, first_report_number + num_reports)
+    latitudes = rng.uniform(25.0, 60.0, size=num_reports)
+    longitudes = rng.uniform(-160.0, -65.0, size=num_reports)
+    days = rng.integers(0, 365 * 70, size=num_reports)
+    timestamps = np.datetime64("1950-01-01") + days.astype("timedelta64[D]")
+    return pl.DataFrame(
+        {
+            "number": numbers,
+            "title": [
+                f"Report {n}: {t}"
+                for n, t in zip(
+                    numbers.tolist(),
+                    titles[rng.integers(0, len(titles), size=num_reports)],
+                )
+            ],
+            "classification": np.array(CLASSES, dtype=object)[
+                rng.integers(0, len(CLASSES), size=num_reports)
+            ].tolist(),
+            "timestamp": [
+                f"{day}T12:00:00Z" for day in timestamps.astype(str).tolist()
+            ],
+            "latitude": latitudes,
+            "longitude": longitudes,
+            "hexid": geo_to_h3(latitudes, longitudes),
+            "extraction_date": [extraction_date] * num_reports,
+        }
+    )
+
+
+def generate_processed_reports(
+    num_reports: int, seed: int = 42
+) -> pl.DataFrame:
+    # Shaped like the located rows of bfro_reports_geocoded.csv (minus the
+    # weather), for the things that query the published file.
+    geocoded_reports = generate_geocoded_reports(num_reports, seed)
+    values = generate_report_values(num_reports, seed)
+    return pl.DataFrame(
+        {
+            "observed": values["observed"].tolist(),
+            "location_details": values["location_details"].tolist(),
+            "county": values["county"].tolist(),
+            "state": values["state"].tolist(),
+            "season": values["season"].tolist(),
+            "title": geocoded_reports["title"],
+            "latitude": geocoded_reports["latitude"],
+            "longitude": geocoded_reports["longitude"],
+            "date": geocoded_reports["timestamp"].str.slice(0, 10),
+            "number": geocoded_reports["number"],
+            "classification": geocoded_reports["classification"],
+            "hexid": geocoded_reports["hexid"],
+        }
+    )
+
+
+def generate_weather_response(
+    rng: np.random.Generator, latitude: float, longitude: float, day: str
+) -> str:
+    # A Visual Crossing timeline response for a single day, with the
+    # include=days fields and the station metadata that come with it.
+    temp_max = float(rng.uniform(20.0, 100.0))
+    temp_min = temp_max - float(rng.uniform(5.0, 30.0))
+    precip = float(rng.choice([0.0, 0.0, 0.0, rng.uniform(0.01, 2.0)]))
+    conditions = rng.choice(
+        ["Clear", "Partially cloudy", "Overcast", "Rain, Overcast", "Snow"]
+    )
+    return json.dumps(
+        {
+            "queryCost": 1,
+            "latitude": latitude,
+            "longitude": longitude,
+            "resolvedAddress": f"{latitude},{longitude}",
+            "address": f"{latitude},{longitude}",
+            "timezone": "America/Chicago",
+            "tzoffset": -6.0,
+            "days": [
+                {
+                    "datetime": day,
+                    "datetimeEpoch": 0,
+                    "tempmax": round(temp_max, 1),
+                    "tempmin": round(temp_min, 1),
+                    "temp": round((temp_max + temp_min) / 2, 1),
+                    "feelslikemax": round(temp_max, 1),
+                    "feelslikemin": round(temp_min, 1),
+                    "feelslike": round((temp_max + temp_min) / 2, 1),
+                    "dew": round(temp_min - 5.0, 1),
+                    "humidity": round(float(rng.uniform(20, 100)), 1),
+                    "precip": round(precip, 2),
+                    "precipprob": 100.0 if precip else 0.0,
+                    "precipcover": 4.17 if precip else 0.0,
+                    "preciptype": (
+                        ["rain"] if precip and temp_min > 32 else None
+                    ),
+                    "snow": 0.0,
+                    "snowdepth": 0.0,
+                    "windgust": round(float(rng.uniform(0, 40)), 1),
+                    "windspeed": round(float(rng.uniform(0, 25)), 1),
+                    "winddir": round(float(rng.uniform(0, 360)), 1),
+                    "pressure": round(float(rng.uniform(990, 1030)), 1),
+                    "cloudcover": round(float(rng.uniform(0, 100)), 1),
+                    "visibility": round(float(rng.uniform(2, 10)), 1),
+                    "solarradiation": round(float(rng.uniform(0, 300)), 1),
+                    "solarenergy": round(float(rng.uniform(0, 25)), 1),
+                    "uvindex": float(rng.integers(0, 10)),
+                    "sunrise": "06:42:10",
+                    "sunset": "19:58:31",
+                    "moonphase": round(float(rng.uniform(0, 1)), 2),
+                    "conditions": conditions,
+                    "description": f"{conditions} throughout the day.",
+                    "icon": "clear-day",
+                    "stations": ["KORD", "KMDW", "F1980"],
+                    "source": "obs",
+                }
+            ],
+            "stations": {
+                station: {
+                    "distance": float(rng.uniform(1000, 40000)),
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "useCount": 0,
+                    "id": station,
+                    "name": station,
+                    "quality": 50,
+                    "contribution": 0.0,
+                }
+                for station in ["KORD", "KMDW", "F1980"]
+            },
+        }
+    )
+
+
+def generate_weather_cache(
+    geocoded_reports: pl.DataFrame,
+    cached_fraction: float = 0.9,
+    seed: int = 42,
+    date_pulled: str = "2023-01-01",
+) -> pl.DataFrame:
+    # A weather cache covering cached_fraction of the report keys, in the
+    # same layout pull_weather writes. The responses come from a pool (and
+    # are parsed once per pool entry), since their contents don't matter to
+    # anything downstream.
+    rng = np.random.default_rng(seed)
+    keys = geocoded_reports.select(
+        [
+            "hexid",
+            pl.col("timestamp")
+            .str.strptime(pl.Datetime, "%Y-%m-%dT%H:%M:%SZ")
+            .alias("timestamp"),
+        ]
+    ).unique()
+    keys = keys.filter(pl.Series(rng.random(keys.height) < cached_fraction))
+    responses = [
+        generate_weather_response(rng, 40.0, -90.0, "2000-01-01")
+        for _ in range(min(max(keys.height, 1), 500))
+    ]
+    pool = pl.DataFrame(
+        [
+            {
+                **parse_weather_data(response),
+                "data": response,
+                "failed_pulls": 0,
+            }
+            for response in responses
+        ],
+        schema={
+            column: dtype
+            for column, dtype in WEATHER_CACHE_SCHEMA.items()
+            if column not in ("hexid", "timestamp", "date_pulled")
+        },
+    )
+    picks = pl.Series(rng.integers(0, pool.height, size=keys.height))
+    return pl.concat(
+        [
+            keys.with_columns(pl.lit(date_pulled).alias("date_pulled")),
+            pool.select(pl.all().take(picks)),
+        ],
+        how="horizontal",
+    ).select(list(WEATHER_CACHE_SCHEMA))
@@ -0,0 +1,609 @@
+import json
+import subprocess
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import duckdb
+import numpy as np
+import polars as pl
+import typer
+from loguru import logger
+from scrapy.http import HtmlResponse, Request
+
+from benchmarks import PIPELINE_DIR
+from benchmarks.generators import (
+    GDB_URL,
+    generate_gdb_site,
+    generate_geocoded_reports,
+    generate_processed_reports,
+    generate_report_pages,
+    generate_reports,
+    generate_weather_cache,
+    write_kml,
+    write_reports,
+)
+from bfro_scrape.spiders.bfro_reports import BfroReportSpider
+from combine_geocoded_reports import (
+    combine_geocoded_reports,
+    write_combined_geocoded_reports,
+)
+from combine_raw_reports import combine_raw_reports
+from extract_locations_from_kml import extract_geocoded_reports, open_kml
+from pull_weather import (
+    get_missing_weather_keys,
+    get_missing_weather_keys_from_cache,
+    insert_weather_frame,
+    merge_new_records_with_weather_cache,
+    open_weather_cache,
+)
+from report_schema import read_reports
+from run_report import RunReport, StageMetrics, compare_reports
+from spatial_index import _distance_sql, build_index, query_radius
+from storage import write_frame
+from text_index import (
+    TEXT_FIELDS,
+    open_text_index,
+    search,
+    update_text_index,
+)
+
+# Each benchmark takes a size and a scratch directory, generates its inputs
+# there, and returns the function to time. The timed part runs as a run
+# report stage named <benchmark>/<size>, so the results are in the same
+# format as the pipeline's run reports and compare the same way. Peak RSS
+# includes the inputs, which are held in memory while the stage runs.
+Benchmark = Callable[[int, Path], Callable[[StageMetrics], None]]
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+def bench_parse_report(size: int, work_dir: Path):
+    # size report pages through the spider's parse_report, cycling through
+    # a pool of distinct pages.
+    pages = generate_report_pages(min(size, 1000))
+
+    def run(metrics: StageMetrics):
+        spider = BfroReportSpider()
+        for i in range(size):
+            body = pages[i % len(pages)]
+            response = HtmlResponse(
+                url=f"{GDB_URL}show_report.asp?id={i}",
+                body=body,
+                encoding="utf-8",
+            )
+            items = list(spider.parse_report(response))
+            metrics.add(rows_in=1, rows_out=len(items), bytes_read=len(body))
+
+    return run
+
+
+def bench_parse_index_pages(size: int, work_dir: Path):
+    # The GDB index, state, and county pages linking size reports.
+    site = generate_gdb_site(size)
+
+    def run(metrics: StageMetrics):
+        spider = BfroReportSpider()
+        spider.known_reports = set()
+        spider.refresh_reports = set()
+        for url, body in site.items():
+            if url == GDB_URL:
+                callback = spider.parse
+            elif "state_listing" in url:
+                callback = spider.parse_state_page
+            else:
+                callback = spider.parse_county_page
+            # County pages read the conditional GET flags from meta.
+            response = HtmlResponse(
+                url=url, body=body, encoding="utf-8", request=Request(url)
+            )
+            requests = list(callback(response))
+            metrics.add(
+                rows_in=1,
+                bytes_read=len(body),
+                rows_out=(
+                    len(requests)
+                    if callback == spider.parse_county_page
+                    else 0
+                ),
+            )
+
+    return run
+
+
+def bench_extract_geocoded_reports(size: int, work_dir: Path):
+    kml_file = work_dir / f"reports_{size}.kml"
+    write_kml(kml_file, size)
+
+    def run(metrics: StageMetrics):
+        metrics.read_file(kml_file)
+        with open_kml(kml_file) as kml_source:
+            geocoded_reports = extract_geocoded_reports(kml_source)
+        metrics.add(rows_in=size, rows_out=geocoded_reports.height)
+
+    return run
+
+
+def bench_combine_raw_reports(size: int, work_dir: Path):
+    # A history of size reports plus a crawl of size / 10, half of them
+    # re-pulls of existing reports and half new.
+    orig_file = work_dir / f"bfro_reports_{size}.csv"
+    new_file = work_dir / f"bfro_reports_new_{size}.json"
+    write_reports(generate_reports(size), orig_file)
+    new_size = max(size // 10, 1)
+    write_reports(
+        generate_reports(
+            new_size, seed=7, first_report_number=size - new_size // 2 + 1
+        ),
+        new_file,
+    )
+
+    def run(metrics: StageMetrics):
+        reports = combine_raw_reports(
+            orig_file, new_file, duckdb.connect(), metrics
+        )
+        metrics.add(rows_out=reports.num_rows)
+
+    return run
+
+
+def bench_combine_geocoded_reports(size: int, work_dir: Path):
+    # A fresh extraction that's dropped the first 1% of the reports and
+    # added as many new ones.
+    orig_reports = generate_geocoded_reports(size)
+    new_reports = generate_geocoded_reports(
+        size,
+        seed=7,
+        first_report_number=size // 100 + 1,
+        extraction_date="2023-02-01",
+    )
+
+    def run(metrics: StageMetrics):
+        combined_reports = combine_geocoded_reports(
+            orig_reports, new_reports, duckdb.connect()
+        )
+        metrics.add(
+            rows_in=orig_reports.height + new_reports.height,
+            rows_out=combined_reports.height,
+        )
+
+    return run
+
+
+def bench_write_combined_geocoded_reports(size: int, work_dir: Path):
+    # The same merge as above, file to file.
+    orig_reports_file = work_dir / f"geocoded_reports_{size}.csv"
+    new_reports_file = work_dir / f"geocoded_reports_new_{size}.csv"
+    write_frame(generate_geocoded_reports(size), orig_reports_file)
+    write_frame(
+        generate_geocoded_reports(
+            size,
+            seed=7,
+            first_report_number=size // 100 + 1,
+            extraction_date="2023-02-01",
+        ),
+        new_reports_file,
+    )
+    combined_reports_file = work_dir / f"geocoded_reports_combined_{size}.csv"
+
+    def run(metrics: StageMetrics):
+        rows = write_combined_geocoded_reports(
+            orig_reports_file, new_reports_file, combined_reports_file
+        )
+        metrics.read_file(orig_reports_file)
+        metrics.read_file(new_reports_file)
+        metrics.add(rows_out=rows)
+        metrics.wrote_file(combined_reports_file)
+
+    return run
+
+
+def _weather_inputs(size: int, work_dir: Path):
+    # Geocoded reports and a weather cache with 90% of their keys.
+    geocoded_reports = generate_geocoded_reports(size)
+    geocoded_reports_file = work_dir / f"geocoded_reports_{size}.csv"
+    write_frame(geocoded_reports, geocoded_reports_file)
+    weather_cache = generate_weather_cache(geocoded_reports)
+    weather_cache_file = work_dir / f"weather_cache_{size}.parquet"
+    write_frame(weather_cache, weather_cache_file)
+    return geocoded_reports, geocoded_reports_file, weather_cache_file
+
+
+def bench_get_missing_weather_keys(size: int, work_dir: Path):
+    _, geocoded_reports_file, weather_cache_file = _weather_inputs(
+        size, work_dir
+    )
+
+    def run(metrics: StageMetrics):
+        metrics.read_file(geocoded_reports_file)
+        metrics.read_file(weather_cache_file)
+        missing_keys = get_missing_weather_keys(
+            geocoded_reports_file, weather_cache_file
+        )
+        metrics.add(
+            rows_in=size,
+            rows_out=missing_keys.height,
+            cache_hits=size - missing_keys.height,
+            cache_misses=missing_keys.height,
+        )
+
+    return run
+
+
+def bench_get_missing_weather_keys_from_cache(size: int, work_dir: Path):
+    # The DuckDB cache table the pipeline uses, rather than files.
+    _, geocoded_reports_file, weather_cache_file = _weather_inputs(
+        size, work_dir
+    )
+    weather_cache = open_weather_cache(Path(":memory:"))
+    insert_weather_frame(weather_cache, pl.read_parquet(weather_cache_file))
+
+    def run(metrics: StageMetrics):
+        missing_keys = get_missing_weather_keys_from_cache(
+            geocoded_reports_file, weather_cache
+        )
+        metrics.add(
+            rows_in=size,
+            rows_out=missing_keys.height,
+            cache_hits=size - missing_keys.height,
+            cache_misses=missing_keys.height,
+        )
+
+    return run
+
+
+def bench_merge_new_records_with_weather_cache(size: int, work_dir: Path):
+    # A new pull of size / 10 keys merged into a cache of size.
+    weather_cache_file = work_dir / f"weather_cache_full_{size}.parquet"
+    write_frame(
+        generate_weather_cache(
+            generate_geocoded_reports(size), cached_fraction=1.0
+        ),
+        weather_cache_file,
+    )
+    new_weather_data = generate_weather_cache(
+        generate_geocoded_reports(
+            max(size // 10, 1), seed=7, first_report_number=size + 1
+        ),
+        cached_fraction=1.0,
+        date_pulled="2023-02-01",
+    )
+
+    def run(metrics: StageMetrics):
+        metrics.read_file(weather_cache_file)
+        merged = merge_new_records_with_weather_cache(
+            weather_cache_file, new_weather_data
+        )
+        metrics.add(
+            rows_in=size + new_weather_data.height, rows_out=merged.height
+        )
+
+    return run
+
+
+def _spatial_inputs(size: int, work_dir: Path):
+    # The published reports, and 20 "Class A reports within 50km between 1990
+    # and 2000" queries around random points in the same area.
+    reports_file = work_dir / f"processed_reports_{size}.csv"
+    write_frame(generate_processed_reports(size), reports_file)
+    rng = np.random.default_rng(42)
+    centers = list(
+        zip(
+            rng.uniform(25.0, 60.0, size=20).tolist(),
+            rng.uniform(-160.0, -65.0, size=20).tolist(),
+        )
+    )
+    return reports_file, centers
+
+
+SPATIAL_QUERY = {
+    "radius_km": 50.0,
+    "start": datetime(1990, 1, 1),
+    "end": datetime(2000, 12, 31),
+    "classification": "Class A",
+}
+
+
+def bench_build_spatial_index(size: int, work_dir: Path):
+    reports_file, _ = _spatial_inputs(size, work_dir)
+    index_dir = work_dir / f"spatial_index_{size}"
+
+    def run(metrics: StageMetrics):
+        metrics.read_file(reports_file)
+        rows = build_index(reports_file, index_dir, con=duckdb.connect())
+        metrics.add(rows_in=size, rows_out=rows)
+
+    return run
+
+
+def bench_spatial_index_queries(size: int, work_dir: Path):
+    reports_file, centers = _spatial_inputs(size, work_dir)
+    index_dir = work_dir / f"spatial_index_{size}"
+    build_index(reports_file, index_dir, con=duckdb.connect())
+
+    def run(metrics: StageMetrics):
+        con = duckdb.connect()
+        for latitude, longitude in centers:
+            reports = query_radius(
+                index_dir, latitude, longitude, con=con, **SPATIAL_QUERY
+            ).fetchall()
+            metrics.add(rows_out=len(reports))
+
+    return run
+
+
+def bench_spatial_scan_queries(size: int, work_dir: Path):
+    # The same queries as a full scan of the published file, to compare.
+    reports_file, centers = _spatial_inputs(size, work_dir)
+
+    def run(metrics: StageMetrics):
+        con = duckdb.connect()
+        for latitude, longitude in centers:
+            reports = con.sql(
+                f"""
+                SELECT * FROM '{reports_file}'
+                WHERE
+                    {_distance_sql(latitude, longitude)}
+                        <= {SPATIAL_QUERY["radius_km"]} AND
+                    TRY_CAST(date AS DATE) BETWEEN
+                        DATE '{SPATIAL_QUERY["start"]:%Y-%m-%d}' AND
+                        DATE '{SPATIAL_QUERY["end"]:%Y-%m-%d}' AND
+                    classification = '{SPATIAL_QUERY["classification"]}'
+                """
+            ).fetchall()
+            metrics.read_file(reports_file)
+            metrics.add(rows_out=len(reports))
+
+    return run
+
+
+# Common words in the generated narratives, so each query matches most of
+# the reports: the worst case for the index.
+TEXT_QUERIES = [
+    "tall dark figure",
+    "footprints in the snow",
+    "loud scream near the creek",
+    "strong smell",
+    "whoop knock",
+]
+
+
+def _text_index_inputs(size: int, work_dir: Path) -> Path:
+    reports_file = work_dir / f"bfro_reports_{size}.csv"
+    write_reports(generate_reports(size), reports_file)
+    return reports_file
+
+
+def bench_update_text_index(size: int, work_dir: Path):
+    # Indexes size reports, then times the update after 1% of them are
+    # pulled again.
+    reports_file = _text_index_inputs(size, work_dir)
+    updated_file = work_dir / f"bfro_reports_updated_{size}.csv"
+    updated_reports = pl.concat(
+        [
+            pl.from_arrow(generate_reports(size)).slice(size // 100),
+            pl.from_arrow(
+                generate_reports(
+                    size // 100, seed=7, pulled_datetime=datetime(2023, 2, 1)
+                )
+            ),
+        ]
+    )
+    write_reports(updated_reports.to_arrow(), updated_file)
+    index_file = work_dir / f"text_index_{size}.duckdb"
+    index_file.unlink(missing_ok=True)
+    con = open_text_index(index_file)
+    update_text_index(con, reports_file)
+
+    def run(metrics: StageMetrics):
+        metrics.read_file(updated_file)
+        metrics.add(rows_out=update_text_index(con, updated_file))
+
+    return run
+
+
+def bench_text_index_queries(size: int, work_dir: Path):
+    reports_file = _text_index_inputs(size, work_dir)
+    index_file = work_dir / f"text_index_{size}.duckdb"
+    index_file.unlink(missing_ok=True)
+    con = open_text_index(index_file)
+    update_text_index(con, reports_file)
+
+    def run(metrics: StageMetrics):
+        for query in TEXT_QUERIES:
+            metrics.add(rows_out=search(con, query).height)
+
+    return run
+
+
+def bench_text_scan_queries(size: int, work_dir: Path):
+    # The same queries as a substring scan of the reports file, with the
+    # words in any order but no ranking, to compare.
+    reports_file = _text_index_inputs(size, work_dir)
+    text = " || ' ' || ".join(
+        f"COALESCE({field}, '')" for field in TEXT_FIELDS
+    )
+
+    def run(metrics: StageMetrics):
+        con = duckdb.connect()
+        for query in TEXT_QUERIES:
+            words = " AND ".join(
+                f"{text} ILIKE '%{word}%'" for word in query.split()
+            )
+            reports = con.sql(
+                f"""
+                SELECT report_number FROM {read_reports(reports_file)}
+                WHERE {words}
+                LIMIT 10
+                """
+            ).fetchall()
+            metrics.read_file(reports_file)
+            metrics.add(rows_out=len(reports))
+
+    return run
+
+
+def dbt_benchmark(project_dir: Path) -> Benchmark:
+    def bench_dbt_models(size: int, work_dir: Path):
+        # A full build of the models on the transient (in memory) target,
+        # from parquet sources.
+        data_dir = work_dir / f"dbt_{size}"
+        for subdir in ["sources", "interim", "processed"]:
+            (data_dir / subdir).mkdir(parents=True, exist_ok=True)
+        write_reports(
+            generate_reports(size), data_dir / "sources/bfro_reports.parquet"
+        )
+        geocoded_reports = generate_geocoded_reports(size)
+        write_frame(
+            geocoded_reports, data_dir / "sources/geocoded_reports.parquet"
+        )
+        write_frame(
+            generate_weather_cache(geocoded_reports),
+            data_dir / "sources/weather_cache.parquet",
+        )
+
+        def run(metrics: StageMetrics):
+            from dbt.cli.main import dbtRunner
+
+            for source in data_dir.glob("sources/*.parquet"):
+                metrics.read_file(source)
+            result = dbtRunner().invoke(
+                [
+                    "run",
+                    "--quiet",
+                    "--target",
+                    "transient",
+                    "--project-dir",
+                    str(project_dir),
+                    "--profiles-dir",
+                    str(project_dir),
+                    "--vars",
+                    json.dumps(
+                        {
+                            "data_dir": str(data_dir),
+                            "storage_format": "parquet",
+                        }
+                    ),
+                ]
+            )
+            if not result.success:
+                raise RuntimeError("dbt run failed.") from result.exception
+            for node_result in result.result or []:
+                metrics.details[node_result.node.name] = round(
+                    node_result.execution_time, 3
+                )
+            metrics.add(rows_in=size)
+            metrics.wrote_file(data_dir / "interim/weather.parquet")
+            metrics.wrote_file(
+                data_dir / "processed/bfro_reports_geocoded.csv"
+            )
+
+        return run
+
+    return bench_dbt_models
+
+
+def benchmarks(dbt_project_dir: Path) -> Dict[str, Benchmark]:
+    return {
+        "parse_report": bench_parse_report,
+        "parse_index_pages": bench_parse_index_pages,
+        "extract_geocoded_reports": bench_extract_geocoded_reports,
+        "combine_raw_reports": bench_combine_raw_reports,
+        "combine_geocoded_reports": bench_combine_geocoded_reports,
+        "write_combined_geocoded_reports": (
+            bench_write_combined_geocoded_reports
+        ),
+        "get_missing_weather_keys": bench_get_missing_weather_keys,
+        "get_missing_weather_keys_from_cache": (
+            bench_get_missing_weather_keys_from_cache
+        ),
+        "merge_new_records_with_weather_cache": (
+            bench_merge_new_records_with_weather_cache
+        ),
+        "build_spatial_index": bench_build_spatial_index,
+        "spatial_index_queries": bench_spatial_index_queries,
+        "spatial_scan_queries": bench_spatial_scan_queries,
+        "update_text_index": bench_update_text_index,
+        "text_index_queries": bench_text_index_queries,
+        "text_scan_queries": bench_text_scan_queries,
+        "dbt_models": dbt_benchmark(dbt_project_dir),
+    }
+
+
+def git_commit() -> str:
+    # The commit the results are for, marked dirty if there are local
+    # changes.
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=PIPELINE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def latest_results(results_dir: Path) -> Optional[Path]:
+    results = [
+        (json.loads(file.read_text())["started"], file)
+        for file in results_dir.glob("*.json")
+    ]
+    return max(results)[1] if results else None
+
+
+def main(
+    sizes: List[int] = typer.Option([10_000, 100_000, 1_000_000]),
+    benchmark: List[str] = typer.Option(
+        [], help="Benchmarks to run, all of them if not given."
+    ),
+    results_dir: Path = RESULTS_DIR,
+    baseline: Optional[Path] = None,
+    threshold: float = 0.2,
+    work_dir: Optional[Path] = None,
+    dbt_project_dir: Path = PIPELINE_DIR / "bfro_mini_warehouse",
+):
+    # Run from pipeline/:
+    #   python -m benchmarks.run --sizes 10000 --benchmark parse_report
+    # Results go to results_dir/<commit>.json and are compared against
+    # baseline, or the most recent results already there.
+    available = benchmarks(dbt_project_dir)
+    unknown = set(benchmark) - set(available)
+    if unknown:
+        raise typer.BadParameter(f"Unknown benchmarks {sorted(unknown)}.")
+    report = RunReport("benchmarks")
+    with tempfile.TemporaryDirectory(dir=work_dir) as scratch_dir:
+        for name in benchmark or list(available):
+            for size in sizes:
+                logger.info(f"Generating inputs for {name} at {size}.")
+                run = available[name](size, Path(scratch_dir))
+                with report.stage(f"{name}/{size}") as metrics:
+                    run(metrics)
+
+    commit = git_commit()
+    results = {**report.to_dict(), "commit": commit, "sizes": sizes}
+    results_file = results_dir / f"{commit}.json"
+    results_dir.mkdir(parents=True, exist_ok=True)
+    # Read before writing, since a rerun on the same commit replaces its
+    # earlier results.
+    if baseline is None:
+        baseline = latest_results(results_dir)
+    baseline_results = (
+        json.loads(baseline.read_text()) if baseline is not None else None
+    )
+    results_file.write_text(json.dumps(results, indent=2))
+    logger.info(f"Wrote results to {results_file}.")
+
+    if baseline_results is not None:
+        logger.info(f"Comparing against {baseline}.")
+        regressions = compare_reports(baseline_results, results, threshold)
+        for regression in regressions:
+            logger.warning(f"Regression: {regression}")
+        if not regressions:
+            logger.info("No regressions.")
+
+
+if __name__ == "__main__":
+    typer.run(main)
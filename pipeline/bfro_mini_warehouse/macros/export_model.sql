@@ -0,0 +1,24 @@
+{#
+    Writes a model's table out to a file, for the incremental models that live
+    in the warehouse but still need to show up as files for everyone else.
+    Used as a post-hook, e.g.
+
+        post_hook="{{ export_model(this, 'path/to/file.csv', 'csv') }}"
+
+    The exclude list drops bookkeeping columns that only matter to the
+    incremental runs. With partition_by the location is a directory of hive
+    partitions (column=value/data_0.parquet), rewritten in place.
+#}
+{% macro export_model(relation, location, format, exclude=[], partition_by=[]) %}
+    COPY (
+        SELECT *
+        {%- if exclude %} EXCLUDE ({{ exclude | join(", ") }}){% endif %}
+        FROM {{ relation }}
+    ) TO '{{ location }}'
+    (
+        {%- if format == "parquet" %}FORMAT PARQUET, COMPRESSION ZSTD
+        {%- else %}HEADER, DELIMITER ','
+        {%- endif %}
+        {%- if partition_by %}, PARTITION_BY ({{ partition_by | join(", ") }}), OVERWRITE_OR_IGNORE true{% endif -%}
+    )
+{% endmacro %}
@@ -0,0 +1,26 @@
+{#
+    The aggregates every rollup model has, over a group of rows from
+    bfro_reports_geocoded: the sighting counts, the class breakdown, the date
+    range, and the averages of the main weather fields over the reports that
+    have weather.
+#}
+{% macro sighting_summary(reports="reports") %}
+    COUNT(*) AS reports,
+    COUNT(*) FILTER (WHERE {{ reports }}.classification = 'Class A')
+        AS class_a_reports,
+    COUNT(*) FILTER (WHERE {{ reports }}.classification = 'Class B')
+        AS class_b_reports,
+    COUNT(*) FILTER (WHERE {{ reports }}.classification = 'Class C')
+        AS class_c_reports,
+    MIN(TRY_CAST({{ reports }}.date AS DATE)) AS first_date,
+    MAX(TRY_CAST({{ reports }}.date AS DATE)) AS last_date,
+    COUNT({{ reports }}.weather_date_pulled) AS reports_with_weather,
+    AVG({{ reports }}.temperature_high)::FLOAT AS avg_temperature_high,
+    AVG({{ reports }}.temperature_mid)::FLOAT AS avg_temperature_mid,
+    AVG({{ reports }}.temperature_low)::FLOAT AS avg_temperature_low,
+    AVG({{ reports }}.humidity)::FLOAT AS avg_humidity,
+    AVG({{ reports }}.cloud_cover)::FLOAT AS avg_cloud_cover,
+    AVG({{ reports }}.precip_intensity)::FLOAT AS avg_precip_intensity,
+    AVG({{ reports }}.wind_speed)::FLOAT AS avg_wind_speed,
+    AVG({{ reports }}.moon_phase)::FLOAT AS avg_moon_phase
+{% endmacro %}
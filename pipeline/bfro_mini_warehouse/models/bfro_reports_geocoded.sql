@@ -1,11 +1,69 @@
 {{
     config(
-        materialized="external",
-        location=var('data_dir') + "/processed/bfro_reports_geocoded.csv",
-        format="csv"
+        materialized="incremental",
+        unique_key="number",
+        incremental_strategy="delete+insert",
+        post_hook="{{ export_model(
+            this,
+            var('data_dir') + '/processed/bfro_reports_geocoded.csv',
+            'csv',
+            exclude=['pulled_datetime', 'extraction_date', 'weather_date_pulled']
+        ) }}"
     )
 }}
 
+WITH geo AS (
+    SELECT * FROM {{ source("local_files", "geocoded_reports") }}
+),
+
+reports AS (
+    SELECT * FROM {{ source("local_files", "bfro_reports") }}
+),
+
+{% if is_incremental() %}
+-- The reports that were scraped, extracted, or got weather since the last
+-- build. These are >= for the same reason as the weather model.
+changed_reports AS (
+    SELECT report_number AS number
+    FROM reports
+    WHERE pulled_datetime::TIMESTAMP >= (
+        SELECT COALESCE(MAX(pulled_datetime), TIMESTAMP '1900-01-01')
+        FROM {{ this }}
+    )
+    UNION
+    SELECT number
+    FROM geo
+    WHERE extraction_date::DATE >= (
+        SELECT COALESCE(MAX(extraction_date), DATE '1900-01-01')
+        FROM {{ this }}
+    )
+    UNION
+    SELECT geo.number
+    FROM geo
+    INNER JOIN {{ ref("weather") }} AS weather
+        ON
+            geo.hexid = weather.hexid AND
+            geo.timestamp::TIMESTAMP = weather.timestamp
+    WHERE weather.date_pulled >= (
+        SELECT COALESCE(MAX(weather_date_pulled), DATE '1900-01-01')
+        FROM {{ this }}
+    )
+),
+{% endif %}
+
+changed_geo AS (
+    SELECT * FROM geo
+    {% if is_incremental() %}
+        WHERE number IN (SELECT number FROM changed_reports)
+    {% endif %}
+),
+
+changed_scraped_reports AS (
+    SELECT * FROM reports
+    {% if is_incremental() %}
+        WHERE report_number IN (SELECT number FROM changed_reports)
+    {% endif %}
+)
 
 SELECT
     -- Re-alias these columns to represent them as lower case in the CSV file.
@@ -19,7 +77,8 @@ SELECT
     geo.title,
     geo.latitude,
     geo.longitude,
-    COALESCE(STRFTIME(geo.timestamp, '%Y-%m-%d'), reports.date) AS date,
+    COALESCE(STRFTIME(geo.timestamp::TIMESTAMP, '%Y-%m-%d'), reports.date)
+        AS date,
     COALESCE(reports.report_number, geo.number) AS number,
     COALESCE(reports.report_class, geo.classification) AS classification,
     geo.hexid,
@@ -32,7 +91,8 @@ SELECT
     weather.moon_phase,
     weather.precip_intensity,
     weather.precip_probability,
-    weather.precip_type,
+    -- Written out as JSON, the way it comes from the API.
+    TO_JSON(weather.precip_type)::VARCHAR AS precip_type,
     weather.pressure,
     weather.summary,
     weather.conditions,
@@ -40,11 +100,17 @@ SELECT
     weather.visibility,
     weather.wind_bearing,
     weather.wind_speed,
+    -- Bookkeeping for the incremental builds, not exported.
+    reports.pulled_datetime::TIMESTAMP AS pulled_datetime,
+    geo.extraction_date::DATE AS extraction_date,
+    weather.date_pulled AS weather_date_pulled,
 FROM
-    {{ source("local_files", "geocoded_reports") }} AS geo
+    changed_geo AS geo
 FULL OUTER JOIN
-    {{ source("local_files", "bfro_reports") }} AS reports
+    changed_scraped_reports AS reports
     ON reports.report_number = geo.number
 LEFT JOIN
     {{ ref("weather") }} AS weather
-    ON geo.hexid = weather.hexid AND geo.timestamp = weather.timestamp
\ No newline at end of file
+    ON
+        geo.hexid = weather.hexid AND
+        geo.timestamp::TIMESTAMP = weather.timestamp
@@ -0,0 +1,55 @@
+import h3
+import pyarrow as pa
+
+# DuckDB doesn't know about H3, so the coarser cells are worked out here: each
+# resolution 10 hexid in the reports, and its parent at every resolution up
+# to and including its own, with the parent's center for plotting. The
+# rollup models pick the resolutions they want out of this. A hexid's parents
+# never change, so each build only adds the hexids it hasn't seen.
+
+
+def model(dbt, session):
+    dbt.config(materialized="incremental")
+    new_hexids = (
+        dbt.ref("bfro_reports_geocoded")
+        .filter("hexid IS NOT NULL")
+        .project("hexid")
+        .distinct()
+    )
+    if dbt.is_incremental:
+        new_hexids = new_hexids.filter(
+            f"hexid NOT IN (SELECT hexid FROM {dbt.this})"
+        )
+    hexids = [hexid for (hexid,) in new_hexids.fetchall()]
+    columns = {
+        "hexid": [],
+        "resolution": [],
+        "parent_hexid": [],
+        "parent_latitude": [],
+        "parent_longitude": [],
+    }
+    # Neighbouring reports share most of their parents.
+    centers = {}
+    for hexid in hexids:
+        for resolution in range(h3.h3_get_resolution(hexid) + 1):
+            parent = h3.h3_to_parent(hexid, resolution)
+            if parent not in centers:
+                centers[parent] = h3.h3_to_geo(parent)
+            latitude, longitude = centers[parent]
+            columns["hexid"].append(hexid)
+            columns["resolution"].append(resolution)
+            columns["parent_hexid"].append(parent)
+            columns["parent_latitude"].append(latitude)
+            columns["parent_longitude"].append(longitude)
+    return pa.table(
+        columns,
+        schema=pa.schema(
+            [
+                ("hexid", pa.string()),
+                ("resolution", pa.int8()),
+                ("parent_hexid", pa.string()),
+                ("parent_latitude", pa.float64()),
+                ("parent_longitude", pa.float64()),
+            ]
+        ),
+    )
@@ -0,0 +1,31 @@
+{{ config(
+    materialized="table",
+    post_hook="{{ export_model(
+        this,
+        var('data_dir') + '/processed/sightings_by_hex',
+        'parquet',
+        partition_by=['resolution']
+    ) }}"
+) }}
+
+-- Sighting counts and weather by H3 cell at each of the rollup resolutions,
+-- for heatmaps. Partitioned by resolution so a map only reads its zoom level.
+SELECT
+    parents.resolution,
+    parents.parent_hexid AS hexid,
+    ANY_VALUE(parents.parent_latitude) AS latitude,
+    ANY_VALUE(parents.parent_longitude) AS longitude,
+    {{ sighting_summary() }}
+FROM
+    {{ ref("bfro_reports_geocoded") }} AS reports
+INNER JOIN
+    {{ ref("hex_parents") }} AS parents
+    ON reports.hexid = parents.hexid
+WHERE
+    parents.resolution IN ({{ var("rollup_resolutions") | join(", ") }})
+GROUP BY
+    parents.resolution,
+    parents.parent_hexid
+ORDER BY
+    parents.resolution,
+    parents.parent_hexid
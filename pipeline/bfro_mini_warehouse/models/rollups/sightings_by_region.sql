@@ -0,0 +1,38 @@
+{{ config(
+    materialized="table",
+    post_hook="{{ export_model(
+        this,
+        var('data_dir') + '/processed/sightings_by_region',
+        'parquet',
+        partition_by=['state']
+    ) }}"
+) }}
+
+-- Sighting counts and weather by state, county and year. The year comes from
+-- the sighting date where it parses, otherwise the first four digit number in
+-- the report's own (often approximate) year, e.g. 1970 for "Early 1970's".
+WITH report_years AS (
+    SELECT
+        report_number AS number,
+        TRY_CAST(REGEXP_EXTRACT(year::VARCHAR, '\d{4}') AS INTEGER) AS year
+    FROM {{ source("local_files", "bfro_reports") }}
+)
+
+SELECT
+    reports.state,
+    reports.county,
+    COALESCE(YEAR(TRY_CAST(reports.date AS DATE)), report_years.year) AS year,
+    {{ sighting_summary() }}
+FROM
+    {{ ref("bfro_reports_geocoded") }} AS reports
+LEFT JOIN
+    report_years
+    ON reports.number = report_years.number
+GROUP BY
+    reports.state,
+    reports.county,
+    COALESCE(YEAR(TRY_CAST(reports.date AS DATE)), report_years.year)
+ORDER BY
+    reports.state,
+    reports.county,
+    year
@@ -1,58 +1,63 @@
 {{ config(
-    materialized="external",
-    location=var('data_dir') + "/interim/weather.csv",
-    format="csv",
-    pre_hook="
-        CREATE MACRO convert_str_null_to_null(col) AS 
-        CASE WHEN col != 'null' THEN col ELSE NULL END
-    "
+    materialized="incremental",
+    unique_key=["hexid", "timestamp"],
+    incremental_strategy="delete+insert",
+    on_schema_change="append_new_columns",
+    post_hook=[
+        "UPDATE {{ this }}
+        SET source_hexid = hexid, source_distance_km = 0
+        WHERE source_hexid IS NULL",
+        "{{ export_model(
+            this,
+            var('data_dir') + '/interim/weather.' + var('storage_format'),
+            var('storage_format'),
+            exclude=['date_pulled']
+        ) }}",
+    ]
 ) }}
 
-WITH extracted_weather_fields AS (
-    SELECT
-        hexid,
-        timestamp,
-        data -> 'days' -> 0 ->> 'tempmax' AS temperature_high,
-        data -> 'days' -> 0 ->> 'tempmin' AS temperature_low,
-        data -> 'days' -> 0 ->> 'temp' AS temperature_mid,
-        data -> 'days' -> 0 ->> 'dew' AS dew_point,
-        data -> 'days' -> 0 ->> 'humidity' AS humidity,
-        data -> 'days' -> 0 ->> 'cloudcover' AS cloud_cover,
-        data -> 'days' -> 0 ->> 'moonphase' AS moon_phase,
-        data -> 'days' -> 0 ->> 'precip' AS precip_intensity,
-        data -> 'days' -> 0 ->> 'precipprob' AS precip_probability,
-        data -> 'days' -> 0 ->> 'preciptype' AS precip_type,
-        data -> 'days' -> 0 ->> 'pressure' AS pressure,
-        data -> 'days' -> 0 ->> 'description' AS summary,
-        data -> 'days' -> 0 ->> 'conditions' AS conditions,
-        data -> 'days' -> 0 ->> 'uvindex' AS uv_index,
-        data -> 'days' -> 0 ->> 'visibility' AS visibility,
-        data -> 'days' -> 0 ->> 'winddir' AS wind_bearing,
-        data -> 'days' -> 0 ->> 'windspeed' AS wind_speed,
-    FROM
-        {{ source("local_files", "weather_cache") }}
-    WHERE data IS NOT NULL
-)
+-- The source columns were added to an existing table with nulls, which
+-- the first post hook fills in. Everything before them was pulled for its
+-- own hex.
 
+-- The weather fields are parsed out of the raw response when it's pulled
+-- (see pull_weather.py), so this just picks them out. The casts are for the
+-- csv sources, they're no-ops on parquet. Weather reused from a nearby hex
+-- (reuse_nearby_weather in pull_weather.py) says where it came from, the
+-- rest was pulled for the hex itself.
 SELECT
     hexid,
-    timestamp,
-    CONVERT_STR_NULL_TO_NULL(temperature_high)::FLOAT AS temperature_high,
-    CONVERT_STR_NULL_TO_NULL(temperature_low)::FLOAT AS temperature_low,
-    CONVERT_STR_NULL_TO_NULL(temperature_mid)::FLOAT AS temperature_mid,
-    CONVERT_STR_NULL_TO_NULL(dew_point)::FLOAT AS dew_point,
-    CONVERT_STR_NULL_TO_NULL(humidity)::FLOAT AS humidity,
-    CONVERT_STR_NULL_TO_NULL(cloud_cover)::FLOAT AS cloud_cover,
-    CONVERT_STR_NULL_TO_NULL(moon_phase)::FLOAT AS moon_phase,
-    CONVERT_STR_NULL_TO_NULL(precip_intensity)::FLOAT AS precip_intensity,
-    CONVERT_STR_NULL_TO_NULL(precip_probability)::FLOAT AS precip_probability,
-    CONVERT_STR_NULL_TO_NULL(precip_type) AS precip_type,
-    CONVERT_STR_NULL_TO_NULL(pressure)::FLOAT AS pressure,
-    CONVERT_STR_NULL_TO_NULL(summary) AS summary,
-    CONVERT_STR_NULL_TO_NULL(conditions) AS conditions,
-    CONVERT_STR_NULL_TO_NULL(uv_index)::FLOAT AS uv_index,
-    CONVERT_STR_NULL_TO_NULL(visibility)::FLOAT AS visibility,
-    CONVERT_STR_NULL_TO_NULL(wind_bearing)::FLOAT AS wind_bearing,
-    CONVERT_STR_NULL_TO_NULL(wind_speed)::FLOAT AS wind_speed,
+    timestamp::TIMESTAMP AS timestamp,
+    date_pulled::DATE AS date_pulled,
+    temperature_high::FLOAT AS temperature_high,
+    temperature_low::FLOAT AS temperature_low,
+    temperature_mid::FLOAT AS temperature_mid,
+    dew_point::FLOAT AS dew_point,
+    humidity::FLOAT AS humidity,
+    cloud_cover::FLOAT AS cloud_cover,
+    moon_phase::FLOAT AS moon_phase,
+    precip_intensity::FLOAT AS precip_intensity,
+    precip_probability::FLOAT AS precip_probability,
+    precip_type::VARCHAR[] AS precip_type,
+    pressure::FLOAT AS pressure,
+    summary::VARCHAR AS summary,
+    conditions::VARCHAR AS conditions,
+    uv_index::FLOAT AS uv_index,
+    visibility::FLOAT AS visibility,
+    wind_bearing::FLOAT AS wind_bearing,
+    wind_speed::FLOAT AS wind_speed,
+    COALESCE(source_hexid::VARCHAR, hexid) AS source_hexid,
+    COALESCE(source_distance_km::FLOAT, 0) AS source_distance_km,
 FROM
-    extracted_weather_fields
+    {{ source("local_files", "weather_cache") }}
+WHERE
+    data IS NOT NULL
+    {% if is_incremental() %}
+        -- Only the responses pulled since the last build. This is >= so a
+        -- second build on the same day picks up the rest of that day's pulls,
+        -- the delete+insert on the key keeps that idempotent.
+        AND date_pulled::DATE >= (
+            SELECT COALESCE(MAX(date_pulled), DATE '1900-01-01')
+            FROM {{ this }}
+        )
+    {% endif %}
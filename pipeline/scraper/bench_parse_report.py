@@ -0,0 +1,113 @@
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import typer
+from loguru import logger
+from scrapy.http import HtmlResponse
+
+from bfro_scrape.report_fields import extract_report_fields
+
+
+def extract_report_fields_xpath(
+    response: HtmlResponse,
+) -> Dict[str, Optional[str]]:
+    # The original per-field XPath extractor from parse_report, kept here as
+    # the baseline.
+    report_number = response.css("span.reportheader::text").re(
+        r"Report # (\d+)"
+    )
+    report_class = response.css("span.reportclassification::text").re(
+        r"\((.*)\)"
+    )
+    raw_keys = response.xpath("//p/span[@class='field']/text()").extract()
+    keys = [k.replace(":", "").replace(" ", "_") for k in raw_keys]
+    value_query = (
+        "//p[span[@class = 'field' and contains(text(), '{}')]]/text()"
+    )
+    values = [
+        " ".join(
+            [
+                s.strip()
+                for s in response.xpath(value_query.format(k)).extract()
+            ]
+        )
+        for k in raw_keys
+    ]
+    data = dict(zip(keys, values))
+    data["REPORT_NUMBER"] = (
+        report_number[0] if len(report_number) > 0 else None
+    )
+    data["REPORT_CLASS"] = report_class[0] if len(report_class) > 0 else None
+    anchor_query = (
+        "//p[span[@class='field' and contains(text(), '{}')]]/a/text()"
+    )
+    empty_keys = [k for k in keys if len(data[k]) == 0]
+    for k in empty_keys:
+        data[k] = response.xpath(anchor_query.format(k)).extract_first()
+    return data
+
+
+def load_fixtures(fixtures_dir: Path) -> List[HtmlResponse]:
+    return [
+        HtmlResponse(
+            url=f"http://www.bfro.net/GDB/{f.name}",
+            body=f.read_bytes(),
+            encoding="utf-8",
+        )
+        for f in sorted(fixtures_dir.glob("*.html"))
+    ]
+
+
+def pages_per_second(
+    extractor: Callable[[HtmlResponse], Dict[str, Optional[str]]],
+    responses: List[HtmlResponse],
+    rounds: int,
+) -> float:
+    # Fresh responses each round so the selector cache doesn't get reused.
+    bodies = [(r.url, r.body) for r in responses]
+    elapsed = 0.0
+    for _ in range(rounds):
+        fresh = [
+            HtmlResponse(url=url, body=body, encoding="utf-8")
+            for url, body in bodies
+        ]
+        start = time.perf_counter()
+        for response in fresh:
+            extractor(response)
+        elapsed += time.perf_counter() - start
+    return len(bodies) * rounds / elapsed
+
+
+def main(
+    fixtures_dir: Path = Path(__file__).parent / "fixtures" / "report_pages",
+    rounds: int = 5,
+):
+    # Run from pipeline/scraper, on the committed pages or a directory of
+    # saved report pages:
+    #   python bench_parse_report.py --fixtures-dir path/to/report/pages
+    responses = load_fixtures(fixtures_dir)
+    if not responses:
+        raise ValueError(f"No .html fixtures found in {fixtures_dir}.")
+    logger.info(f"Loaded {len(responses)} report pages.")
+
+    logger.info("Checking extractors agree.")
+    for response in responses:
+        if extract_report_fields(response) != extract_report_fields_xpath(
+            response
+        ):
+            raise ValueError(f"Extractors disagree on {response.url}.")
+
+    xpath_rate = pages_per_second(
+        extract_report_fields_xpath, responses, rounds
+    )
+    logger.info(f"xpath extractor: {xpath_rate:.1f} pages/sec")
+    single_pass_rate = pages_per_second(
+        extract_report_fields, responses, rounds
+    )
+    logger.info(f"single pass extractor: {single_pass_rate:.1f} pages/sec")
+    logger.info(f"speedup: {single_pass_rate / xpath_rate:.2f}x")
+
+
+if __name__ == "__main__":
+    typer.run(main)
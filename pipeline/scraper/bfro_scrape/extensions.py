@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# Extensions for the crawl.
+#
+# See documentation in:
+# http://doc.scrapy.org/en/latest/topics/extensions.html
+
+import json
+import os
+import resource
+import time
+from datetime import datetime
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http.request import NO_CALLBACK
+from scrapy.utils.job import job_dir
+from scrapy.utils.request import request_from_dict
+
+
+def _peak_rss_bytes():
+    # The crawl is its own process, so the process peak is the stage peak.
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class CrawlStateExtension(object):
+    # With JOBDIR set, scrapy keeps the scheduler queue and the dupefilter
+    # there, so a crawl that's stopped resumes from where it was when run
+    # again. What it doesn't keep are the requests that were being
+    # downloaded when it stopped, or that failed for good (a network error,
+    # or a retryable status after all the retries): they're in the
+    # dupefilter, so they'd never be fetched again. These are kept in
+    # spider.state (which scrapy also saves in JOBDIR) from when they reach
+    # the downloader until a usable response comes back or they're queued
+    # for a retry, and scheduled again when the crawl resumes. One that's
+    # still failing after max_resumes resumes is given up on.
+
+    def __init__(self, crawler, max_resumes, retry_codes):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_resumes = max_resumes
+        self.retry_codes = set(retry_codes)
+        self.unfinished = {}
+        self.resumes = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not job_dir(crawler.settings):
+            raise NotConfigured
+        ext = cls(
+            crawler,
+            crawler.settings.getint("CRAWL_STATE_MAX_RESUMES", 3),
+            [
+                int(code)
+                for code in crawler.settings.getlist("RETRY_HTTP_CODES")
+            ],
+        )
+        crawler.signals.connect(
+            ext.spider_opened, signal=signals.spider_opened
+        )
+        crawler.signals.connect(
+            ext.request_scheduled, signal=signals.request_scheduled
+        )
+        crawler.signals.connect(
+            ext.request_reached_downloader,
+            signal=signals.request_reached_downloader,
+        )
+        crawler.signals.connect(
+            ext.response_received, signal=signals.response_received
+        )
+        crawler.signals.connect(
+            ext.spider_closed, signal=signals.spider_closed
+        )
+        return ext
+
+    def _fingerprint(self, request):
+        return self.crawler.request_fingerprinter.fingerprint(request).hex()
+
+    def spider_opened(self, spider):
+        # Scrapy's SpiderState extension has loaded spider.state by now.
+        self.unfinished = spider.state.setdefault("unfinished_requests", {})
+        self.resumes = spider.state.setdefault("request_resumes", {})
+        for fingerprint in list(self.unfinished):
+            self.resumes[fingerprint] = self.resumes.get(fingerprint, 0) + 1
+            if self.resumes[fingerprint] > self.max_resumes:
+                request = self.unfinished.pop(fingerprint)
+                del self.resumes[fingerprint]
+                spider.logger.warning(
+                    f"Giving up on {request['url']} after "
+                    f"{self.max_resumes} resumes."
+                )
+                self.stats.inc_value("crawl_state/abandoned")
+        if self.unfinished:
+            spider.logger.info(
+                f"Resuming crawl, fetching {len(self.unfinished)} "
+                "unfinished requests again."
+            )
+        self.stats.set_value("crawl_state/resumed", len(self.unfinished))
+        for request in list(self.unfinished.values()):
+            request = request_from_dict(request, spider=spider)
+            self.crawler.engine.crawl(request.replace(dont_filter=True))
+
+    def request_scheduled(self, request, spider):
+        # Retries (and the requests scheduled above) skip the dupefilter,
+        # and once they're queued the scheduler keeps them.
+        if request.dont_filter:
+            self.unfinished.pop(self._fingerprint(request), None)
+
+    def request_reached_downloader(self, request, spider):
+        # The requests scrapy makes itself (robots.txt) are left to it.
+        if request.callback is NO_CALLBACK:
+            return
+        self.unfinished[self._fingerprint(request)] = request.to_dict(
+            spider=spider
+        )
+
+    def response_received(self, response, request, spider):
+        if response.status not in self.retry_codes:
+            fingerprint = self._fingerprint(request)
+            self.unfinished.pop(fingerprint, None)
+            self.resumes.pop(fingerprint, None)
+
+    def spider_closed(self, spider, reason):
+        # Before RunReportExtension, so the count is in the run report.
+        self.stats.set_value("crawl_state/unfinished", len(self.unfinished))
+
+
+class RunReportExtension(object):
+    # Writes the crawl's timings and counters to RUN_REPORT_FILE as a run
+    # report with a single crawl_reports stage, in the same format as
+    # pipeline/scripts/run_report.py so the orchestrator can fold it into
+    # its own report. Responses are the rows in and scraped reports the
+    # rows out. Index pages that came back unchanged from the conditional
+    # GET cache are the cache hits.
+
+    def __init__(self, report_file, stats):
+        self.report_file = Path(report_file)
+        self.stats = stats
+        self.started = None
+        self.wall_start = None
+        self.cpu_start = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        report_file = crawler.settings.get("RUN_REPORT_FILE")
+        if not report_file:
+            raise NotConfigured
+        ext = cls(report_file, crawler.stats)
+        crawler.signals.connect(
+            ext.spider_opened, signal=signals.spider_opened
+        )
+        crawler.signals.connect(
+            ext.spider_closed, signal=signals.spider_closed
+        )
+        return ext
+
+    def spider_opened(self, spider):
+        self.started = datetime.now()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def spider_closed(self, spider, reason):
+        stat = self.stats.get_value
+        cache_hits = stat("conditional_get/not_modified", 0) + stat(
+            "conditional_get/same_hash", 0
+        )
+        cache_misses = stat("conditional_get/changed", 0)
+        lookups = cache_hits + cache_misses
+        stage = {
+            "name": "crawl_reports",
+            "wall_seconds": round(time.perf_counter() - self.wall_start, 3),
+            "cpu_seconds": round(time.process_time() - self.cpu_start, 3),
+            "peak_rss_bytes": _peak_rss_bytes(),
+            "rows_in": stat("response_received_count", 0),
+            "rows_out": stat("item_scraped_count", 0),
+            "bytes_read": stat("downloader/response_bytes", 0),
+            "bytes_written": 0,
+            "api_calls": stat("downloader/request_count", 0),
+            "cache_hits": cache_hits,
+            "cache_misses": cache_misses,
+            "cache_hit_rate": (
+                round(cache_hits / lookups, 4) if lookups else None
+            ),
+            "details": {
+                "finish_reason": reason,
+                **{
+                    key: value
+                    for key, value in self.stats.get_stats().items()
+                    if isinstance(value, (int, float, str))
+                },
+            },
+        }
+        parquet_file = spider.settings.get("REPORT_PARQUET_FILE")
+        if parquet_file and Path(parquet_file).exists():
+            stage["bytes_written"] = Path(parquet_file).stat().st_size
+        self.report_file.parent.mkdir(parents=True, exist_ok=True)
+        self.report_file.write_text(
+            json.dumps(
+                {
+                    "name": spider.name,
+                    "started": self.started.isoformat(timespec="seconds"),
+                    "pid": os.getpid(),
+                    "stages": [stage],
+                },
+                indent=2,
+            )
+        )
+        spider.logger.info(f"Wrote run report to {self.report_file}.")
@@ -5,7 +5,13 @@
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+import hashlib
+import json
+from pathlib import Path
+
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
 
 
 class BfroScrapeSpiderMiddleware(object):
@@ -54,3 +60,118 @@ class BfroScrapeSpiderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class ConditionalGetCacheMiddleware(object):
+    # Downloader middleware that makes conditional GETs for the index pages
+    # (requests with meta["conditional_get"] set). The ETag / Last-Modified
+    # validators and a hash of the body are kept per URL on disk, and when a
+    # page comes back unchanged - either as a 304 or with the same body
+    # hash - the response is flagged with meta["page_unchanged"] so the
+    # spider can skip following its links. 304s are filled in with the last
+    # body we saw so the callbacks can still parse them.
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_file = self.cache_dir / "index.json"
+        self.index = (
+            json.loads(self.index_file.read_text())
+            if self.index_file.exists()
+            else {}
+        )
+        # Validators are only committed when the crawl finishes cleanly.
+        # Otherwise a crawl that dies after a county page but before its
+        # reports would mark the county as done on the next run.
+        self.pending = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("CONDITIONAL_GET_CACHE_ENABLED"):
+            raise NotConfigured
+        m = cls(crawler.settings.get("CONDITIONAL_GET_CACHE_DIR"))
+        crawler.signals.connect(m.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(m.spider_closed, signal=signals.spider_closed)
+        return m
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _header(response, name):
+        value = response.headers.get(name)
+        return value.decode("latin-1") if value else None
+
+    def process_request(self, request, spider):
+        if not request.meta.get("conditional_get"):
+            return None
+        entry = self.index.get(request.url)
+        if entry is None:
+            return None
+        if entry.get("etag"):
+            request.headers.setdefault("If-None-Match", entry["etag"])
+        if entry.get("last_modified"):
+            request.headers.setdefault(
+                "If-Modified-Since", entry["last_modified"]
+            )
+        return None
+
+    def process_response(self, request, response, spider):
+        if not request.meta.get("conditional_get"):
+            return response
+        entry = self.index.get(request.url)
+        body_file = self.cache_dir / f"{self._key(request.url)}.html"
+
+        if response.status == 304 and entry and body_file.exists():
+            request.meta["page_unchanged"] = True
+            spider.crawler.stats.inc_value("conditional_get/not_modified")
+            # 304s don't carry a content type, so rebuild it as HTML.
+            headers = response.headers.copy()
+            if entry.get("content_type"):
+                headers["Content-Type"] = entry["content_type"]
+            return HtmlResponse(
+                url=response.url,
+                status=200,
+                headers=headers,
+                body=body_file.read_bytes(),
+                request=request,
+            )
+        if response.status != 200:
+            return response
+
+        body_hash = hashlib.sha256(response.body).hexdigest()
+        if entry and entry.get("body_hash") == body_hash:
+            request.meta["page_unchanged"] = True
+            spider.crawler.stats.inc_value("conditional_get/same_hash")
+        else:
+            spider.crawler.stats.inc_value("conditional_get/changed")
+            body_file.write_bytes(response.body)
+        self.pending[request.url] = {
+            "etag": self._header(response, "ETag"),
+            "last_modified": self._header(response, "Last-Modified"),
+            "content_type": self._header(response, "Content-Type"),
+            "body_hash": body_hash,
+        }
+        return response
+
+    def spider_opened(self, spider):
+        # In a resumable crawl (JOBDIR set) the validators waiting on the
+        # crawl to finish are kept with the rest of its state, so the pages
+        # fetched before it was stopped still get theirs saved.
+        if hasattr(spider, "state"):
+            self.pending = spider.state.setdefault(
+                "conditional_get_pending", {}
+            )
+
+    def spider_closed(self, spider, reason):
+        if reason != "finished":
+            spider.logger.info(
+                f"Crawl ended with {reason}, not saving conditional GET cache."
+            )
+            return
+        self.index.update(self.pending)
+        self.index_file.write_text(json.dumps(self.index))
+        spider.logger.info(
+            f"Saved {len(self.index)} entries to {self.index_file}."
+        )
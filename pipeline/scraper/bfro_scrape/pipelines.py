@@ -5,7 +5,172 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
+import json
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.utils.job import job_dir
+
+# The report columns are defined once, with the pipeline scripts.
+SCRIPTS_DIR = Path(__file__).resolve().parents[2] / "scripts"
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.append(str(SCRIPTS_DIR))
+from report_schema import REPORT_SCHEMA  # noqa: E402
+
+
+class ReportParquetPipeline(object):
+    # Validates the scraped reports against REPORT_SCHEMA and streams them
+    # into a typed parquet file, writing a row group every batch_size items
+    # so memory stays flat regardless of the crawl size. The file is written
+    # to a temporary path and moved into place when the spider closes.
+    #
+    # In a resumable crawl (JOBDIR set) each batch is its own file in
+    # JOBDIR/reports instead, so the reports scraped before a crawl was
+    # stopped are still there when it resumes. The output file is put
+    # together from all of them when the spider closes. Their requests are
+    # already in the dupefilter, so the reports in the batch being filled
+    # are also appended to JOBDIR/reports/pending.jsonl as they come in,
+    # which survives the crawl being killed before it could write the batch
+    # (a docker stop that runs out of time, say).
+
+    def __init__(self, parquet_file, batch_size=500, parts_dir=None):
+        self.parquet_file = Path(parquet_file)
+        self.batch_size = batch_size
+        self.parts_dir = Path(parts_dir) if parts_dir else None
+        self.rows = []
+        self.writer = None
+        self.pending = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        parquet_file = crawler.settings.get("REPORT_PARQUET_FILE")
+        if not parquet_file:
+            raise NotConfigured
+        jobdir = job_dir(crawler.settings)
+        return cls(
+            parquet_file,
+            crawler.settings.getint("REPORT_PARQUET_BATCH_SIZE", 500),
+            Path(jobdir) / "reports" if jobdir else None,
+        )
+
+    @property
+    def tmp_file(self):
+        return self.parquet_file.with_name(self.parquet_file.name + ".tmp")
+
+    @property
+    def pending_file(self):
+        return self.parts_dir / "pending.jsonl"
+
+    def open_spider(self, spider):
+        if self.parts_dir:
+            self.parts_dir.mkdir(parents=True, exist_ok=True)
+            parts = len(list(self.parts_dir.glob("*.parquet")))
+            if parts:
+                spider.logger.info(
+                    f"Resuming with {parts} batches of reports already "
+                    "scraped."
+                )
+            self.rows = self._read_pending(spider)
+            self.pending = open(self.pending_file, "a")
+            return
+        # Opened up front so an empty crawl still leaves a (typed) file for
+        # the combine step to read.
+        self.writer = pq.ParquetWriter(
+            self.tmp_file, REPORT_SCHEMA, compression="zstd"
+        )
 
-class BfroScrapePipeline(object):
     def process_item(self, item, spider):
+        unknown_fields = set(item.keys()) - set(REPORT_SCHEMA.names)
+        if unknown_fields:
+            spider.logger.warning(
+                f"Dropping unknown fields {sorted(unknown_fields)} from "
+                f"report {item.get('report_number')}."
+            )
+        try:
+            report_number = int(item["report_number"])
+        except (KeyError, TypeError, ValueError):
+            raise DropItem(
+                f"Invalid report_number {item.get('report_number')!r}."
+            )
+        row = {name: item.get(name) for name in REPORT_SCHEMA.names}
+        row["report_number"] = report_number
+        row["pulled_datetime"] = datetime.fromisoformat(
+            item["pulled_datetime"]
+        )
+        self.rows.append(row)
+        if self.pending:
+            self.pending.write(
+                json.dumps({**row, "pulled_datetime": item["pulled_datetime"]})
+                + "\n"
+            )
+            self.pending.flush()
+        if len(self.rows) >= self.batch_size:
+            self.flush()
         return item
+
+    def flush(self):
+        if not self.rows:
+            return
+        batch = pa.Table.from_pylist(self.rows, schema=REPORT_SCHEMA)
+        if self.parts_dir:
+            # Numbered on from the parts already there, and renamed into
+            # place so a crawl killed mid-write never leaves half a file.
+            part = len(list(self.parts_dir.glob("*.parquet")))
+            part_file = self.parts_dir / f"part-{part:05d}.parquet"
+            tmp_part_file = part_file.with_name(part_file.name + ".tmp")
+            pq.write_table(batch, tmp_part_file, compression="zstd")
+            tmp_part_file.replace(part_file)
+            self.pending.truncate(0)
+        else:
+            self.writer.write_table(batch)
+        self.rows = []
+
+    def _read_pending(self, spider):
+        # The rows of a batch that was never written. A crawl killed mid
+        # write can leave the last line cut off. Its report is lost, and the
+        # file is rewritten without it so the next line isn't appended to
+        # it.
+        if not self.pending_file.exists():
+            return []
+        rows = []
+        lines = []
+        with open(self.pending_file) as pending:
+            for line in pending:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    spider.logger.warning(
+                        "Skipping a partly written pending report."
+                    )
+                    continue
+                row["pulled_datetime"] = datetime.fromisoformat(
+                    row["pulled_datetime"]
+                )
+                rows.append(row)
+                lines.append(line)
+        self.pending_file.write_text(
+            "".join(line.rstrip("\n") + "\n" for line in lines)
+        )
+        if rows:
+            spider.logger.info(
+                f"Resuming with {len(rows)} reports that weren't in a batch."
+            )
+        return rows
+
+    def close_spider(self, spider):
+        self.flush()
+        if self.parts_dir:
+            self.pending.close()
+            self.pending_file.unlink()
+            self.writer = pq.ParquetWriter(
+                self.tmp_file, REPORT_SCHEMA, compression="zstd"
+            )
+            for part_file in sorted(self.parts_dir.glob("*.parquet")):
+                self.writer.write_table(pq.read_table(part_file))
+        self.writer.close()
+        self.tmp_file.replace(self.parquet_file)
+        spider.logger.info(f"Wrote reports to {self.parquet_file}.")
@@ -0,0 +1,77 @@
+from typing import Dict, List, Optional
+
+from scrapy.http import TextResponse
+
+
+def _text_nodes(element) -> List[str]:
+    # Equivalent to XPath's element/text(): the element's leading text plus
+    # the tail of each child (including comments).
+    nodes = [element.text] if element.text is not None else []
+    nodes.extend(c.tail for c in element if c.tail is not None)
+    return nodes
+
+
+def extract_report_fields(response: TextResponse) -> Dict[str, Optional[str]]:
+    # Pulls the report number, classification, and every "span.field" value
+    # out of a report page.
+    #
+    # The fields are laid out as <p><span class="field">KEY:</span> value</p>
+    # with some values hiding in <a> tags instead. Rather than running an
+    # XPath over the whole document for each key, this walks the field
+    # paragraphs once and then matches keys against them, keeping the exact
+    # matching behavior of the original XPath queries, i.e.
+    # //p[span[@class='field' and contains(text(), 'KEY')]]/text().
+    report_number = response.css("span.reportheader::text").re(
+        r"Report # (\d+)"
+    )
+    report_class = response.css("span.reportclassification::text").re(
+        r"\((.*)\)"
+    )
+
+    raw_keys: List[str] = []
+    # For each field paragraph: the first text node of each of its field
+    # spans (what contains(text(), ...) compares against), its own text, and
+    # the text of its anchors.
+    paragraphs = []
+    for p in response.selector.root.iter("p"):
+        spans = [c for c in p if c.tag == "span" and c.get("class") == "field"]
+        if not spans:
+            continue
+        span_texts = []
+        for span in spans:
+            span_nodes = _text_nodes(span)
+            raw_keys.extend(span_nodes)
+            span_texts.append(span_nodes[0] if span_nodes else "")
+        anchor_text = [t for a in p if a.tag == "a" for t in _text_nodes(a)]
+        paragraphs.append((span_texts, _text_nodes(p), anchor_text))
+
+    def matching(key: str):
+        return [
+            paragraph
+            for paragraph in paragraphs
+            if any(key in span_text for span_text in paragraph[0])
+        ]
+
+    keys = [k.replace(":", "").replace(" ", "_") for k in raw_keys]
+    # The " ".join( ... ) is because some values are split over multiple text
+    # nodes thanks to <BR> tags.
+    values = [
+        " ".join(s.strip() for _, text, _ in matching(raw_key) for s in text)
+        for raw_key in raw_keys
+    ]
+
+    data: Dict[str, Optional[str]] = dict(zip(keys, values))
+
+    data["REPORT_NUMBER"] = (
+        report_number[0] if len(report_number) > 0 else None
+    )
+    data["REPORT_CLASS"] = report_class[0] if len(report_class) > 0 else None
+
+    # The empty keys have their text hiding out in some 'a' tags. Note these
+    # are matched on the cleaned key, not the raw one.
+    empty_keys = [k for k in keys if len(data[k]) == 0]
+    for k in empty_keys:
+        anchor_text = [t for _, _, a in matching(k) for t in a]
+        data[k] = anchor_text[0] if anchor_text else None
+
+    return data
@@ -52,21 +52,42 @@ DOWNLOAD_DELAY = 0.25
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    'bfro_scrape.middlewares.MyCustomDownloaderMiddleware': 543,
-# }
+# Sits below HttpCompressionMiddleware so it sees decompressed bodies.
+DOWNLOADER_MIDDLEWARES = {
+    "bfro_scrape.middlewares.ConditionalGetCacheMiddleware": 585,
+}
+
+# Conditional GETs for the GDB index, state, and county pages. Unchanged
+# county pages don't have their reports re-followed.
+CONDITIONAL_GET_CACHE_ENABLED = False
+CONDITIONAL_GET_CACHE_DIR = "../../data/raw/reports/index_cache"
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-# }
+EXTENSIONS = {
+    "bfro_scrape.extensions.CrawlStateExtension": 400,
+    "bfro_scrape.extensions.RunReportExtension": 500,
+}
+
+# Writes a run report (same format as pipeline/scripts/run_report.py) with
+# the crawl's timings and counters when set.
+RUN_REPORT_FILE = None
+
+# Resumable crawls: set JOBDIR and a stopped crawl (Ctrl-C, SIGTERM) picks
+# up where it left off when it's run again with the same JOBDIR. Requests
+# that were in flight or failed are fetched again, up to this many resumes.
+CRAWL_STATE_MAX_RESUMES = 3
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
-# ITEM_PIPELINES = {
-#    'bfro_scrape.pipelines.BfroScrapePipeline': 300,
-# }
+# The parquet pipeline only runs when REPORT_PARQUET_FILE is set.
+ITEM_PIPELINES = {
+    "bfro_scrape.pipelines.ReportParquetPipeline": 300,
+}
+
+# Typed parquet output for the scraped reports, written a row group at a time.
+REPORT_PARQUET_FILE = None
+REPORT_PARQUET_BATCH_SIZE = 500
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -1,5 +1,66 @@
 import scrapy
-from datetime import datetime
+import csv
+import pyarrow.parquet as pq
+import re
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, Set, Tuple
+
+from bfro_scrape.report_fields import extract_report_fields
+
+# The report pages are linked as show_report.asp?id=<report number>.
+REPORT_ID_REGEX = re.compile(r"[?&]id=(\d+)")
+
+
+def extract_report_id(url: str) -> Optional[int]:
+    match = REPORT_ID_REGEX.search(url)
+    return int(match.group(1)) if match else None
+
+
+def load_known_reports(
+    reports_file: Path, refresh_days: int = 0
+) -> Tuple[Set[int], Set[int]]:
+    # Returns the known reports, and the reports to refresh. Reports pulled
+    # within the last refresh_days are left out of the known set and put in
+    # the refresh set so they get re-checked - recently posted reports are
+    # the ones most likely to be edited after the fact.
+    if not reports_file.exists():
+        return set(), set()
+    refresh_cutoff = datetime.today() - timedelta(days=refresh_days)
+    known_reports = set()
+    refresh_reports = set()
+    for report_number, pulled_datetime in _read_report_keys(reports_file):
+        if not report_number:
+            continue
+        if refresh_days > 0 and pulled_datetime:
+            if isinstance(pulled_datetime, str):
+                pulled_datetime = datetime.fromisoformat(pulled_datetime)
+            if pulled_datetime >= refresh_cutoff:
+                refresh_reports.add(int(report_number))
+                continue
+        known_reports.add(int(report_number))
+    # A report pulled more than once is refreshed if its latest pull is.
+    return known_reports - refresh_reports, refresh_reports
+
+
+def _read_report_keys(reports_file: Path):
+    # Yields (report_number, pulled_datetime) from the reports csv or parquet
+    # file without holding the narrative columns in memory.
+    if reports_file.suffix == ".parquet":
+        keys = pq.read_table(
+            reports_file, columns=["report_number", "pulled_datetime"]
+        )
+        yield from zip(
+            keys.column("report_number").to_pylist(),
+            keys.column("pulled_datetime").to_pylist(),
+        )
+        return
+    # The narrative fields can be very long.
+    csv.field_size_limit(sys.maxsize)
+    with open(reports_file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            yield row.get("report_number"), row.get("pulled_datetime")
 
 
 class BfroReportSpider(scrapy.Spider):
@@ -7,6 +68,26 @@ class BfroReportSpider(scrapy.Spider):
 
     start_urls = ["http://www.bfro.net/GDB/"]
 
+    # Spider arguments (-a key=value), which scrapy passes in as strings.
+    test_run = "false"
+    incremental = "false"
+    reports_file = "../../data/raw/reports/bfro_reports.csv"
+    refresh_days = "0"
+
+    def start_requests(self):
+        self.known_reports: Set[int] = set()
+        self.refresh_reports: Set[int] = set()
+        if self.incremental.lower() == "true":
+            self.known_reports, self.refresh_reports = load_known_reports(
+                Path(self.reports_file), int(self.refresh_days)
+            )
+            self.logger.info(
+                f"Incremental crawl, skipping {len(self.known_reports)} "
+                f"reports already in {self.reports_file} and refreshing "
+                f"{len(self.refresh_reports)}."
+            )
+        yield from super().start_requests()
+
     def parse(self, response):
         # Grab the state report pages from the main GDB page.
         state_pages = response.css("table.countytbl td.cs a")
@@ -14,7 +95,11 @@ class BfroReportSpider(scrapy.Spider):
             state_pages = state_pages[:1]
         for s in state_pages:
             if s is not None:
-                yield response.follow(s, self.parse_state_page)
+                yield response.follow(
+                    s,
+                    self.parse_state_page,
+                    meta={"conditional_get": True},
+                )
 
     def parse_state_page(self, response):
         # This grabs all of the county reports.
@@ -23,71 +108,32 @@ class BfroReportSpider(scrapy.Spider):
             county_pages = county_pages[1:]
         for c in county_pages:
             if c is not None:
-                yield response.follow(c, self.parse_county_page)
+                yield response.follow(
+                    c,
+                    self.parse_county_page,
+                    meta={"conditional_get": True},
+                )
 
     def parse_county_page(self, response):
+        # page_unchanged is set by ConditionalGetCacheMiddleware when the
+        # county listing hasn't changed since the last finished crawl, which
+        # followed all of its new reports. Only the ones due for a refresh
+        # are followed again.
+        page_unchanged = response.meta.get("page_unchanged")
+        if page_unchanged and not self.refresh_reports:
+            self.logger.debug(f"{response.url} unchanged, skipping.")
+            return
         for c in response.css("span.reportcaption a"):
             if c is not None:
+                report_id = extract_report_id(c.attrib.get("href", ""))
+                if report_id in self.known_reports:
+                    continue
+                if page_unchanged and report_id not in self.refresh_reports:
+                    continue
                 yield response.follow(c, self.parse_report)
 
     def parse_report(self, response):
-        # Get the report number.
-        report_number = response.css("span.reportheader::text").re(
-            r"Report # (\d+)"
-        )
-        # Get the report classification.
-        report_class = response.css("span.reportclassification::text").re(
-            r"\((.*)\)"
-        )
-
-        # Now we need to get each field. For that we're going to use
-        # XPath selectors.
-        raw_keys = response.xpath("//p/span[@class='field']/text()").extract()
-        keys = [k.replace(":", "").replace(" ", "_") for k in raw_keys]
-
-        # Now if scrapy had XPath 2.0 this would be pretty simple.
-        # Unfortunately it doesn't so we need to use a mixture of Python and
-        # XPath. This XPath query grabs all "p" elements containing a
-        # 'span.field' with text matching the key.
-        value_query = (
-            "//p[span[@class = 'field' and contains(text(), '{}')]]/text()"
-        )
-
-        # This is almost right: we need to grab text out of a couple of 'a'
-        # tags. The " ".join( ... ) business is because some of the value
-        # queries return multiple nodes thanks to some <BR> tags. This query
-        # joins all of the text matching each field key into a single string.
-        values = [
-            " ".join(
-                [
-                    s.strip()
-                    for s in response.xpath(value_query.format(k)).extract()
-                ]
-            )
-            for k in raw_keys
-        ]
-
-        data = dict(zip(keys, values))
-
-        # Add the report number and class.
-        data["REPORT_NUMBER"] = (
-            report_number[0] if len(report_number) > 0 else None
-        )
-        data["REPORT_CLASS"] = (
-            report_class[0] if len(report_class) > 0 else None
-        )
-
-        # The empty keys have their text hiding out in some 'a' tags. This
-        # fetches them.
-        empty_keys = [k for k in keys if len(data[k]) == 0]
-
-        for k in empty_keys:
-            data[k] = response.xpath(
-                (
-                    "//p[span[@class='field' and "
-                    "contains(text(), '{}')]]/a/text()"
-                ).format(k)
-            ).extract_first()
+        data = extract_report_fields(response)
 
         # If everything is None, we don't want to write the values out,
         # it just means a bad scrape.
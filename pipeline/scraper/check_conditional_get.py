@@ -0,0 +1,199 @@
+import json
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import scrapy
+import typer
+from loguru import logger
+from scrapy.crawler import CrawlerRunner
+from scrapy.exceptions import CloseSpider
+from scrapy.utils.project import get_project_settings
+from twisted.internet import defer, reactor
+
+# Checks ConditionalGetCacheMiddleware end to end: real crawls through the
+# project's settings against a local stand-in for the GDB index pages. Run
+# from pipeline/scraper:
+#   python check_conditional_get.py
+
+
+class StandInServer(ThreadingHTTPServer):
+    # Serves pages[path] = (body, etag). A page with an etag sends it and
+    # answers a matching If-None-Match with a 304, one without sends no
+    # validators at all, so it can only be caught by its body hash.
+
+    def __init__(self, port: int):
+        super().__init__(("127.0.0.1", port), StandInHandler)
+        self.pages: Dict[str, Any] = {}
+        self.requests: List[Dict[str, Optional[str]]] = []
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body, etag = self.server.pages[self.path]
+        self.server.requests.append(
+            {
+                "path": self.path,
+                "if_none_match": self.headers.get("If-None-Match"),
+            }
+        )
+        if etag and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class IndexPageSpider(scrapy.Spider):
+    # Fetches the index pages the way the report spider does, recording
+    # whether each came back unchanged. With close_reason set the crawl
+    # stops early (after the first page) with that reason.
+    name = "conditional_get_check"
+    urls: List[str] = []
+    close_reason: Optional[str] = None
+
+    def start_requests(self):
+        self.pages = {}
+        for url in self.urls:
+            yield scrapy.Request(
+                url, self.parse, meta={"conditional_get": True}
+            )
+
+    def parse(self, response):
+        self.pages[response.url] = {
+            "unchanged": bool(response.meta.get("page_unchanged")),
+            "body": response.text,
+        }
+        if self.close_reason:
+            raise CloseSpider(self.close_reason)
+
+
+def _check(condition: bool, message: str):
+    if not condition:
+        raise ValueError(message)
+
+
+def main(port: int = 8799):
+    server = StandInServer(port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    etag_url = f"http://127.0.0.1:{port}/etag"
+    hash_url = f"http://127.0.0.1:{port}/hash"
+    server.pages["/etag"] = (b"<html>etag v1</html>", '"v1"')
+    server.pages["/hash"] = (b"<html>hash v1</html>", None)
+    cache_dir = Path(tempfile.mkdtemp()) / "index_cache"
+    index_file = cache_dir / "index.json"
+
+    settings = get_project_settings()
+    settings.setdict(
+        {
+            "CONDITIONAL_GET_CACHE_ENABLED": True,
+            "CONDITIONAL_GET_CACHE_DIR": str(cache_dir),
+            "ROBOTSTXT_OBEY": False,
+            "DOWNLOAD_DELAY": 0,
+            "CONCURRENT_REQUESTS": 1,
+            "LOG_LEVEL": "WARNING",
+        },
+        priority="cmdline",
+    )
+    runner = CrawlerRunner(settings)
+    results = []
+
+    @defer.inlineCallbacks
+    def crawl(urls: List[str], close_reason: Optional[str] = None):
+        crawler = runner.create_crawler(IndexPageSpider)
+        yield runner.crawl(crawler, urls=urls, close_reason=close_reason)
+        results.append((crawler.spider.pages, crawler.stats.get_stats()))
+
+    @defer.inlineCallbacks
+    def crawls():
+        try:
+            # 1. Nothing cached: both pages are new, and the validators are
+            # saved when the crawl finishes.
+            yield crawl([etag_url, hash_url])
+            # 2. Nothing changed: the ETag page comes back as a 304 and the
+            # other with the same body.
+            yield crawl([etag_url, hash_url])
+            # 3. Both change, but the crawl doesn't finish.
+            server.pages["/etag"] = (b"<html>etag v2</html>", '"v2"')
+            server.pages["/hash"] = (b"<html>hash v2</html>", None)
+            yield crawl([etag_url], close_reason="cancelled")
+            # 4. So the next crawl still sees them as changed.
+            yield crawl([etag_url, hash_url])
+        finally:
+            reactor.stop()
+
+    crawls()
+    reactor.run()
+    server.shutdown()
+    _check(len(results) == 4, f"Only {len(results)} of 4 crawls ran.")
+    first, second, cancelled, last = results
+
+    logger.info("Checking the first crawl.")
+    pages, stats = first
+    _check(
+        not any(page["unchanged"] for page in pages.values()),
+        "Pages flagged unchanged with nothing cached.",
+    )
+    _check(
+        stats.get("conditional_get/changed") == 2,
+        "The first crawl didn't count both pages as changed.",
+    )
+
+    logger.info("Checking the 304 and same hash paths.")
+    pages, stats = second
+    etag_request = [r for r in server.requests if r["path"] == "/etag"][1]
+    _check(
+        etag_request["if_none_match"] == '"v1"',
+        "The saved ETag wasn't sent back.",
+    )
+    _check(
+        stats.get("conditional_get/not_modified") == 1,
+        "The ETag page wasn't a 304.",
+    )
+    _check(
+        pages[etag_url]["unchanged"] and "etag v1" in pages[etag_url]["body"],
+        "The 304 wasn't flagged unchanged with the cached body filled in.",
+    )
+    _check(
+        stats.get("conditional_get/same_hash") == 1
+        and pages[hash_url]["unchanged"],
+        "The same body wasn't flagged unchanged.",
+    )
+
+    logger.info("Checking validators are only saved by finished crawls.")
+    _, stats = cancelled
+    _check(
+        stats.get("finish_reason") == "cancelled",
+        "The cancelled crawl finished.",
+    )
+    pages, stats = last
+    etag_request = [r for r in server.requests if r["path"] == "/etag"][3]
+    _check(
+        etag_request["if_none_match"] == '"v1"',
+        "The cancelled crawl saved its validators.",
+    )
+    _check(
+        not any(page["unchanged"] for page in pages.values())
+        and stats.get("conditional_get/changed") == 2,
+        "Pages changed since the last finished crawl were flagged unchanged.",
+    )
+    index = json.loads(index_file.read_text())
+    _check(
+        index[etag_url]["etag"] == '"v2"',
+        "The finished crawl didn't save its validators.",
+    )
+    logger.info("All conditional GET checks passed.")
+
+
+if __name__ == "__main__":
+    typer.run(main)
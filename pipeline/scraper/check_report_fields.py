@@ -0,0 +1,45 @@
+from pathlib import Path
+
+import typer
+from loguru import logger
+
+from bench_parse_report import load_fixtures, extract_report_fields_xpath
+from bfro_scrape.report_fields import extract_report_fields
+
+# Checks the single pass extract_report_fields against the original XPath
+# extractor on the saved report pages in fixtures/report_pages, which cover
+# missing fields, values in anchors and nested spans, repeated and
+# overlapping labels, and a page with no header at all. Run from
+# pipeline/scraper:
+#   python check_report_fields.py
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "report_pages"
+
+
+def main(fixtures_dir: Path = FIXTURES_DIR):
+    responses = load_fixtures(fixtures_dir)
+    if not responses:
+        raise ValueError(f"No .html fixtures found in {fixtures_dir}.")
+
+    disagreements = []
+    for response in responses:
+        expected = extract_report_fields_xpath(response)
+        actual = extract_report_fields(response)
+        fields = sorted(
+            k
+            for k in expected.keys() | actual.keys()
+            if expected.get(k, "<missing>") != actual.get(k, "<missing>")
+        )
+        if fields:
+            disagreements.append(f"{response.url}: {', '.join(fields)}")
+        else:
+            logger.info(f"{response.url}: {len(expected)} fields agree.")
+    if disagreements:
+        raise ValueError(
+            "Extractors disagree on " + "; ".join(disagreements) + "."
+        )
+    logger.info(f"Extractors agree on all {len(responses)} report pages.")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,242 @@
+import json
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import h3
+import polars as pl
+import typer
+from loguru import logger
+
+from pull_weather import (
+    RETRY_BASE_DAYS,
+    open_weather_cache,
+    pull_weather_with_cache,
+)
+
+# Checks the weather pull end to end against a local stand-in for Visual
+# Crossing: the concurrent, rate limited fetch, the retries, splitting date
+# range responses, failed keys' next_pull_date, and the ledger of billed
+# days. Run from pipeline/scripts:
+#   python check_pull_weather.py
+
+
+class StandInServer(ThreadingHTTPServer):
+    # Serves timeline requests like Visual Crossing, one entry in days for
+    # each day in the requested range. behaviors[hexid] picks what a hex's
+    # requests get: "ok", "429 once" (a 429 on the first request, then the
+    # weather), "400" (always), or "503" (always). Retry-After is 0 so the
+    # retries don't slow the check down.
+
+    def __init__(self, port: int):
+        super().__init__(("127.0.0.1", port), StandInHandler)
+        self.behaviors: Dict[str, str] = {}
+        self.requests: List[Tuple[float, str]] = []
+        self.hits: Counter = Counter()
+        self.hex_hits: Counter = Counter()
+        self.lock = threading.Lock()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        # /timeline/latitude,longitude/start[/end]
+        _, location, *dates = path.strip("/").split("/")
+        latitude, longitude = (float(x) for x in location.split(","))
+        hexid = h3.geo_to_h3(latitude, longitude, 10)
+        behavior = self.server.behaviors[hexid]
+        with self.server.lock:
+            self.server.requests.append((time.monotonic(), path))
+            self.server.hits[path] += 1
+            self.server.hex_hits[hexid] += 1
+            hits = self.server.hits[path]
+        if behavior in ("400", "503") or (
+            behavior == "429 once" and hits == 1
+        ):
+            self.send_response(int(behavior[:3]))
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        start = date.fromisoformat(dates[0][:10])
+        end = date.fromisoformat(dates[-1][:10])
+        days = [
+            {
+                "datetime": (start + timedelta(days=i)).isoformat(),
+                "tempmax": 70.0 + i,
+                "tempmin": 50.0,
+                "preciptype": ["rain"],
+                "description": "Clear.",
+            }
+            for i in range((end - start).days + 1)
+        ]
+        body = json.dumps({"queryCost": len(days), "days": days}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _check(condition: bool, message: str):
+    if not condition:
+        raise ValueError(message)
+
+
+def _geocoded_reports(keys: List[Tuple[str, str, str]]) -> pl.DataFrame:
+    # (hexid, date, classification) keys as extract_locations_from_kml.py
+    # writes them.
+    rows = []
+    for number, (hexid, day, classification) in enumerate(keys, start=1):
+        latitude, longitude = h3.h3_to_geo(hexid)
+        rows.append(
+            {
+                "number": number,
+                "title": f"Report {number}",
+                "classification": classification,
+                "timestamp": f"{day}T12:00:00Z",
+                "latitude": latitude,
+                "longitude": longitude,
+                "hexid": hexid,
+                "extraction_date": f"{date.today():%Y-%m-%d}",
+            }
+        )
+    return pl.from_dicts(rows)
+
+
+def main(port: int = 8798):
+    server = StandInServer(port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{port}/timeline"
+    ok, retried, bad, down, late = (
+        h3.geo_to_h3(45.0 + i, -122.0, 10) for i in range(5)
+    )
+    server.behaviors = {
+        ok: "ok",
+        retried: "429 once",
+        bad: "400",
+        down: "503",
+        late: "ok",
+    }
+    # With max_gap_days at 3 the ok hex's dates share one range request,
+    # which is billed for all 5 days in it, not just the 3 with reports.
+    keys = [
+        (ok, "2020-01-01", "Class A"),
+        (ok, "2020-01-02", "Class A"),
+        (ok, "2020-01-05", "Class B"),
+        (retried, "2020-03-01", "Class A"),
+        (bad, "2020-04-01", "Class B"),
+        (down, "2020-05-01", "Class C"),
+    ]
+    work_dir = Path(tempfile.mkdtemp())
+    geocoded_reports_file = work_dir / "geocoded_reports.csv"
+    _geocoded_reports(keys).write_csv(geocoded_reports_file)
+    weather_cache = open_weather_cache(work_dir / "weather_cache.duckdb")
+    requests_per_second = 20.0
+    concurrency = 2
+    pull_kwargs = {
+        "base_url": base_url,
+        "concurrency": concurrency,
+        "requests_per_second": requests_per_second,
+        "max_retries": 2,
+        "max_gap_days": 3,
+    }
+
+    logger.info("Pulling the missing weather.")
+    still_missing = pull_weather_with_cache(
+        weather_cache, geocoded_reports_file, "key", limit=8, **pull_kwargs
+    )
+    rows = {
+        (hexid, timestamp.date().isoformat()): row
+        for hexid, timestamp, *row in weather_cache.execute(
+            """
+            SELECT hexid, timestamp, data, temperature_high, failed_pulls,
+                next_pull_date
+            FROM weather_cache
+            """
+        ).fetchall()
+    }
+    _check(len(rows) == len(keys), f"{len(rows)} of {len(keys)} keys cached.")
+    _check(not still_missing, "Keys were left to pull within the limit.")
+
+    logger.info("Checking the range response was split.")
+    range_paths = [p for p in server.hits if p.endswith("/2020-01-05")]
+    _check(
+        len(range_paths) == 1 and "/2020-01-01/" in range_paths[0],
+        "The ok hex's dates didn't share a range request.",
+    )
+    for day, temperature_high in [
+        ("2020-01-01", 70.0),
+        ("2020-01-02", 71.0),
+        ("2020-01-05", 74.0),
+    ]:
+        data, cached_high, *_ = rows[(ok, day)]
+        _check(
+            json.loads(data)["days"][0]["datetime"] == day
+            and len(json.loads(data)["days"]) == 1
+            and cached_high == temperature_high,
+            f"{day} didn't get its own day of the range response.",
+        )
+
+    logger.info("Checking the retries.")
+    _check(
+        server.hex_hits[retried] == 2 and rows[(retried, "2020-03-01")][0],
+        "The 429 wasn't retried into a successful pull.",
+    )
+    _check(server.hex_hits[bad] == 1, "The 400 was retried.")
+    _check(
+        server.hex_hits[down] == 3, "The 503 wasn't retried max_retries times."
+    )
+
+    logger.info("Checking the failed keys.")
+    for hexid, day in [(bad, "2020-04-01"), (down, "2020-05-01")]:
+        data, _, failed_pulls, next_pull_date = rows[(hexid, day)]
+        _check(
+            data is None
+            and failed_pulls == 1
+            and next_pull_date
+            == date.today() + timedelta(days=RETRY_BASE_DAYS),
+            f"The failed pull of {day} wasn't set to be tried again.",
+        )
+
+    logger.info("Checking the ledger.")
+    ((billed_days,),) = weather_cache.execute(
+        "SELECT calls FROM weather_api_calls WHERE date = ?", [date.today()]
+    ).fetchall()
+    # The range is 5 days, every other request 1, and retries are free.
+    _check(billed_days == 8, f"The ledger has {billed_days} billed days.")
+
+    logger.info("Checking the rate limit.")
+    times = sorted(t for t, _ in server.requests)
+    for i in range(len(times)):
+        for j in range(i + 1, len(times)):
+            allowed = concurrency + requests_per_second * (times[j] - times[i])
+            _check(
+                j - i + 1 <= allowed + 1,
+                f"{j - i + 1} requests in {times[j] - times[i]:.3f}s.",
+            )
+
+    logger.info("Checking a second run the same day spends nothing.")
+    requests_before = len(server.requests)
+    _geocoded_reports(keys + [(late, "2020-06-01", "Class A")]).write_csv(
+        geocoded_reports_file
+    )
+    still_missing = pull_weather_with_cache(
+        weather_cache, geocoded_reports_file, "key", limit=8, **pull_kwargs
+    )
+    _check(
+        still_missing and len(server.requests) == requests_before,
+        "The second run pulled past the day's limit.",
+    )
+    server.shutdown()
+    logger.info("All weather pull checks passed.")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,223 @@
+import hashlib
+import tempfile
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import typer
+from loguru import logger
+
+from run_report import StageMetrics
+from upload_to_gdrive import upload_files_to_gdrive
+
+# Checks upload_files_to_gdrive against a fake Drive service: unchanged files
+# aren't uploaded again, owners who can already see a file aren't shared it
+# again, and each upload thread gets its own service. Run from
+# pipeline/scripts:
+#   python check_upload_to_gdrive.py
+
+
+class FakeRequest:
+    def __init__(self, drive: "FakeDrive", call: str, result: Any):
+        self.drive = drive
+        self.call = call
+        self.result = result
+
+    def execute(self):
+        with self.drive.lock:
+            self.drive.calls[self.call] += 1
+        return self.result() if callable(self.result) else self.result
+
+
+class FakeDrive:
+    # The Drive state shared by every fake service: the files by id, with
+    # their name, parent, md5 and who they're shared with, and a count of
+    # the API calls made, by resource and method.
+
+    def __init__(self):
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.calls: Counter = Counter()
+        self.lock = threading.Lock()
+
+
+class FakeDriveService:
+    # What upload_to_gdrive uses of a Drive v3 service. A service only
+    # serves the thread that built it, like the real client's connection.
+
+    def __init__(self, drive: FakeDrive):
+        self.drive = drive
+        self.thread = threading.get_ident()
+
+    def _request(self, call: str, result: Any) -> FakeRequest:
+        if threading.get_ident() != self.thread:
+            raise RuntimeError("A Drive service was shared between threads.")
+        return FakeRequest(self.drive, call, result)
+
+    def files(self):
+        return FakeFiles(self)
+
+    def permissions(self):
+        return FakePermissions(self)
+
+
+def _md5(media) -> str:
+    return hashlib.md5(media.getbytes(0, media.size())).hexdigest()
+
+
+class FakeFiles:
+    def __init__(self, service: FakeDriveService):
+        self.service = service
+        self.drive = service.drive
+
+    def list(self, q: str, fields: str):
+        name = q.split("'")[1]
+        folder_id = q.split("'")[3]
+        return self.service._request(
+            "files.list",
+            {
+                "files": [
+                    {"id": file_id, "name": name, "md5Checksum": file["md5"]}
+                    for file_id, file in self.drive.files.items()
+                    if file["name"] == name and file["parent"] == folder_id
+                ]
+            },
+        )
+
+    def create(self, body: Dict[str, Any], media_body, fields: str):
+        def create():
+            with self.drive.lock:
+                file_id = f"id{len(self.drive.files)}"
+                self.drive.files[file_id] = {
+                    "name": body["name"],
+                    "parent": body["parents"][0],
+                    "md5": _md5(media_body),
+                    "readers": set(),
+                }
+            return {"id": file_id}
+
+        return self.service._request("files.create", create)
+
+    def update(self, fileId: str, body: Dict[str, Any], media_body):
+        def update():
+            self.drive.files[fileId]["md5"] = _md5(media_body)
+            return {"id": fileId}
+
+        return self.service._request("files.update", update)
+
+
+class FakePermissions:
+    def __init__(self, service: FakeDriveService):
+        self.service = service
+        self.drive = service.drive
+
+    def list(self, fileId: str, fields: str):
+        return self.service._request(
+            "permissions.list",
+            lambda: {
+                "permissions": [
+                    {"emailAddress": email}
+                    for email in self.drive.files[fileId]["readers"]
+                ]
+            },
+        )
+
+    def create(self, fileId: str, body: Dict[str, Any]):
+        def create():
+            self.drive.files[fileId]["readers"].add(body["emailAddress"])
+
+        return self.service._request("permissions.create", create)
+
+
+def _check(condition: bool, message: str):
+    if not condition:
+        raise ValueError(message)
+
+
+def main(num_files: int = 6, concurrency: int = 3):
+    work_dir = Path(tempfile.mkdtemp())
+    files = []
+    for i in range(num_files):
+        file = work_dir / f"report_{i}.csv"
+        file.write_text(f"number,title\n{i},Report {i}\n")
+        files.append(file)
+    drive = FakeDrive()
+    services: List[FakeDriveService] = []
+
+    def build_google_drive_service() -> FakeDriveService:
+        service = FakeDriveService(drive)
+        with drive.lock:
+            services.append(service)
+        return service
+
+    def upload(
+        owner_emails: List[str], metrics: Optional[StageMetrics] = None
+    ) -> Dict[Path, str]:
+        drive.calls.clear()
+        return upload_files_to_gdrive(
+            build_google_drive_service,
+            files,
+            "folder",
+            owner_emails,
+            concurrency=concurrency,
+            metrics=metrics,
+        )
+
+    logger.info("Checking a first upload.")
+    file_ids = upload(["owner@example.com"])
+    _check(
+        len(set(file_ids.values())) == num_files
+        and drive.calls["files.create"] == num_files,
+        "Not every file was created.",
+    )
+    _check(
+        drive.calls["permissions.list"] == 0
+        and drive.calls["permissions.create"] == num_files,
+        "New files weren't shared with the owner exactly once.",
+    )
+    _check(
+        0 < len(services) <= concurrency,
+        f"{len(services)} services built for {concurrency} threads.",
+    )
+
+    logger.info("Checking unchanged files and permissions make no calls.")
+    metrics = StageMetrics("upload_to_gdrive")
+    # Owner emails are matched case insensitively.
+    _check(
+        upload(["Owner@Example.com"], metrics) == file_ids,
+        "Unchanged files got new ids.",
+    )
+    _check(
+        drive.calls
+        == {"files.list": num_files, "permissions.list": num_files},
+        f"Unchanged files made these calls: {dict(drive.calls)}.",
+    )
+    _check(
+        metrics.counters["cache_hits"] == num_files
+        and metrics.counters["api_calls"] == 2 * num_files,
+        "The skipped uploads weren't counted as cache hits.",
+    )
+
+    logger.info("Checking a changed file and a new owner.")
+    files[0].write_text("number,title\n0,Report 0, edited\n")
+    _check(
+        upload(["owner@example.com", "new@example.com"]) == file_ids,
+        "Changed files got new ids.",
+    )
+    _check(
+        drive.calls["files.update"] == 1
+        and drive.calls["files.create"] == 0
+        and drive.calls["permissions.create"] == num_files,
+        f"The changed file and new owner made these calls: "
+        f"{dict(drive.calls)}.",
+    )
+    _check(
+        drive.files[file_ids[files[0]]]["md5"]
+        == hashlib.md5(files[0].read_bytes()).hexdigest(),
+        "The changed file wasn't uploaded.",
+    )
+    logger.info("All Drive upload checks passed.")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -3,12 +3,21 @@ from loguru import logger
 import duckdb
 import polars as pl
 from pathlib import Path
+from typing import Optional, Union
+from storage import copy_to_file
+from run_report import script_report
+from report_schema import GEOCODED_REPORT_COLUMNS, GEOCODED_REPORT_FIELDS
 
 
 def combine_geocoded_reports(
-    orig_reports: pl.DataFrame, new_reports: pl.DataFrame
+    orig_reports: pl.DataFrame,
+    new_reports: pl.DataFrame,
+    con: Optional[duckdb.DuckDBPyConnection] = None,
 ) -> pl.DataFrame:
-    return duckdb.sql(
+    # The reports can also be Arrow tables.
+    if con is None:
+        con = duckdb.default_connection
+    return con.sql(
         """
         WITH all_rows AS (
             SELECT * FROM orig_reports
@@ -23,22 +32,120 @@ def combine_geocoded_reports(
     ).pl()
 
 
+def read_geocoded_reports(geocoded_reports: Union[Path, str]) -> str:
+    # A DuckDB relation for a csv / parquet file, read with the types above
+    # so nothing gets re-typed on the way through, or the name of a table
+    # (or registered Arrow table).
+    if isinstance(geocoded_reports, str):
+        return geocoded_reports
+    if geocoded_reports.suffix == ".parquet":
+        return f"READ_PARQUET('{geocoded_reports}')"
+    columns = ", ".join(
+        f"{column}: '{column_type}'"
+        for column, column_type in GEOCODED_REPORT_FIELDS
+    )
+    return (
+        f"READ_CSV('{geocoded_reports}', header=true, columns={{{columns}}})"
+    )
+
+
+def write_combined_geocoded_reports(
+    orig_reports: Union[Path, str],
+    new_reports: Union[Path, str],
+    combined_reports_file: Path,
+    con: Optional[duckdb.DuckDBPyConnection] = None,
+) -> int:
+    # The streaming version of combine_geocoded_reports: reads the inputs
+    # (files or table names) in DuckDB and writes the result straight to
+    # combined_reports_file, returning the number of rows written.
+    #
+    # The latest extraction of each report is picked from the keys alone,
+    # then only those rows are read back in and copied out, so the window
+    # never holds the full rows. Ties go to the new extraction. If either
+    # input lists a report more than once for the same extraction date the
+    # keys can't tell the copies apart, so it falls back to deduplicating
+    # the full rows.
+    if con is None:
+        con = duckdb.default_connection
+    sources = [read_geocoded_reports(new_reports)]
+    if isinstance(orig_reports, str) or orig_reports.exists():
+        sources.append(read_geocoded_reports(orig_reports))
+    columns = ", ".join(GEOCODED_REPORT_COLUMNS)
+    keys = " UNION ALL ".join(
+        f"SELECT number, extraction_date, {priority} AS priority FROM {source}"
+        for priority, source in enumerate(sources)
+    )
+    con.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE latest_geocoded_reports AS
+        SELECT number, extraction_date, priority, COUNT(*) AS copies
+        FROM ({keys})
+        GROUP BY number, extraction_date, priority
+        QUALIFY ROW_NUMBER() OVER(
+            PARTITION BY number
+            ORDER BY extraction_date DESC NULLS LAST, priority
+        ) = 1
+        """
+    )
+    try:
+        (duplicated,) = con.execute(
+            "SELECT COUNT(*) FROM latest_geocoded_reports WHERE copies > 1"
+        ).fetchone()
+        if duplicated:
+            logger.warning(
+                f"{duplicated} reports appear more than once with the same "
+                "extraction date, deduplicating the full rows."
+            )
+            rows = " UNION ALL ".join(
+                f"SELECT {columns}, {priority} AS priority FROM {source}"
+                for priority, source in enumerate(sources)
+            )
+            query = f"""
+                SELECT {columns} FROM ({rows})
+                QUALIFY ROW_NUMBER() OVER(
+                    PARTITION BY number
+                    ORDER BY extraction_date DESC NULLS LAST, priority
+                ) = 1
+            """
+        else:
+            query = " UNION ALL ".join(
+                f"""
+                SELECT {columns}
+                FROM {source} AS r
+                SEMI JOIN (
+                    SELECT * FROM latest_geocoded_reports
+                    WHERE priority = {priority}
+                ) AS l
+                    ON
+                        r.number = l.number AND
+                        r.extraction_date IS NOT DISTINCT FROM
+                            l.extraction_date
+                """
+                for priority, source in enumerate(sources)
+            )
+        return copy_to_file(con, query, combined_reports_file)
+    finally:
+        con.execute("DROP TABLE latest_geocoded_reports")
+
+
 def main(
     orig_reports_file: Path,
     new_reports_file: Path,
     combined_reports_file: Path,
+    report_file: Optional[Path] = None,
 ):
-    logger.info(f"Reading {orig_reports_file.name}")
-    orig_reports = pl.read_csv(orig_reports_file)
-    logger.info(f"Reading {new_reports_file.name}")
-    new_reports = pl.read_csv(new_reports_file)
-    logger.info(
-        f"Executing duckdb query to combine {orig_reports_file.name} "
-        f"and {new_reports_file.name}."
-    )
-    combined_reports = combine_geocoded_reports(orig_reports, new_reports)
-    logger.info(f"Saving combined reports to {combined_reports_file.name}")
-    combined_reports.write_csv(combined_reports_file)
+    with script_report("combine_geocoded_reports", report_file) as metrics:
+        logger.info(
+            f"Combining {orig_reports_file.name} and {new_reports_file.name} "
+            f"into {combined_reports_file.name}."
+        )
+        metrics.read_file(orig_reports_file)
+        metrics.read_file(new_reports_file)
+        rows_out = write_combined_geocoded_reports(
+            orig_reports_file, new_reports_file, combined_reports_file
+        )
+        metrics.add(rows_out=rows_out)
+        metrics.wrote_file(combined_reports_file)
     logger.info("👣 done 👣")
 
 
@@ -1,106 +1,97 @@
 import typer
 from pathlib import Path
+from typing import Optional
 from loguru import logger
 import duckdb
+import polars as pl
+import pyarrow as pa
+from storage import write_frame
+from report_schema import (
+    REPORT_KEY,
+    REPORT_VERSION,
+    read_reports,
+    select_list,
+)
+from run_report import StageMetrics, script_report
+
+
+def combine_raw_reports(
+    reports_orig_file: Path,
+    reports_new_file: Path,
+    con: Optional[duckdb.DuckDBPyConnection] = None,
+    metrics: Optional[StageMetrics] = None,
+) -> pa.Table:
+    # Combines new reports with existing reports, keeping the latest pull of
+    # each one, as some reports will drop off the BFRO website.
+    #
+    # The winners are picked from the key columns alone, and only then are
+    # the full text rows read back in, so the window function never carries
+    # the narrative columns. Ties go to the new pull. A file can repeat a
+    # pull (a re-crawled page appended twice), so the join back keeps one of
+    # the rows it matches for each report, which only windows over the
+    # winning rows. Rows without a report number count as one report, so one
+    # of them is kept, like the other reports.
+    if con is None:
+        con = duckdb.default_connection
+    sources = [("new", read_reports(reports_new_file))]
+    if reports_orig_file.exists():
+        sources.append(("orig", read_reports(reports_orig_file)))
+    if metrics is not None:
+        for _, source in sources:
+            (rows_in,) = con.sql(f"SELECT COUNT(*) FROM {source}").fetchone()
+            metrics.add(rows_in=rows_in)
+        metrics.read_file(reports_orig_file)
+        metrics.read_file(reports_new_file)
+    keys = " UNION ALL ".join(
+        f"SELECT {REPORT_KEY}, {REPORT_VERSION}, {priority} AS priority "
+        f"FROM {source}"
+        for priority, (_, source) in enumerate(sources)
+    )
+    rows = " UNION ALL ".join(
+        f"""
+        SELECT {select_list("r.")}
+        FROM {source} AS r
+        SEMI JOIN (
+            SELECT * FROM latest WHERE priority = {priority}
+        ) AS l
+            ON
+                r.{REPORT_KEY} IS NOT DISTINCT FROM l.{REPORT_KEY} AND
+                r.{REPORT_VERSION} IS NOT DISTINCT FROM l.{REPORT_VERSION}
+        QUALIFY ROW_NUMBER() OVER(PARTITION BY r.{REPORT_KEY}) = 1
+        """
+        for priority, (_, source) in enumerate(sources)
+    )
+    return con.sql(
+        f"""
+        WITH latest AS (
+            SELECT * FROM ({keys})
+            QUALIFY ROW_NUMBER() OVER(
+                PARTITION BY {REPORT_KEY}
+                ORDER BY {REPORT_VERSION} DESC NULLS LAST, priority
+            ) = 1
+        )
+        {rows}
+        """
+    ).arrow()
 
 
 def main(
-    reports_orig_file: Path, reports_new_file: Path, reports_out_file: Path
+    reports_orig_file: Path,
+    reports_new_file: Path,
+    reports_out_file: Path,
+    report_file: Optional[Path] = None,
 ):
     logger.info(f"reports_orig_file: {reports_orig_file.name}")
     logger.info(f"reports_new_file: {reports_new_file.name}")
     logger.info(f"reports_out_file: {reports_out_file.name}")
 
-    columns = [
-        "year",
-        "season",
-        "month",
-        "date",
-        "state",
-        "county",
-        "location_details",
-        "nearest_town",
-        "nearest_road",
-        "observed",
-        "also_noticed",
-        "other_witnesses",
-        "other_stories",
-        "time_and_conditions",
-        "environment",
-        "report_number",
-        "report_class",
-        '"a_&_g_references"',
-        "pulled_datetime",
-    ]
-
-    if reports_orig_file.exists():
-        combined_reports_frame = duckdb.sql(
-            f"""
-            WITH all_rows AS (
-                SELECT {', '.join(columns)} FROM '{reports_orig_file}'
-                UNION ALL
-                SELECT {', '.join(columns)} FROM READ_NDJSON(
-                    '{reports_new_file}',
-                    columns={{
-                        year: 'VARCHAR',
-                        season: 'VARCHAR',
-                        month: 'VARCHAR',
-                        date: 'VARCHAR',
-                        state: 'VARCHAR',
-                        county: 'VARCHAR',
-                        location_details: 'VARCHAR',
-                        nearest_town: 'VARCHAR',
-                        nearest_road: 'VARCHAR',
-                        observed: 'VARCHAR',
-                        also_noticed: 'VARCHAR',
-                        other_witnesses: 'VARCHAR',
-                        other_stories: 'VARCHAR',
-                        time_and_conditions: 'VARCHAR',
-                        environment: 'VARCHAR',
-                        report_number: 'BIGINT',
-                        report_class: 'VARCHAR',
-                        "a_&_g_references": 'VARCHAR',
-                        pulled_datetime: 'TIMESTAMP'
-                    }}
-                )
-            )
-            SELECT {', '.join(columns)} FROM all_rows
-            QUALIFY ROW_NUMBER() OVER(
-                PARTITION BY report_number ORDER BY pulled_datetime DESC
-            ) = 1
-            """
-        ).pl()
-    else:
-        combined_reports_frame = duckdb.sql(
-            f"""
-            SELECT {', '.join(columns)} FROM READ_NDJSON(
-                '{reports_new_file}',
-                columns={{
-                    year: 'VARCHAR',
-                    season: 'VARCHAR',
-                    month: 'VARCHAR',
-                    date: 'VARCHAR',
-                    state: 'VARCHAR',
-                    county: 'VARCHAR',
-                    location_details: 'VARCHAR',
-                    nearest_town: 'VARCHAR',
-                    nearest_road: 'VARCHAR',
-                    observed: 'VARCHAR',
-                    also_noticed: 'VARCHAR',
-                    other_witnesses: 'VARCHAR',
-                    other_stories: 'VARCHAR',
-                    time_and_conditions: 'VARCHAR',
-                    environment: 'VARCHAR',
-                    report_number: 'BIGINT',
-                    report_class: 'VARCHAR',
-                    "a_&_g_references": 'VARCHAR',
-                    pulled_datetime: 'TIMESTAMP'
-                }}
-            )
-            """
-        ).pl()
-
-    combined_reports_frame.write_csv(reports_out_file)
+    with script_report("combine_raw_reports", report_file) as metrics:
+        combined_reports = combine_raw_reports(
+            reports_orig_file, reports_new_file, metrics=metrics
+        )
+        write_frame(pl.from_arrow(combined_reports), reports_out_file)
+        metrics.add(rows_out=combined_reports.num_rows)
+        metrics.wrote_file(reports_out_file)
     logger.info("Done!")
 
 
@@ -1,142 +1,161 @@
 from lxml import etree
 from lxml.etree import Element
-import re
 import typer
 from pathlib import Path
 from loguru import logger
 import polars as pl
 from datetime import date
-import h3
-
-
-def extract_geocoded_reports(report_xml: Element) -> pl.DataFrame:
-    # Grab the relevant info we need.
-    logger.info("Extracting report titles.")
-    report_titles = [
-        t.strip() for t in report_xml.xpath("//Placemark/description/b/text()")
+import numpy as np
+import warnings
+from typing import BinaryIO, Dict, Iterator, List, Optional
+from contextlib import contextmanager
+import itertools
+import zipfile
+from storage import write_frame
+from run_report import script_report
+from report_schema import GEOCODED_REPORT_COLUMNS
+
+# The vectorized functions are under h3.unstable in h3 3.x.
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    from h3.unstable import vect as h3_vect
+
+
+def geo_to_h3(
+    latitudes: np.ndarray, longitudes: np.ndarray, resolution: int = 10
+) -> List[str]:
+    # Batched h3.geo_to_h3, returning the usual hex string ids.
+    return [
+        format(h, "x")
+        for h in h3_vect.geo_to_h3(
+            latitudes.astype(np.float64),
+            longitudes.astype(np.float64),
+            resolution,
+        ).tolist()
     ]
 
-    logger.info("Extracting report classifications.")
-    report_classifications = report_xml.xpath(
-        "//Placemark/description/a/text()"
-    )
 
-    # Make sure the lengths match.
-    logger.info("Validating report classifications and titles.")
-    if len(report_titles) != len(report_classifications):
-        raise ValueError(
-            "ERROR - len(titles): {}, len(classifications): {}".format(
-                len(report_titles), len(report_classifications)
+def _first_text(element: Element, path: str) -> Optional[str]:
+    found = element.find(path)
+    return found.text if found is not None else None
+
+
+def iter_placemarks(kml_source: BinaryIO) -> Iterator[Dict[str, str]]:
+    # Streams the placemarks out of the KML one at a time, pulling the title,
+    # classification, timestamp and location out of each together. Each
+    # placemark (and everything before it) is dropped from the tree once
+    # it's read, so memory doesn't grow with the size of the file.
+    for index, (_, placemark) in enumerate(
+        etree.iterparse(kml_source, events=("end",), tag="Placemark")
+    ):
+        report = {
+            "title": _first_text(placemark, "description/b"),
+            "classification": _first_text(placemark, "description/a"),
+            "timestamp": _first_text(placemark, "TimeStamp/when"),
+            "latitude": _first_text(placemark, "LookAt/latitude"),
+            "longitude": _first_text(placemark, "LookAt/longitude"),
+        }
+        missing = [k for k, v in report.items() if v is None]
+        if missing:
+            raise ValueError(
+                "ERROR - placemark {} is missing {}".format(
+                    index, ", ".join(missing)
+                )
             )
-        )
-
-    logger.info("Extracting report timestamps.")
-    report_timestamps = [
-        ts.strip()
-        for ts in report_xml.xpath("//Placemark[1]/TimeStamp/when/text()")
-    ]
-
-    # Make sure the lengths match.
-    logger.info("Validating report timestamp length.")
-    if len(report_titles) != len(report_timestamps):
-        raise ValueError(
-            "ERROR - len(titles): {}, len(timestamps): {}".format(
-                len(report_titles), len(report_timestamps)
-            )
-        )
-
-    logger.info("Extracting report latitudes.")
-    report_latitudes = report_xml.xpath(
-        "//Placemark[1]/LookAt/latitude/text()"
-    )
-
-    # Make sure the lengths match.
-    logger.info("Validating report latitudes.")
-    if len(report_titles) != len(report_latitudes):
-        raise ValueError(
-            "ERROR - len(titles): {}, len(latitudes): {}".format(
-                len(report_titles), len(report_latitudes)
+        report["title"] = report["title"].strip()
+        report["timestamp"] = report["timestamp"].strip()
+        yield report
+
+        placemark.clear(keep_tail=True)
+        for element in itertools.chain([placemark], placemark.iterancestors()):
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+@contextmanager
+def open_kml(kml_file: Path) -> Iterator[BinaryIO]:
+    # Opens either a plain KML file or the KMZ (zipped) file the BFRO site
+    # serves, reading the KML straight out of the archive.
+    if zipfile.is_zipfile(kml_file):
+        with zipfile.ZipFile(kml_file) as kmz:
+            kml_name = next(
+                n for n in kmz.namelist() if n.lower().endswith(".kml")
             )
-        )
-
-    logger.info("Extracting report longitudes.")
-    report_longitudes = report_xml.xpath(
-        "//Placemark[1]/LookAt/longitude/text()"
+            with kmz.open(kml_name) as kml_source:
+                yield kml_source
+    else:
+        with open(kml_file, "rb") as kml_source:
+            yield kml_source
+
+
+def extract_geocoded_reports(kml_source: BinaryIO) -> pl.DataFrame:
+    logger.info("Extracting placemarks.")
+    columns: Dict[str, List[str]] = {
+        "title": [],
+        "classification": [],
+        "timestamp": [],
+        "latitude": [],
+        "longitude": [],
+    }
+    for report in iter_placemarks(kml_source):
+        for column, values in columns.items():
+            values.append(report[column])
+
+    # Now consolidate into a data frame. The report number is the join key
+    # against the scraped data.
+    logger.info("Extracting report numbers and hexids.")
+    geocoded_reports = pl.DataFrame(
+        columns, schema={column: pl.Utf8 for column in columns}
+    ).with_columns(
+        [
+            pl.col("title")
+            .str.extract(r"Report (\d+):", 1)
+            .cast(pl.Int64)
+            .alias("number"),
+            pl.col("latitude").str.strip().cast(pl.Float64),
+            pl.col("longitude").str.strip().cast(pl.Float64),
+        ]
     )
 
-    # Make sure the lengths match.
-    logger.info("Validting report longitudes.")
-    if len(report_titles) != len(report_longitudes):
-        raise ValueError(
-            "ERROR - len(titles): {}, len(longitudes): {}".format(
-                len(report_titles), len(report_longitudes)
-            )
-        )
-
-    # Now to extract the report numbers. This will be a join key against the
-    # scraped data.
-    logger.info("Extracting report numbers.")
-    report_numbers = [
-        re.search(r"Report (\d+):", t).group(1) for t in report_titles
-    ]
-
     logger.info("Validating report numbers.")
-    if len(report_titles) != len(report_numbers):
+    if geocoded_reports["number"].null_count() > 0:
         raise ValueError(
-            "ERROR - len(titles): {}, len(numbers): {}".format(
-                len(report_titles), len(report_numbers)
+            "ERROR - {} titles without a report number".format(
+                geocoded_reports["number"].null_count()
             )
         )
 
-    # Now consolidate into a data frame.
-    return (
-        pl.DataFrame(
-            {
-                "number": report_numbers,
-                "title": report_titles,
-                "classification": report_classifications,
-                "timestamp": report_timestamps,
-                "latitude": report_latitudes,
-                "longitude": report_longitudes,
-            }
+    return geocoded_reports.with_columns(
+        [
+            pl.Series(
+                "hexid",
+                geo_to_h3(
+                    geocoded_reports["latitude"].to_numpy(),
+                    geocoded_reports["longitude"].to_numpy(),
+                ),
+            ),
+            pl.lit(f"{date.today():%Y-%m-%d}").alias("extraction_date"),
+        ]
+    ).select(GEOCODED_REPORT_COLUMNS)
+
+
+def main(
+    kml_file: Path, geocoded_out: Path, report_file: Optional[Path] = None
+):
+    # kml_file can be the KML itself or the KMZ download.
+    with script_report("extract_geocoded_reports", report_file) as metrics:
+        logger.info(f"Reading and parsing {kml_file.name}")
+        metrics.read_file(kml_file)
+        with open_kml(kml_file) as kml_source:
+            geocoded_reports = extract_geocoded_reports(kml_source)
+        metrics.add(
+            rows_in=geocoded_reports.height, rows_out=geocoded_reports.height
         )
-        .apply(
-            lambda x: (
-                x[0],  # number
-                x[1],  # title
-                x[2],  # classification
-                x[3],  # timestamp
-                float(x[4]),  # latitude
-                float(x[5]),  # longitude
-                h3.geo_to_h3(float(x[4]), float(x[5]), resolution=10),  # hexid
-                f"{date.today():%Y-%m-%d}",  # extraction_date
-            )
-        )
-        .rename(
-            {
-                "column_0": "number",
-                "column_1": "title",
-                "column_2": "classification",
-                "column_3": "timestamp",
-                "column_4": "latitude",
-                "column_5": "longitude",
-                "column_6": "hexid",
-                "column_7": "extraction_date",
-            }
-        )
-    )
-
-
-def main(kml_file: Path, geocoded_out: Path):
-    # Read the data into something that can be parsed.
-    logger.info(f"Reading and parsing {kml_file.name}")
-    report_xml = etree.fromstring(kml_file.read_bytes())
-
-    geocoded_reports = extract_geocoded_reports(report_xml)
 
-    # Now drop it into a CSV.
-    logger.info(f"Writing results to {geocoded_out.name}.")
-    geocoded_reports.write_csv(geocoded_out)
+        # Now drop it into a CSV (or parquet).
+        logger.info(f"Writing results to {geocoded_out.name}.")
+        write_frame(geocoded_reports, geocoded_out)
+        metrics.wrote_file(geocoded_out)
     logger.info("👣 all done 👣")
 
 
@@ -0,0 +1,86 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# Stage manifests for skipping work that's already been done. A manifest
+# records the hashes of a stage's input files, its parameters, and its code
+# from the last successful run, plus the hashes of the outputs it wrote. If
+# all of those still match, the stage's previous outputs are current and the
+# stage can be skipped.
+
+
+def file_hash(file: Path) -> Optional[str]:
+    # A directory (e.g. a partitioned export) hashes as the files in it.
+    if not file.exists():
+        return None
+    if file.is_dir():
+        return files_hash([f for f in file.rglob("*") if f.is_file()])
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def files_hash(files: List[Path]) -> str:
+    # One hash over a set of files, e.g. the code for a stage.
+    digest = hashlib.sha256()
+    for file in sorted(files):
+        digest.update(str(file).encode("utf-8"))
+        digest.update((file_hash(file) or "").encode("utf-8"))
+    return digest.hexdigest()
+
+
+def stage_fingerprint(
+    inputs: List[Path], code: List[Path], params: Dict[str, Any]
+) -> Dict[str, Any]:
+    return {
+        "inputs": {str(file): file_hash(file) for file in inputs},
+        "code": files_hash(code),
+        "params": params,
+    }
+
+
+def load_manifest(manifest_dir: Path, stage: str) -> Optional[Dict[str, Any]]:
+    manifest_file = manifest_dir / f"{stage}.json"
+    if not manifest_file.exists():
+        return None
+    return json.loads(manifest_file.read_text())
+
+
+def is_up_to_date(
+    manifest: Optional[Dict[str, Any]],
+    fingerprint: Dict[str, Any],
+    outputs: List[Path],
+) -> bool:
+    # Params go through json so they compare the same way they're stored.
+    if manifest is None:
+        return False
+    if manifest["fingerprint"] != json.loads(json.dumps(fingerprint)):
+        return False
+    # The outputs have to still be the ones the stage wrote.
+    return manifest["outputs"] == {
+        str(file): file_hash(file) for file in outputs
+    }
+
+
+def save_manifest(
+    manifest_dir: Path,
+    stage: str,
+    fingerprint: Dict[str, Any],
+    outputs: List[Path],
+):
+    manifest_dir.mkdir(parents=True, exist_ok=True)
+    manifest_file = manifest_dir / f"{stage}.json"
+    tmp_file = manifest_file.with_name(manifest_file.name + ".tmp")
+    tmp_file.write_text(
+        json.dumps(
+            {
+                "fingerprint": fingerprint,
+                "outputs": {str(file): file_hash(file) for file in outputs},
+            },
+            indent=2,
+        )
+    )
+    tmp_file.replace(manifest_file)
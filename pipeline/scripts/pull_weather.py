@@ -3,13 +3,19 @@ from pathlib import Path
 import polars as pl
 import h3
 import duckdb
-from typing import Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 from dotenv import load_dotenv, find_dotenv
 import os
 import requests
+import json
 import loguru
 from loguru import logger
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
+from run_report import StageMetrics, script_report
+from storage import copy_to_file
 
 
 def get_visual_crossing_key_from_env() -> str:
@@ -30,12 +36,14 @@ def get_missing_weather_keys(
             f"""
             SELECT
                 gr.hexid,
-                gr.timestamp
+                gr.timestamp::TIMESTAMP AS timestamp
             FROM
                 '{geocoded_reports}' AS gr
             LEFT JOIN
                 '{weather_cache}' AS wc
-                ON gr.hexid = wc.hexid AND gr.timestamp = wc.timestamp
+                ON
+                    gr.hexid = wc.hexid AND
+                    gr.timestamp::TIMESTAMP = wc.timestamp::TIMESTAMP
             WHERE
                 (wc.timestamp IS NULL OR wc.hexid IS NULL) AND
                 gr.hexid IS NOT NULL AND
@@ -47,64 +55,422 @@ def get_missing_weather_keys(
             f"""
             SELECT
                 hexid,
-                timestamp
+                timestamp::TIMESTAMP AS timestamp
             FROM '{geocoded_reports}'
             """
         ).pl()
 
 
+VISUAL_CROSSING_URL = (
+    "https://weather.visualcrossing.com/VisualCrossingWebServices/rest/"
+    "services/timeline"
+)
+
+
 def create_weather_request(
-    latitude: float, longitude: float, timestamp: datetime
+    latitude: float,
+    longitude: float,
+    timestamp: datetime,
+    base_url: str = VISUAL_CROSSING_URL,
 ) -> str:
-    # Note - timestamp comes in as a datetime because duckdb's csv parser
-    # recognizes the format.
+    # Note - timestamp comes in as a datetime because it's cast when the
+    # missing keys are pulled.
     return (
-        "https://weather.visualcrossing.com/VisualCrossingWebServices/rest/"
-        f"services/timeline/{latitude},{longitude}/"
+        f"{base_url}/{latitude},{longitude}/"
         f"{timestamp.strftime('%Y-%m-%dT%H:%M:%S')}"
     )
 
 
+def create_weather_range_request(
+    latitude: float,
+    longitude: float,
+    start: datetime,
+    end: datetime,
+    base_url: str = VISUAL_CROSSING_URL,
+) -> str:
+    return (
+        f"{base_url}/{latitude},{longitude}/"
+        f"{start.strftime('%Y-%m-%d')}/{end.strftime('%Y-%m-%d')}"
+    )
+
+
+def plan_weather_requests(
+    missing_weather_keys: pl.DataFrame,
+    max_gap_days: int = 1,
+    max_span_days: int = 30,
+) -> List[Tuple[str, List[datetime]]]:
+    # Groups the missing keys by hexid and merges dates that are close
+    # together into one (hexid, [timestamps]) batch, which becomes a single
+    # date range request. A new batch starts when the next date is more than
+    # max_gap_days after the previous one or would stretch the range past
+    # max_span_days. Visual Crossing bills for every day in the range, so
+    # with the default of 1 only consecutive dates are merged, which costs
+    # the same as pulling them one at a time in fewer requests. A bigger gap
+    # bills the days in between too.
+    # The batches come back most valuable first: by the best report class
+    # in them (class_rank, see get_missing_weather_keys_from_cache), then
+    # the most recent date, then how many reports they cover. Without those
+    # columns every key counts as one report of the same class.
+    if "class_rank" not in missing_weather_keys.columns:
+        missing_weather_keys = missing_weather_keys.with_columns(
+            [pl.lit(0).alias("class_rank"), pl.lit(1).alias("reports")]
+        )
+    batches: List[Tuple[str, List[datetime]]] = []
+    # Best class rank, latest date and report count for each batch.
+    priorities: List[List[Any]] = []
+    for row in (
+        missing_weather_keys.groupby(["hexid", "timestamp"])
+        .agg([pl.col("class_rank").min(), pl.col("reports").sum()])
+        .sort(["hexid", "timestamp"])
+        .iter_rows(named=True)
+    ):
+        if batches and batches[-1][0] == row["hexid"]:
+            timestamps = batches[-1][1]
+            gap = (row["timestamp"].date() - timestamps[-1].date()).days
+            span = (row["timestamp"].date() - timestamps[0].date()).days
+            if gap <= max_gap_days and span < max_span_days:
+                timestamps.append(row["timestamp"])
+                priority = priorities[-1]
+                priority[0] = min(priority[0], row["class_rank"])
+                priority[1] = row["timestamp"]
+                priority[2] += row["reports"]
+                continue
+        batches.append((row["hexid"], [row["timestamp"]]))
+        priorities.append(
+            [row["class_rank"], row["timestamp"], row["reports"]]
+        )
+    order = sorted(
+        range(len(batches)),
+        key=lambda i: (
+            priorities[i][0],
+            -priorities[i][1].toordinal(),
+            -priorities[i][2],
+        ),
+    )
+    return [batches[i] for i in order]
+
+
+def weather_request_cost(timestamps: List[datetime]) -> int:
+    # The days Visual Crossing bills a (hexid, [timestamps]) batch for:
+    # every day in its range, whether there's a report on it or not.
+    return (timestamps[-1].date() - timestamps[0].date()).days + 1
+
+
+def split_weather_response(
+    weather_response: str, timestamps: List[datetime]
+) -> List[Optional[str]]:
+    # Splits a date range response into one response per timestamp, each
+    # with a single entry in days so it matches the single date responses
+    # (the weather model reads data -> 'days' -> 0).
+    response = json.loads(weather_response)
+    days = {day.get("datetime"): day for day in response.get("days", [])}
+    split_responses: List[Optional[str]] = []
+    for timestamp in timestamps:
+        day = days.get(timestamp.strftime("%Y-%m-%d"))
+        split_responses.append(
+            json.dumps({**response, "days": [day]}) if day else None
+        )
+    return split_responses
+
+
+# The days[0] fields kept as typed columns in the cache: column name, Visual
+# Crossing field, and DuckDB type.
+WEATHER_FIELDS = [
+    ("temperature_high", "tempmax", "FLOAT"),
+    ("temperature_low", "tempmin", "FLOAT"),
+    ("temperature_mid", "temp", "FLOAT"),
+    ("dew_point", "dew", "FLOAT"),
+    ("humidity", "humidity", "FLOAT"),
+    ("cloud_cover", "cloudcover", "FLOAT"),
+    ("moon_phase", "moonphase", "FLOAT"),
+    ("precip_intensity", "precip", "FLOAT"),
+    ("precip_probability", "precipprob", "FLOAT"),
+    ("precip_type", "preciptype", "VARCHAR[]"),
+    ("pressure", "pressure", "FLOAT"),
+    ("summary", "description", "VARCHAR"),
+    ("conditions", "conditions", "VARCHAR"),
+    ("uv_index", "uvindex", "FLOAT"),
+    ("visibility", "visibility", "FLOAT"),
+    ("wind_bearing", "winddir", "FLOAT"),
+    ("wind_speed", "windspeed", "FLOAT"),
+]
+
+WEATHER_FIELD_DTYPES = {
+    "FLOAT": pl.Float32,
+    "VARCHAR": pl.Utf8,
+    "VARCHAR[]": pl.List(pl.Utf8),
+}
+
+# The cache rows: the key, the parsed fields, the raw response, where the
+# weather came from if it was reused from a nearby hex (see
+# reuse_nearby_weather), null if it was pulled for the key's own hex, and how
+# many pulls of the key have failed and when it's due to be tried again.
+WEATHER_CACHE_SCHEMA = {
+    "hexid": pl.Utf8,
+    "timestamp": pl.Datetime,
+    "date_pulled": pl.Utf8,
+    **{
+        column: WEATHER_FIELD_DTYPES[field_type]
+        for column, _, field_type in WEATHER_FIELDS
+    },
+    "data": pl.Utf8,
+    "source_hexid": pl.Utf8,
+    "source_distance_km": pl.Float32,
+    "failed_pulls": pl.Int32,
+    "next_pull_date": pl.Date,
+}
+
+# A key whose pull fails is tried again RETRY_BASE_DAYS later, and the wait
+# doubles with every failure after that, up to RETRY_MAX_DAYS. Failures
+# usually mean Visual Crossing has no data for that date, so they shouldn't
+# keep eating into the daily calls, but it does backfill.
+RETRY_BASE_DAYS = 1
+RETRY_MAX_DAYS = 64
+
+# The order the report classes' keys are pulled in, best first. Anything
+# else comes after them.
+CLASS_PRIORITY = ["Class A", "Class B", "Class C"]
+
+
+def parse_weather_data(data: Optional[str]) -> Dict[str, Any]:
+    # Decodes a cached response into the WEATHER_FIELDS columns, all None if
+    # there's no data (or it isn't readable).
+    fields: Dict[str, Any] = {column: None for column, _, _ in WEATHER_FIELDS}
+    if data is None:
+        return fields
+    try:
+        day = (json.loads(data).get("days") or [None])[0] or {}
+    except (ValueError, AttributeError):
+        logger.warning(f"Unable to parse weather data: {data[:100]}")
+        return fields
+    for column, field, field_type in WEATHER_FIELDS:
+        value = day.get(field)
+        if value is None:
+            continue
+        if field_type == "FLOAT":
+            fields[column] = float(value)
+        elif field_type == "VARCHAR[]":
+            values = value if isinstance(value, list) else [value]
+            fields[column] = [str(v) for v in values]
+        else:
+            fields[column] = str(value)
+    return fields
+
+
+def with_weather_fields(weather_data: pl.DataFrame) -> pl.DataFrame:
+    # Adds the parsed WEATHER_FIELDS columns to raw cache rows.
+    fields = pl.DataFrame(
+        [parse_weather_data(data) for data in weather_data["data"]],
+        schema={
+            column: WEATHER_CACHE_SCHEMA[column]
+            for column, _, _ in WEATHER_FIELDS
+        },
+    )
+    return pl.concat(
+        [weather_data.select(["hexid", "timestamp", "date_pulled"]), fields],
+        how="horizontal",
+    ).with_columns(weather_data["data"])
+
+
+class RateLimiter:
+    # Token bucket shared by the fetch threads. Tokens refill at
+    # requests_per_second up to burst, and each request takes one.
+    def __init__(self, requests_per_second: float, burst: int = 1):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens
+                    + (now - self.last_refill) * self.requests_per_second,
+                )
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.requests_per_second
+            time.sleep(wait)
+
+
+# Sessions aren't guaranteed to be thread safe, so each fetch thread gets its
+# own (and keeps its connections alive between requests).
+_thread_local = threading.local()
+
+
+def _get_session() -> requests.Session:
+    if not hasattr(_thread_local, "session"):
+        _thread_local.session = requests.Session()
+    return _thread_local.session
+
+
+def fetch_weather(
+    weather_request: str,
+    visual_crossing_key: str,
+    rate_limiter: RateLimiter,
+    max_retries: int = 3,
+    backoff_seconds: float = 1.0,
+    logger=loguru.logger,
+    metrics: Optional[StageMetrics] = None,
+) -> Optional[str]:
+    # Returns the raw response text, or None if the request failed. 429s and
+    # 5xx responses are retried with exponential backoff (or the server's
+    # Retry-After if it sends one), anything else fails right away.
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+        logger.info(f"Making weather request: {weather_request}")
+        retry_after = None
+        if metrics is not None:
+            metrics.add(api_calls=1)
+        try:
+            response = _get_session().get(
+                weather_request,
+                params={"key": visual_crossing_key, "include": "days"},
+                timeout=60,
+            )
+        except requests.RequestException as e:
+            logger.warning(f"Request {weather_request} failed: {e}.")
+        else:
+            if metrics is not None:
+                metrics.add(bytes_read=len(response.content))
+            if response.ok:
+                logger.info("Weather request successful.")
+                return response.text
+            if response.status_code != 429 and response.status_code < 500:
+                break
+            logger.warning(
+                f"Request {weather_request} returned {response.status_code}."
+            )
+            retry_after = response.headers.get("Retry-After")
+        if attempt < max_retries:
+            time.sleep(
+                float(retry_after)
+                if retry_after and retry_after.isdigit()
+                else backoff_seconds * 2**attempt
+            )
+    logger.warning(f"Encountered error with request {weather_request}.")
+    return None
+
+
 def pull_missing_weather(
     missing_weather_keys: pl.DataFrame,
     visual_crossing_key: str,
     limit: int = 900,
     logger=loguru.logger,
+    concurrency: int = 8,
+    requests_per_second: float = 5.0,
+    max_retries: int = 3,
+    base_url: str = VISUAL_CROSSING_URL,
+    max_gap_days: int = 1,
+    max_span_days: int = 30,
+    on_weather_data: Optional[
+        Callable[[List[Dict[str, str]], int], None]
+    ] = None,
+    metrics: Optional[StageMetrics] = None,
 ) -> Tuple[pl.DataFrame, bool]:
-    weather_data: List[Dict[str, str]] = []
-    total_calls = 0
-    for row in missing_weather_keys.iter_rows(named=True):
-        latitude, longitude = h3.h3_to_geo(row["hexid"])
-        weather_request = create_weather_request(
-            latitude, longitude, row["timestamp"]
-        )
-        logger.info(f"Making weather request: {weather_request}")
-        response = requests.get(
-            weather_request,
-            params={"key": visual_crossing_key, "include": "days"},
-        )
-        if response.ok:
-            weather_response = response.text
-            logger.info("Weather request successful.")
+    # limit is in billed days (see weather_request_cost), retries aren't
+    # counted. The requests are taken most valuable first (see
+    # plan_weather_requests) while they fit in it, and a request that
+    # doesn't fit is passed over for smaller ones after it. Keys in the same
+    # hex on nearby dates share a request. on_weather_data is called with
+    # the rows and billed days for each request as soon as it completes, so
+    # they can be saved before the rest of the pull finishes.
+    planned_batches = plan_weather_requests(
+        missing_weather_keys, max_gap_days, max_span_days
+    )
+    batches = []
+    billed_days = 0
+    for batch in planned_batches:
+        cost = weather_request_cost(batch[1])
+        if billed_days + cost <= limit:
+            batches.append(batch)
+            billed_days += cost
+    limit_reached = len(batches) < len(planned_batches)
+    if metrics is not None:
+        metrics.details["billed_days"] = billed_days
+    weather_requests = []
+    for hexid, timestamps in batches:
+        latitude, longitude = h3.h3_to_geo(hexid)
+        if len(timestamps) == 1:
+            weather_requests.append(
+                create_weather_request(
+                    latitude, longitude, timestamps[0], base_url=base_url
+                )
+            )
         else:
-            logger.warning(
-                f"Encountered error with request {weather_request}."
+            weather_requests.append(
+                create_weather_range_request(
+                    latitude,
+                    longitude,
+                    timestamps[0],
+                    timestamps[-1],
+                    base_url=base_url,
+                )
             )
-            # Set the weather data to None here so we don't just pile up bad
-            # pulls from run to run.
-            weather_response = None
-        total_calls += 1
-        weather_data.append(
-            {
-                **row,
-                "date_pulled": f"{date.today():%Y-%m-%d}",
-                "data": weather_response,
-            }
-        )
-        if total_calls > limit:
-            logger.info("Call limit reached. Terminating.")
-            break
-    return pl.from_dicts(weather_data), (total_calls > limit)
+    rate_limiter = RateLimiter(requests_per_second, burst=concurrency)
+    weather_data: List[Dict[str, str]] = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(
+                fetch_weather,
+                weather_request,
+                visual_crossing_key,
+                rate_limiter,
+                max_retries=max_retries,
+                logger=logger,
+                metrics=metrics,
+            ): batch
+            for batch, weather_request in zip(batches, weather_requests)
+        }
+        for future in as_completed(futures):
+            hexid, timestamps = futures[future]
+            weather_response = future.result()
+            # Failed requests keep their data as None, and aren't tried
+            # again until next_pull_date (see RETRY_BASE_DAYS).
+            if weather_response is None:
+                split_responses = [None] * len(timestamps)
+            elif len(timestamps) == 1:
+                split_responses = [weather_response]
+            else:
+                split_responses = split_weather_response(
+                    weather_response, timestamps
+                )
+            batch_data = [
+                {
+                    "hexid": hexid,
+                    "timestamp": timestamp,
+                    "date_pulled": f"{date.today():%Y-%m-%d}",
+                    # Decoded once here so nothing downstream has to.
+                    **parse_weather_data(data),
+                    "data": data,
+                    "source_hexid": None,
+                    "source_distance_km": None,
+                    "failed_pulls": int(data is None),
+                    "next_pull_date": (
+                        date.today() + timedelta(days=RETRY_BASE_DAYS)
+                        if data is None
+                        else None
+                    ),
+                }
+                for timestamp, data in zip(timestamps, split_responses)
+            ]
+            if on_weather_data is not None:
+                on_weather_data(batch_data, weather_request_cost(timestamps))
+            if metrics is not None:
+                metrics.add(rows_out=len(batch_data))
+            weather_data.extend(batch_data)
+    if limit_reached:
+        logger.info("Call limit reached. Terminating.")
+    return (
+        pl.from_dicts(weather_data, schema=WEATHER_CACHE_SCHEMA),
+        limit_reached,
+    )
 
 
 def merge_new_records_with_weather_cache(
@@ -116,7 +482,7 @@ def merge_new_records_with_weather_cache(
         f"""
         WITH all_rows AS (
             SELECT * FROM '{weather_cache_file}'
-            UNION ALL
+            UNION ALL BY NAME
             SELECT * FROM new_weather_data
         )
         SELECT * FROM all_rows
@@ -127,34 +493,609 @@ def merge_new_records_with_weather_cache(
     ).pl()
 
 
-def main(
-    weather_cache_file: Path, geocoded_reports_file: Path, limit: int = 900
+def open_weather_cache(
+    weather_cache_db: Path, seed_file: Optional[Path] = None
+) -> duckdb.DuckDBPyConnection:
+    # The weather cache as a DuckDB table keyed on (hexid, timestamp). Every
+    # insert is its own transaction, so whatever was pulled before a crash is
+    # kept. A new database is seeded from seed_file (an exported cache) if
+    # it exists. Caches from before the parsed weather fields were added are
+    # parsed and upgraded in place. The database also keeps the ledger of
+    # days billed each day (see remaining_api_calls), which is why pulls
+    # refuse an in-memory cache.
+    new_db = not weather_cache_db.exists()
+    weather_cache = duckdb.connect(str(weather_cache_db))
+    columns = {
+        column
+        for (column,) in weather_cache.execute(
+            """
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_name = 'weather_cache'
+            """
+        ).fetchall()
+    }
+    if columns and "temperature_high" not in columns:
+        logger.info(f"Parsing the weather fields in {weather_cache_db.name}.")
+        weather_cache.begin()
+        raw_weather_cache = weather_cache.execute(
+            "SELECT * FROM weather_cache"
+        ).pl()
+        weather_cache.execute("DROP TABLE weather_cache")
+        _create_weather_cache_table(weather_cache)
+        insert_weather_frame(
+            weather_cache, with_weather_fields(raw_weather_cache)
+        )
+        weather_cache.commit()
+    else:
+        _create_weather_cache_table(weather_cache)
+        # Caches from before weather was reused between hexes.
+        weather_cache.execute(
+            """
+            ALTER TABLE weather_cache
+            ADD COLUMN IF NOT EXISTS source_hexid VARCHAR
+            """
+        )
+        weather_cache.execute(
+            """
+            ALTER TABLE weather_cache
+            ADD COLUMN IF NOT EXISTS source_distance_km FLOAT
+            """
+        )
+        # And from before failed pulls were retried.
+        weather_cache.execute(
+            """
+            ALTER TABLE weather_cache
+            ADD COLUMN IF NOT EXISTS failed_pulls INTEGER
+            """
+        )
+        weather_cache.execute(
+            """
+            ALTER TABLE weather_cache
+            ADD COLUMN IF NOT EXISTS next_pull_date DATE
+            """
+        )
+    weather_cache.execute(
+        """
+        CREATE TABLE IF NOT EXISTS weather_api_calls (
+            date DATE PRIMARY KEY,
+            calls INTEGER
+        )
+        """
+    )
+    if new_db and seed_file is not None and seed_file.exists():
+        logger.info(f"Seeding {weather_cache_db.name} from {seed_file.name}.")
+        _seed_weather_cache(weather_cache, seed_file)
+    # Failed pulls from older caches (or seeds) count as one failure on the
+    # day they were pulled.
+    weather_cache.execute(
+        f"""
+        UPDATE weather_cache
+        SET
+            failed_pulls = CASE WHEN data IS NULL THEN 1 ELSE 0 END,
+            next_pull_date = CASE
+                WHEN data IS NULL
+                THEN date_pulled::DATE + {RETRY_BASE_DAYS}
+            END
+        WHERE failed_pulls IS NULL
+        """
+    )
+    return weather_cache
+
+
+def _create_weather_cache_table(weather_cache: duckdb.DuckDBPyConnection):
+    field_columns = ",\n".join(
+        f"{column} {field_type}" for column, _, field_type in WEATHER_FIELDS
+    )
+    weather_cache.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS weather_cache (
+            hexid VARCHAR,
+            timestamp TIMESTAMP,
+            date_pulled VARCHAR,
+            {field_columns},
+            data VARCHAR,
+            source_hexid VARCHAR,
+            source_distance_km FLOAT,
+            failed_pulls INTEGER,
+            next_pull_date DATE,
+            PRIMARY KEY (hexid, timestamp)
+        )
+        """
+    )
+
+
+def _seed_weather_cache(
+    weather_cache: duckdb.DuckDBPyConnection, seed_file: Path
 ):
-    logger.info(f"weather_cache_file: {weather_cache_file.name}")
-    logger.info(f"geocoded_reports_file: {geocoded_reports_file.name}")
-    logger.info(f"limit: {limit}")
-    visual_crossing_key = get_visual_crossing_key_from_env()
-    logger.info(f"Getting missing weather keys from {geocoded_reports_file}.")
-    missing_weather_keys = get_missing_weather_keys(
-        geocoded_reports_file, weather_cache_file
+    seed_columns = [
+        column
+        for column, *_ in weather_cache.execute(
+            f"DESCRIBE SELECT * FROM '{seed_file}'"
+        ).fetchall()
+    ]
+    if "temperature_high" in seed_columns:
+        # The list comes back as a string from a csv export.
+        weather_cache.execute(
+            f"""
+            INSERT OR IGNORE INTO weather_cache BY NAME
+            SELECT * REPLACE (
+                timestamp::TIMESTAMP AS timestamp,
+                date_pulled::VARCHAR AS date_pulled,
+                precip_type::VARCHAR[] AS precip_type,
+                data::VARCHAR AS data
+            )
+            FROM '{seed_file}'
+            ORDER BY date_pulled
+            """
+        )
+    else:
+        raw_weather_cache = weather_cache.execute(
+            f"""
+            SELECT
+                hexid,
+                timestamp::TIMESTAMP AS timestamp,
+                date_pulled::VARCHAR AS date_pulled,
+                data::VARCHAR AS data
+            FROM '{seed_file}'
+            ORDER BY date_pulled
+            """
+        ).pl()
+        insert_weather_frame(
+            weather_cache, with_weather_fields(raw_weather_cache)
+        )
+
+
+def _relation(table: Union[Path, str]) -> str:
+    return f"'{table}'" if isinstance(table, Path) else table
+
+
+def get_missing_weather_keys_from_cache(
+    geocoded_reports: Union[Path, str],
+    weather_cache: duckdb.DuckDBPyConnection,
+) -> pl.DataFrame:
+    # geocoded_reports is a csv / parquet file, or the name of a table (or
+    # registered Arrow table) on the weather cache connection. Keys whose
+    # last pull failed are missing again once their next_pull_date comes.
+    # Each key also gets the best class of its reports (its index in
+    # CLASS_PRIORITY) and how many reports it has, which
+    # plan_weather_requests orders the requests by.
+    class_ranks = "\n".join(
+        f"WHEN '{report_class}' THEN {rank}"
+        for rank, report_class in enumerate(CLASS_PRIORITY)
     )
-    if missing_weather_keys.is_empty():
-        logger.info("Nothing new to pull. All done.")
-        return
-    logger.info("Pulling missing weather data.")
-    new_weather_data, _ = pull_missing_weather(
-        missing_weather_keys, visual_crossing_key, limit
+    return weather_cache.execute(
+        f"""
+        SELECT
+            gr.hexid,
+            gr.timestamp::TIMESTAMP AS timestamp,
+            MIN(
+                CASE gr.classification
+                    {class_ranks}
+                    ELSE {len(CLASS_PRIORITY)}
+                END
+            ) AS class_rank,
+            COUNT(*) AS reports
+        FROM
+            {_relation(geocoded_reports)} AS gr
+        ANTI JOIN
+            (
+                SELECT hexid, timestamp
+                FROM weather_cache
+                WHERE data IS NOT NULL OR next_pull_date > ?
+            ) AS wc
+            ON
+                gr.hexid = wc.hexid AND
+                gr.timestamp::TIMESTAMP = wc.timestamp
+        WHERE
+            gr.hexid IS NOT NULL AND
+            gr.timestamp IS NOT NULL
+        GROUP BY 1, 2
+        """,
+        [date.today()],
+    ).pl()
+
+
+def _is_nearby(
+    hexid: str,
+    other_hexid: str,
+    reuse_resolution: Optional[int],
+    k_ring: Set[str],
+) -> bool:
+    if other_hexid in k_ring:
+        return True
+    return reuse_resolution is not None and h3.h3_to_parent(
+        hexid, reuse_resolution
+    ) == h3.h3_to_parent(other_hexid, reuse_resolution)
+
+
+def reuse_nearby_weather(
+    weather_cache: duckdb.DuckDBPyConnection,
+    missing_weather_keys: pl.DataFrame,
+    reuse_resolution: Optional[int] = None,
+    reuse_k_ring: int = 0,
+) -> pl.DataFrame:
+    # Fills in missing keys from the weather already pulled for a nearby hex
+    # on the same day, and returns the keys that are still missing. Nearby
+    # is within reuse_k_ring cells (about 115m per ring at resolution 10),
+    # or in the same cell at the coarser reuse_resolution (about 5km2 at
+    # resolution 7), and the closest hex wins. Only weather that was pulled for
+    # its own hex is reused, so it never travels further than that. The
+    # reused rows record the hex they came from and how far away it is.
+    if missing_weather_keys.is_empty() or (
+        reuse_resolution is None and reuse_k_ring <= 0
+    ):
+        return missing_weather_keys
+    weather_cache.register(
+        "missing_weather_keys", missing_weather_keys.to_arrow()
     )
+    candidates = weather_cache.execute(
+        """
+        SELECT missing.hexid, missing.timestamp, wc.hexid
+        FROM missing_weather_keys AS missing
+        INNER JOIN weather_cache AS wc
+            ON missing.timestamp = wc.timestamp
+        WHERE wc.data IS NOT NULL AND wc.source_hexid IS NULL
+        ORDER BY wc.hexid
+        """
+    ).fetchall()
+    weather_cache.unregister("missing_weather_keys")
+    k_rings: Dict[str, Set[str]] = {}
+    nearest: Dict[Tuple[str, datetime], Tuple[str, float]] = {}
+    for hexid, timestamp, source_hexid in candidates:
+        if hexid not in k_rings:
+            k_rings[hexid] = (
+                set(h3.k_ring(hexid, reuse_k_ring)) if reuse_k_ring else set()
+            )
+        if not _is_nearby(
+            hexid, source_hexid, reuse_resolution, k_rings[hexid]
+        ):
+            continue
+        distance = h3.point_dist(
+            h3.h3_to_geo(hexid), h3.h3_to_geo(source_hexid), unit="km"
+        )
+        key = (hexid, timestamp)
+        if key not in nearest or distance < nearest[key][1]:
+            nearest[key] = (source_hexid, distance)
+    if not nearest:
+        return missing_weather_keys
+    reused_weather = pl.DataFrame(
+        [
+            (hexid, timestamp, source_hexid, distance)
+            for (hexid, timestamp), (source_hexid, distance) in nearest.items()
+        ],
+        schema={
+            "hexid": pl.Utf8,
+            "timestamp": pl.Datetime,
+            "source_hexid": pl.Utf8,
+            "source_distance_km": pl.Float32,
+        },
+    )
+    weather_cache.register("reused_weather", reused_weather.to_arrow())
+    field_columns = ", ".join(
+        f"wc.{column}" for column, _, _ in WEATHER_FIELDS
+    )
+    reused_rows = weather_cache.execute(
+        f"""
+        SELECT
+            reused.hexid,
+            reused.timestamp,
+            '{date.today():%Y-%m-%d}' AS date_pulled,
+            {field_columns},
+            wc.data,
+            reused.source_hexid,
+            reused.source_distance_km,
+            0 AS failed_pulls,
+            NULL::DATE AS next_pull_date
+        FROM reused_weather AS reused
+        INNER JOIN weather_cache AS wc
+            ON
+                reused.source_hexid = wc.hexid AND
+                reused.timestamp = wc.timestamp
+        """
+    ).pl()
+    weather_cache.unregister("reused_weather")
+    # Reused weather replaces a failed pull the same way a new pull would.
+    insert_pulled_weather(weather_cache, reused_rows)
+    logger.info(f"Reused nearby weather for {reused_weather.height} keys.")
+    return missing_weather_keys.join(
+        reused_weather.select(["hexid", "timestamp"]),
+        on=["hexid", "timestamp"],
+        how="anti",
+    )
+
+
+def insert_pulled_weather(
+    weather_cache: duckdb.DuckDBPyConnection, weather_data: pl.DataFrame
+):
+    # Like the merge, the first pull for a key wins, unless it failed. Then
+    # the new row replaces it, and if that failed too the wait before the
+    # next try doubles. DuckDB can't update the list column, or delete and
+    # insert a key in one transaction, so the failed rows are deleted first.
+    # A crash in between only loses failed pulls, which are pulled again.
+    weather_cache.register("new_weather_data", weather_data.to_arrow())
+    retried_weather = weather_cache.execute(
+        f"""
+        SELECT new.* REPLACE (
+            COALESCE(wc.failed_pulls, 0) + new.failed_pulls AS failed_pulls,
+            CASE
+                WHEN new.data IS NULL
+                THEN DATE '{date.today():%Y-%m-%d}' + LEAST(
+                    {RETRY_MAX_DAYS},
+                    {RETRY_BASE_DAYS} * POW(2, COALESCE(wc.failed_pulls, 0))
+                )::INTEGER
+            END AS next_pull_date
+        )
+        FROM new_weather_data AS new
+        INNER JOIN weather_cache AS wc
+            ON new.hexid = wc.hexid AND new.timestamp = wc.timestamp
+        WHERE wc.data IS NULL
+        """
+    ).pl()
+    weather_cache.unregister("new_weather_data")
+    if not retried_weather.is_empty():
+        weather_cache.register("retried_weather", retried_weather.to_arrow())
+        weather_cache.execute(
+            """
+            DELETE FROM weather_cache
+            WHERE (hexid, timestamp) IN (
+                SELECT (hexid, timestamp) FROM retried_weather
+            )
+            """
+        )
+        weather_cache.unregister("retried_weather")
+        insert_weather_frame(weather_cache, retried_weather)
+    insert_weather_frame(weather_cache, weather_data)
+
+
+def insert_weather_data(
+    weather_cache: duckdb.DuckDBPyConnection,
+    weather_data: List[Dict[str, Any]],
+):
+    # The rows pull_missing_weather hands to on_weather_data.
+    insert_pulled_weather(
+        weather_cache,
+        pl.from_dicts(weather_data, schema=WEATHER_CACHE_SCHEMA),
+    )
+
+
+def remaining_api_calls(
+    weather_cache: duckdb.DuckDBPyConnection, daily_limit: int
+) -> int:
+    # How many of today's daily_limit billed days (see weather_request_cost)
+    # haven't been spent yet, by any run against this cache.
+    (calls,) = weather_cache.execute(
+        "SELECT COALESCE(SUM(calls), 0) FROM weather_api_calls WHERE date = ?",
+        [date.today()],
+    ).fetchone()
+    return max(daily_limit - calls, 0)
+
 
-    if not weather_cache_file.exists():
-        logger.info(f"Weather cache file {weather_cache_file} does not exist.")
-        logger.info("Saving what was just pulled.")
-        new_weather_data.write_csv(weather_cache_file)
+def weather_pull_pending(
+    weather_cache: duckdb.DuckDBPyConnection,
+    geocoded_reports: Union[Path, str],
+    daily_limit: int,
+) -> bool:
+    # Whether a pull today would do anything: some report key's weather is
+    # missing from the cache or due to be tried again, and there are billed
+    # days left today to pull it with.
+    if remaining_api_calls(weather_cache, daily_limit) == 0:
+        return False
+    return not get_missing_weather_keys_from_cache(
+        geocoded_reports, weather_cache
+    ).is_empty()
+
+
+def record_api_calls(weather_cache: duckdb.DuckDBPyConnection, calls: int):
+    weather_cache.execute(
+        """
+        INSERT INTO weather_api_calls VALUES (?, ?)
+        ON CONFLICT (date) DO UPDATE SET calls = calls + EXCLUDED.calls
+        """,
+        [date.today(), calls],
+    )
+
+
+def insert_weather_frame(
+    weather_cache: duckdb.DuckDBPyConnection, weather_data: pl.DataFrame
+):
+    # Adds the rows for keys that aren't in the cache yet.
+    weather_cache.register("new_weather_data", weather_data.to_arrow())
+    weather_cache.execute(
+        """
+        INSERT OR IGNORE INTO weather_cache BY NAME
+        SELECT * FROM new_weather_data
+        """
+    )
+    weather_cache.unregister("new_weather_data")
+
+
+def export_weather_cache(
+    weather_cache: duckdb.DuckDBPyConnection, export_file: Path
+):
+    # Writes the cache out as a csv / parquet file for dbt.
+    copy_to_file(
+        weather_cache,
+        "SELECT * FROM weather_cache ORDER BY hexid, timestamp",
+        export_file,
+    )
+
+
+def pull_weather_with_cache(
+    weather_cache: duckdb.DuckDBPyConnection,
+    geocoded_reports: Union[Path, str],
+    visual_crossing_key: str,
+    limit: int = 900,
+    export_file: Optional[Path] = None,
+    metrics: Optional[StageMetrics] = None,
+    reuse_resolution: Optional[int] = None,
+    reuse_k_ring: int = 0,
+    **pull_kwargs,
+) -> bool:
+    # Returns whether keys are still missing, because the call limit was hit
+    # or failed pulls that are due to be tried again were left over. Those
+    # that aren't due yet don't count, they'll be picked up on the day. limit
+    # is the number of billed days a day, shared by every run against this
+    # cache: the days billed so far today are recorded in it and only the
+    # rest are spent, so the cache has to be a database file, not in memory.
+    # Weather from nearby hexes is reused before anything's pulled if
+    # reuse_resolution or reuse_k_ring are set (see reuse_nearby_weather).
+    ((database_path,),) = weather_cache.execute(
+        """
+        SELECT path FROM duckdb_databases()
+        WHERE database_name = current_database()
+        """
+    ).fetchall()
+    if database_path is None:
+        raise ValueError(
+            "The weather cache is in memory, so it can't keep track of the "
+            "daily call limit."
+        )
+    logger.info(f"Getting missing weather keys from {geocoded_reports}.")
+    missing_weather_keys = get_missing_weather_keys_from_cache(
+        geocoded_reports, weather_cache
+    )
+    reused_keys = missing_weather_keys.height
+    missing_weather_keys = reuse_nearby_weather(
+        weather_cache, missing_weather_keys, reuse_resolution, reuse_k_ring
+    )
+    reused_keys -= missing_weather_keys.height
+    if metrics is not None:
+        # Every report key is a cache lookup; the ones not missing are hits.
+        (total_keys,) = weather_cache.execute(
+            f"""
+            SELECT COUNT(*) FROM (
+                SELECT DISTINCT hexid, timestamp::TIMESTAMP
+                FROM {_relation(geocoded_reports)}
+                WHERE hexid IS NOT NULL AND timestamp IS NOT NULL
+            )
+            """
+        ).fetchone()
+        if isinstance(geocoded_reports, Path):
+            metrics.read_file(geocoded_reports)
+        metrics.add(
+            rows_in=total_keys,
+            cache_hits=total_keys - missing_weather_keys.height,
+            cache_misses=missing_weather_keys.height,
+        )
+        metrics.details["reused_weather_keys"] = reused_keys
+    limit_reached = False
+    remaining_calls = remaining_api_calls(weather_cache, limit)
+    if missing_weather_keys.is_empty():
+        logger.info("Nothing new to pull.")
+    elif remaining_calls == 0:
+        logger.info(f"All {limit} of today's billed days have been spent.")
+        limit_reached = True
     else:
-        logger.info("Combining new weather data with existing weather data.")
-        merge_new_records_with_weather_cache(
-            weather_cache_file, new_weather_data
-        ).write_csv(weather_cache_file)
+        logger.info(
+            f"Pulling missing weather data, {remaining_calls} of {limit} "
+            "billed days left today."
+        )
+
+        def save_weather_data(
+            weather_data: List[Dict[str, Any]], billed_days: int
+        ):
+            # One request's rows, and the days it was billed for.
+            insert_weather_data(weather_cache, weather_data)
+            record_api_calls(weather_cache, billed_days)
+
+        _, limit_reached = pull_missing_weather(
+            missing_weather_keys,
+            visual_crossing_key,
+            remaining_calls,
+            on_weather_data=save_weather_data,
+            metrics=metrics,
+            **pull_kwargs,
+        )
+    failed_keys, due_keys = weather_cache.execute(
+        """
+        SELECT COUNT(*), COUNT(*) FILTER (WHERE next_pull_date <= ?)
+        FROM weather_cache
+        WHERE data IS NULL
+        """,
+        [date.today()],
+    ).fetchone()
+    if failed_keys:
+        logger.info(f"{failed_keys} failed keys will be tried again later.")
+    if metrics is not None:
+        metrics.details["failed_weather_keys"] = failed_keys
+    if export_file is not None:
+        logger.info(f"Exporting weather cache to {export_file}.")
+        export_weather_cache(weather_cache, export_file)
+        if metrics is not None:
+            metrics.wrote_file(export_file)
+    return limit_reached or due_keys > 0
+
+
+def pull_weather_into_cache(
+    weather_cache_db: Path,
+    geocoded_reports_file: Path,
+    visual_crossing_key: str,
+    limit: int = 900,
+    export_file: Optional[Path] = None,
+    **pull_kwargs,
+) -> bool:
+    weather_cache = open_weather_cache(weather_cache_db, seed_file=export_file)
+    try:
+        return pull_weather_with_cache(
+            weather_cache,
+            geocoded_reports_file,
+            visual_crossing_key,
+            limit,
+            export_file,
+            **pull_kwargs,
+        )
+    finally:
+        weather_cache.close()
+
+
+def main(
+    weather_cache_file: Path,
+    geocoded_reports_file: Path,
+    limit: int = 900,
+    concurrency: int = 8,
+    requests_per_second: float = 5.0,
+    max_gap_days: int = 1,
+    max_span_days: int = 30,
+    reuse_resolution: Optional[int] = None,
+    reuse_k_ring: int = 0,
+    export_file: Optional[Path] = None,
+    report_file: Optional[Path] = None,
+):
+    # weather_cache_file can be a .duckdb database, in which case each
+    # response is saved as it arrives and the cache is exported to
+    # export_file for dbt. Otherwise it's a csv / parquet file, which is
+    # kept in a .duckdb database of the same name (seeded from it the
+    # first time, so that has the daily call ledger) and rewritten at the
+    # end of the pull.
+    logger.info(f"weather_cache_file: {weather_cache_file.name}")
+    logger.info(f"geocoded_reports_file: {geocoded_reports_file.name}")
+    logger.info(f"limit: {limit} billed days a day")
+    logger.info(f"concurrency: {concurrency}")
+    logger.info(f"requests_per_second: {requests_per_second}")
+    logger.info(f"max_gap_days: {max_gap_days}")
+    logger.info(f"max_span_days: {max_span_days}")
+    logger.info(f"reuse_resolution: {reuse_resolution}")
+    logger.info(f"reuse_k_ring: {reuse_k_ring}")
+    visual_crossing_key = get_visual_crossing_key_from_env()
+    if weather_cache_file.suffix != ".duckdb":
+        export_file = weather_cache_file
+        weather_cache_file = weather_cache_file.with_suffix(".duckdb")
+    with script_report("pull_weather", report_file) as metrics:
+        pull_weather_into_cache(
+            weather_cache_file,
+            geocoded_reports_file,
+            visual_crossing_key,
+            limit,
+            concurrency=concurrency,
+            requests_per_second=requests_per_second,
+            max_gap_days=max_gap_days,
+            max_span_days=max_span_days,
+            reuse_resolution=reuse_resolution,
+            reuse_k_ring=reuse_k_ring,
+            export_file=export_file,
+            metrics=metrics,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+import textwrap
+from pathlib import Path
+from typing import Dict, List, Union
+
+import pyarrow as pa
+import typer
+from loguru import logger
+
+# The scraped report columns, in file order: column name, DuckDB type, and
+# description. Everything that writes, reads or describes the report files
+# is generated from this - the scraper's parquet schema, the combine step's
+# reads and merge, the one-off migration of the original reports, and the
+# bfro_reports dbt source (run this file to regenerate it after changing
+# anything here).
+REPORT_FIELDS = [
+    (
+        "year",
+        "VARCHAR",
+        "The year the sighting took place. Sometimes approximate.",
+    ),
+    ("season", "VARCHAR", "The season the sighting took place."),
+    ("month", "VARCHAR", "The month the sighting occurred."),
+    (
+        "date",
+        "VARCHAR",
+        "The date the sighting occurred, as pretty much any format you can "
+        "think of. Highly non-uniform.",
+    ),
+    (
+        "state",
+        "VARCHAR",
+        "The name of the state in which the sighting occurred.",
+    ),
+    ("county", "VARCHAR", "The county in which the sighting occurred."),
+    (
+        "location_details",
+        "VARCHAR",
+        "Additional details about the location of the sighting.",
+    ),
+    ("nearest_town", "VARCHAR", "The nearest town to the sighting."),
+    ("nearest_road", "VARCHAR", "The nearest road to the sighting."),
+    ("observed", "VARCHAR", "The sighting description itself."),
+    (
+        "also_noticed",
+        "VARCHAR",
+        "Additional details pertinent to the sighting.",
+    ),
+    (
+        "other_witnesses",
+        "VARCHAR",
+        "Witnesses to the sighting besides the original reporter.",
+    ),
+    (
+        "other_stories",
+        "VARCHAR",
+        "Other stories related to the sighting at that location.",
+    ),
+    (
+        "time_and_conditions",
+        "VARCHAR",
+        "The time of day and natural language weather conditions for the "
+        "sighting.",
+    ),
+    (
+        "environment",
+        "VARCHAR",
+        "A natural language description of the environment and surrounding "
+        "area where the sighting occurred.",
+    ),
+    (
+        "report_number",
+        "BIGINT",
+        "The primary key identifier for each report.",
+    ),
+    (
+        "report_class",
+        "VARCHAR",
+        'The report classification. Either "Class A" - direct sighting, '
+        '"Class B" - indirect evidence (footprints, scat, etc), or '
+        '"Class C" - rumors and stories.',
+    ),
+    (
+        "a_&_g_references",
+        "VARCHAR",
+        "References to what look like external media, newspapers, etc. Null "
+        "for most of the reports.",
+    ),
+    ("pulled_datetime", "TIMESTAMP", "The datetime the record was scraped."),
+]
+
+REPORT_COLUMNS = [column for column, _, _ in REPORT_FIELDS]
+
+# The Arrow type for each DuckDB type used here.
+ARROW_TYPES = {
+    "VARCHAR": pa.string(),
+    "BIGINT": pa.int64(),
+    "DOUBLE": pa.float64(),
+    "TIMESTAMP": pa.timestamp("us"),
+}
+
+# What the scraper validates the reports against and writes to parquet.
+REPORT_SCHEMA = pa.schema(
+    [
+        (column, ARROW_TYPES[column_type])
+        for column, column_type, _ in REPORT_FIELDS
+    ]
+)
+
+# The columns extract_locations_from_kml.py writes, with their DuckDB types,
+# in file order. They match the geocoded_reports dbt source.
+GEOCODED_REPORT_FIELDS = [
+    ("number", "BIGINT"),
+    ("title", "VARCHAR"),
+    ("classification", "VARCHAR"),
+    ("timestamp", "VARCHAR"),
+    ("latitude", "DOUBLE"),
+    ("longitude", "DOUBLE"),
+    ("hexid", "VARCHAR"),
+    ("extraction_date", "VARCHAR"),
+]
+
+GEOCODED_REPORT_COLUMNS = [column for column, _ in GEOCODED_REPORT_FIELDS]
+
+# A report is identified by its number, and the latest pull of it wins.
+REPORT_KEY = "report_number"
+REPORT_VERSION = "pulled_datetime"
+
+# The dbt tests on the bfro_reports source columns.
+REPORT_TESTS: Dict[str, List[Union[str, Dict[str, List[str]]]]] = {
+    "season": [
+        {"accepted_values": ["Fall", "Winter", "Spring", "Summer", "Unknown"]},
+        "not_null",
+    ],
+    "state": ["not_null"],
+    "county": ["not_null"],
+    "report_number": ["not_null", "unique"],
+    "report_class": [
+        "not_null",
+        {"accepted_values": ["Class A", "Class B", "Class C"]},
+    ],
+    "pulled_datetime": ["not_null"],
+}
+
+
+def quote(column: str) -> str:
+    # Quotes the column names that aren't plain identifiers.
+    return column if column.replace("_", "").isalnum() else f'"{column}"'
+
+
+def select_list(prefix: str = "") -> str:
+    return ", ".join(f"{prefix}{quote(column)}" for column in REPORT_COLUMNS)
+
+
+def duckdb_columns() -> str:
+    # The columns={...} argument to DuckDB's read_csv / read_ndjson.
+    fields = ", ".join(
+        f"{quote(column)}: '{column_type}'"
+        for column, column_type, _ in REPORT_FIELDS
+    )
+    return f"{{{fields}}}"
+
+
+def read_reports(reports_file: Path) -> str:
+    # A DuckDB relation reading a reports file with the schema's types: the
+    # scraper's parquet output, the jsonlines feed, or a csv history (which
+    # is always written in REPORT_COLUMNS order). Parquet files are typed
+    # already, so only the columns that are used get read.
+    if reports_file.suffix == ".parquet":
+        return f"READ_PARQUET('{reports_file}')"
+    if reports_file.suffix == ".json":
+        return f"READ_NDJSON('{reports_file}', columns={duckdb_columns()})"
+    return (
+        f"READ_CSV('{reports_file}', header=true, columns={duckdb_columns()})"
+    )
+
+
+def _yaml_text(key: str, text: str, indent: int) -> List[str]:
+    # A description as a single line if it fits, folded otherwise.
+    pad = " " * indent
+    line = f"{pad}{key}: {text}"
+    if len(line) <= 85 and ": " not in text and not text.startswith('"'):
+        return [line]
+    return [f"{pad}{key}: >"] + textwrap.wrap(
+        text, 79, initial_indent=pad + "  ", subsequent_indent=pad + "  "
+    )
+
+
+def _yaml_tests(tests: List[Union[str, Dict[str, List[str]]]]) -> List[str]:
+    lines = ["            tests:"]
+    for test in tests:
+        if isinstance(test, str):
+            lines.append(f"              - {test}")
+        else:
+            ((name, values),) = test.items()
+            quoted = ", ".join(f"'{value}'" for value in values)
+            lines.append(f"              - {name}:")
+            lines.append(f"                  values: [{quoted}]")
+    return lines
+
+
+GENERATED_START = (
+    "      # Generated by pipeline/scripts/report_schema.py, edit it there."
+)
+GENERATED_END = "      # End of generated bfro_reports source."
+
+
+def dbt_source_yaml() -> str:
+    # The bfro_reports table entry in the local_files dbt source.
+    lines = [
+        GENERATED_START,
+        "      - name: bfro_reports",
+        "        description: Full text reports extracted from the BFRO site "
+        "via scrapy.",
+        "        columns:",
+    ]
+    for column, column_type, description in REPORT_FIELDS:
+        lines.append(f"          - name: {column}")
+        lines.append(f"            data_type: {column_type.lower()}")
+        lines.extend(_yaml_text("description", description, 12))
+        if column in REPORT_TESTS:
+            lines.extend(_yaml_tests(REPORT_TESTS[column]))
+    lines.append(GENERATED_END)
+    return "\n".join(lines) + "\n"
+
+
+def update_dbt_source(source_file: Path) -> bool:
+    # Replaces the generated block in the dbt source yml, returning whether
+    # it changed.
+    source = source_file.read_text()
+    start = source.index(GENERATED_START)
+    end = source.index(GENERATED_END) + len(GENERATED_END) + 1
+    updated = source[:start] + dbt_source_yaml() + source[end:]
+    if updated == source:
+        return False
+    source_file.write_text(updated)
+    return True
+
+
+DBT_SOURCE_FILE = (
+    Path(__file__).resolve().parent.parent
+    / "bfro_mini_warehouse"
+    / "models"
+    / "sources"
+    / "local_files.yml"
+)
+
+
+def main(source_file: Path = DBT_SOURCE_FILE, check: bool = False):
+    # With --check, fails if the dbt source is out of date instead of
+    # rewriting it.
+    if check:
+        source = source_file.read_text()
+        start = source.index(GENERATED_START)
+        if not source[start:].startswith(dbt_source_yaml()):
+            logger.error(f"{source_file} is out of date.")
+            raise typer.Exit(code=1)
+        logger.info(f"{source_file} is up to date.")
+    elif update_dbt_source(source_file):
+        logger.info(f"Updated {source_file}.")
+    else:
+        logger.info(f"{source_file} already up to date.")
+
+
+if __name__ == "__main__":
+    typer.run(main)
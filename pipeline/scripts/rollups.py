@@ -0,0 +1,91 @@
+import json
+import shutil
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import duckdb
+import h3
+import typer
+from loguru import logger
+
+# Readers for the rollups the dbt build writes to data/processed (see the
+# models in bfro_mini_warehouse/models/rollups). Each one is a directory of
+# hive partitions, so filtering on the partition column only opens that
+# partition's file and never touches the reports themselves.
+ROLLUP_PARTITIONS = {
+    "sightings_by_hex": "resolution",
+    "sightings_by_region": "state",
+}
+
+
+def rollup_dir(data_dir: Path, rollup: str) -> Path:
+    if rollup not in ROLLUP_PARTITIONS:
+        raise ValueError(f"Unknown rollup {rollup}.")
+    return data_dir / "processed" / rollup
+
+
+def clear_rollups(data_dir: Path):
+    # The export rewrites the partitions in place, so one that's no longer
+    # produced (a resolution dropped from rollup_resolutions, say) would
+    # otherwise stick around. Called before each build.
+    for rollup in ROLLUP_PARTITIONS:
+        shutil.rmtree(rollup_dir(data_dir, rollup), ignore_errors=True)
+
+
+def read_rollup(
+    data_dir: Path,
+    rollup: str,
+    con: Optional[duckdb.DuckDBPyConnection] = None,
+    **filters: Any,
+) -> duckdb.DuckDBPyRelation:
+    # Equality filters on any of the rollup's columns, e.g.
+    # read_rollup(data_dir, "sightings_by_hex", resolution=5).
+    if con is None:
+        con = duckdb.default_connection
+    files = rollup_dir(data_dir, rollup) / "*" / "*.parquet"
+    rollup_reports = con.read_parquet(str(files), hive_partitioning=True)
+    for column, value in filters.items():
+        rollup_reports = rollup_reports.filter(
+            duckdb.ColumnExpression(column) == duckdb.ConstantExpression(value)
+        )
+    return rollup_reports
+
+
+def hex_rollup_geojson(data_dir: Path, resolution: int) -> Dict[str, Any]:
+    # One resolution of sightings_by_hex as a GeoJSON feature collection of
+    # the cell outlines, ready for a heatmap layer.
+    cells = read_rollup(data_dir, "sightings_by_hex", resolution=resolution)
+    columns = cells.columns
+    features = []
+    for row in cells.fetchall():
+        properties = {
+            column: value.isoformat() if hasattr(value, "isoformat") else value
+            for column, value in zip(columns, row)
+        }
+        boundary = h3.h3_to_geo_boundary(properties["hexid"], geo_json=True)
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "Polygon", "coordinates": [boundary]},
+                "properties": properties,
+            }
+        )
+    return {"type": "FeatureCollection", "features": features}
+
+
+def main(
+    resolution: int,
+    geojson_file: Path,
+    data_dir: Path = Path("data"),
+):
+    # Writes one resolution of the hex rollup out as GeoJSON.
+    geojson = hex_rollup_geojson(data_dir, resolution)
+    logger.info(
+        f"Writing {len(geojson['features'])} cells to {geojson_file.name}."
+    )
+    with open(geojson_file, "w") as f:
+        json.dump(geojson, f)
+
+
+if __name__ == "__main__":
+    typer.run(main)
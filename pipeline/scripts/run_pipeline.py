@@ -0,0 +1,631 @@
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import duckdb
+import polars as pl
+import pyarrow as pa
+import requests
+import typer
+from loguru import logger
+
+from combine_geocoded_reports import (
+    read_geocoded_reports,
+    write_combined_geocoded_reports,
+)
+from combine_raw_reports import combine_raw_reports
+from extract_locations_from_kml import extract_geocoded_reports, open_kml
+from manifests import (
+    is_up_to_date,
+    load_manifest,
+    save_manifest,
+    stage_fingerprint,
+)
+from pull_weather import (
+    get_visual_crossing_key_from_env,
+    open_weather_cache,
+    pull_weather_with_cache,
+    weather_pull_pending,
+)
+from report_schema import read_reports
+from rollups import ROLLUP_PARTITIONS, clear_rollups
+from run_report import RunReport
+from spatial_index import build_index
+from storage import copy_to_file, write_frame
+from text_index import open_text_index, update_text_index
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+PIPELINE_DIR = SCRIPTS_DIR.parent
+KML_URL = "http://www.bfro.net/app/AllReportsKMZ.aspx"
+
+
+class LocalPipeline:
+    # Runs the pipeline stages in one process. The stages share a single
+    # DuckDB connection (the weather cache) and hand their results to each
+    # other as Arrow tables, so each file is read and written once per run.
+    # What's written is the state the next run starts from (data/raw), the
+    # dbt sources (data/sources), and, with checkpoints on, every stage's
+    # output in data/interim/checkpoints.
+    #
+    # Each stage is a method, run in order by run(), so they can also be
+    # run on their own from a notebook or another script. run() skips the
+    # stages whose inputs, parameters, and code haven't changed since their
+    # last successful run (see manifests.py), unless force is set. The crawl
+    # and KML download always run since there's no way to know what changed
+    # on the site without looking.
+    #
+    # Every stage is timed and counted in self.report, which is written to
+    # data/interim/run_reports at the end of a run (see run_report.py).
+
+    def __init__(
+        self,
+        data_dir: Path = PIPELINE_DIR / "data",
+        storage_format: str = "csv",
+        checkpoints: bool = False,
+        force: bool = False,
+    ):
+        if storage_format not in ("csv", "parquet"):
+            raise ValueError(f"Unknown storage format {storage_format}.")
+        self.data_dir = data_dir.resolve()
+        self.storage_format = storage_format
+        self.checkpoints = checkpoints
+        self.force = force
+        self.manifest_dir = self.data_dir / "interim" / "manifests"
+        self.report = RunReport("run_pipeline")
+        self.report_dir = self.data_dir / "interim" / "run_reports"
+        # The crawl's output and the KML download are always these.
+        self.new_reports_file = (
+            self.data_dir / "raw" / "reports" / "bfro_reports_new.parquet"
+        )
+        self.kmz_file = (
+            self.data_dir / "raw" / "geocoder" / "AllReportsKMZ.aspx"
+        )
+        self.weather_cache_db = (
+            self.data_dir / "raw" / "weather" / "weather_cache.duckdb"
+        )
+        self._convert_raw_files()
+        # A new cache is seeded from the last export, whichever format it's
+        # in.
+        seed_file = self._file("raw/weather/weather_cache")
+        if not seed_file.exists():
+            seed_file = self._other_format_file("raw/weather/weather_cache")
+        self.weather_cache = open_weather_cache(
+            self.weather_cache_db, seed_file=seed_file
+        )
+        self.reports: Optional[pa.Table] = None
+        self.new_geocoded_reports: Optional[pa.Table] = None
+        self.geocoded_reports: Optional[pa.Table] = None
+
+    def _file(self, name: str) -> Path:
+        return self.data_dir / f"{name}.{self.storage_format}"
+
+    def _other_format_file(self, name: str) -> Path:
+        other_format = "parquet" if self.storage_format == "csv" else "csv"
+        return self.data_dir / f"{name}.{other_format}"
+
+    def _convert_raw_files(self):
+        # The report histories in data/raw are what each run builds on. After
+        # switching storage formats they're still in the old one, so they're
+        # converted here, once, rather than the run taking them for a first
+        # run and dropping the reports that have since left the site.
+        con = duckdb.connect()
+        for name, read in [
+            ("raw/reports/bfro_reports", read_reports),
+            ("raw/geocoder/geocoded_reports", read_geocoded_reports),
+        ]:
+            raw_file = self._file(name)
+            other_file = self._other_format_file(name)
+            if raw_file.exists() or not other_file.exists():
+                continue
+            logger.info(f"Converting {other_file.name} to {raw_file.name}.")
+            copy_to_file(con, f"SELECT * FROM {read(other_file)}", raw_file)
+        con.close()
+
+    def _save(self, table: pa.Table, raw_name: str, source_name: str):
+        # Writes the new state into data/raw and hands dbt a copy.
+        raw_file = self._file(raw_name)
+        write_frame(pl.from_arrow(table), raw_file)
+        shutil.copyfile(raw_file, self._file(f"sources/{source_name}"))
+
+    def _checkpoint(self, table: pa.Table, name: str):
+        if self.checkpoints:
+            checkpoint_dir = self.data_dir / "interim" / "checkpoints"
+            checkpoint_dir.mkdir(parents=True, exist_ok=True)
+            logger.info(f"Checkpointing {name}.")
+            write_frame(
+                pl.from_arrow(table),
+                checkpoint_dir / f"{name}.{self.storage_format}",
+            )
+
+    def _checkpoint_file(self, file: Path, name: str):
+        # For the stages that write their output with DuckDB.
+        if self.checkpoints:
+            checkpoint_dir = self.data_dir / "interim" / "checkpoints"
+            checkpoint_dir.mkdir(parents=True, exist_ok=True)
+            logger.info(f"Checkpointing {name}.")
+            shutil.copyfile(
+                file, checkpoint_dir / f"{name}.{self.storage_format}"
+            )
+
+    def crawl_reports(
+        self,
+        test_run: str = "False",
+        incremental: str = "False",
+        resumable: bool = True,
+    ):
+        # Scrapy wants its own reactor, so the crawl stays a subprocess.
+        # The spider writes its own run report, which is folded into ours.
+        #
+        # A resumable crawl keeps its state in a scrapy JOBDIR (see
+        # CrawlStateExtension in the scraper) until it finishes with nothing
+        # left to fetch. If it doesn't, this raises and leaves the JOBDIR,
+        # and the next run picks the crawl up from there.
+        logger.info(
+            f"Pulling new reports, test_run={test_run} "
+            f"incremental={incremental}."
+        )
+        crawl_report_file = self.report_dir / "crawl_reports.json"
+        crawl_report_file.unlink(missing_ok=True)
+        job_dir = self.data_dir / "raw" / "reports" / "crawl_job"
+        job_args = {"test_run": test_run, "incremental": incremental}
+        job_args_file = job_dir / "crawl_args.json"
+        job_settings = []
+        if resumable:
+            if job_args_file.exists():
+                if json.loads(job_args_file.read_text()) == job_args:
+                    logger.info(f"Resuming the stopped crawl in {job_dir}.")
+                else:
+                    logger.info("Stopped crawl had other arguments, dropping.")
+                    shutil.rmtree(job_dir)
+            job_dir.mkdir(parents=True, exist_ok=True)
+            job_args_file.write_text(json.dumps(job_args))
+            job_settings = ["-s", f"JOBDIR={job_dir}"]
+        subprocess.run(
+            [
+                "scrapy",
+                "crawl",
+                "bfro_reports",
+                "-a",
+                f"test_run={test_run}",
+                "-a",
+                f"incremental={incremental}",
+                "-a",
+                f"reports_file={self._file('raw/reports/bfro_reports')}",
+                "-s",
+                f"CONDITIONAL_GET_CACHE_ENABLED={incremental}",
+                "-s",
+                "CONDITIONAL_GET_CACHE_DIR="
+                f"{self.data_dir / 'raw' / 'reports' / 'index_cache'}",
+                "-s",
+                f"REPORT_PARQUET_FILE={self.new_reports_file}",
+                "-s",
+                f"RUN_REPORT_FILE={crawl_report_file}",
+                *job_settings,
+            ],
+            cwd=PIPELINE_DIR / "scraper" / "bfro_scrape",
+            check=True,
+        )
+        self.report.add_stages(crawl_report_file)
+        if resumable:
+            (stage,) = json.loads(crawl_report_file.read_text())["stages"]
+            reason = stage["details"]["finish_reason"]
+            unfinished = stage["details"].get("crawl_state/unfinished", 0)
+            if reason != "finished" or unfinished:
+                raise RuntimeError(
+                    f"Crawl ended ({reason}) with {unfinished} requests "
+                    "left to fetch again, run again to resume it."
+                )
+            shutil.rmtree(job_dir)
+
+    def combine_raw_reports(self):
+        logger.info("Combining new reports with existing reports.")
+        with self.report.stage("combine_raw_reports") as metrics:
+            self.reports = combine_raw_reports(
+                self._file("raw/reports/bfro_reports"),
+                self.new_reports_file,
+                self.weather_cache,
+                metrics,
+            )
+            self._checkpoint(self.reports, "bfro_reports")
+            self._save(
+                self.reports, "raw/reports/bfro_reports", "bfro_reports"
+            )
+            metrics.add(rows_out=self.reports.num_rows)
+            metrics.wrote_file(self._file("raw/reports/bfro_reports"))
+
+    def download_kml(self):
+        logger.info("Pulling the kml file.")
+        with self.report.stage("download_kml") as metrics:
+            with requests.get(KML_URL, stream=True, timeout=300) as response:
+                response.raise_for_status()
+                with open(self.kmz_file, "wb") as kmz:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        kmz.write(chunk)
+            metrics.add(api_calls=1)
+            metrics.wrote_file(self.kmz_file)
+
+    def extract_geocoded_reports(self):
+        logger.info("Extracting geocoded reports.")
+        with self.report.stage("extract_geocoded_reports") as metrics:
+            metrics.read_file(self.kmz_file)
+            with open_kml(self.kmz_file) as kml_source:
+                self.new_geocoded_reports = extract_geocoded_reports(
+                    kml_source
+                ).to_arrow()
+            metrics.add(
+                rows_in=self.new_geocoded_reports.num_rows,
+                rows_out=self.new_geocoded_reports.num_rows,
+            )
+            self._checkpoint(self.new_geocoded_reports, "geocoded_reports_new")
+
+    def combine_geocoded_reports(self):
+        # Combines the newly extracted reports with any existing KML sourced
+        # reports, in case any are removed from the KML file.
+        logger.info("Combining geocoded reports.")
+        geocoded_reports_file = self._file("raw/geocoder/geocoded_reports")
+        with self.report.stage("combine_geocoded_reports") as metrics:
+            metrics.add(rows_in=self.new_geocoded_reports.num_rows)
+            if geocoded_reports_file.exists():
+                # Merged in DuckDB straight to the raw file, which the
+                # weather stage then reads instead of a table in memory.
+                metrics.read_file(geocoded_reports_file)
+                self.weather_cache.register(
+                    "new_geocoded_reports", self.new_geocoded_reports
+                )
+                try:
+                    rows = write_combined_geocoded_reports(
+                        geocoded_reports_file,
+                        "new_geocoded_reports",
+                        geocoded_reports_file,
+                        self.weather_cache,
+                    )
+                finally:
+                    self.weather_cache.unregister("new_geocoded_reports")
+                self.geocoded_reports = None
+                shutil.copyfile(
+                    geocoded_reports_file,
+                    self._file("sources/geocoded_reports"),
+                )
+                self._checkpoint_file(
+                    geocoded_reports_file, "geocoded_reports"
+                )
+            else:
+                self.geocoded_reports = self.new_geocoded_reports
+                self._checkpoint(self.geocoded_reports, "geocoded_reports")
+                self._save(
+                    self.geocoded_reports,
+                    "raw/geocoder/geocoded_reports",
+                    "geocoded_reports",
+                )
+                rows = self.geocoded_reports.num_rows
+            metrics.add(rows_out=rows)
+            metrics.wrote_file(geocoded_reports_file)
+
+    def pull_missing_weather(self, limit: int = 900, **pull_kwargs) -> bool:
+        # Returns whether the call limit was hit. If the geocoded reports
+        # stage was skipped they're read from its output instead.
+        logger.info("Pulling weather.")
+        geocoded_reports = self._file("raw/geocoder/geocoded_reports")
+        if self.geocoded_reports is not None:
+            self.weather_cache.register(
+                "geocoded_reports", self.geocoded_reports
+            )
+            geocoded_reports = "geocoded_reports"
+        weather_cache_file = self._file("raw/weather/weather_cache")
+        with self.report.stage("pull_weather") as metrics:
+            limit_reached = pull_weather_with_cache(
+                self.weather_cache,
+                geocoded_reports,
+                get_visual_crossing_key_from_env(),
+                limit,
+                export_file=weather_cache_file,
+                metrics=metrics,
+                **pull_kwargs,
+            )
+        if self.geocoded_reports is not None:
+            self.weather_cache.unregister("geocoded_reports")
+        # Writes everything to the database file, for the stage's
+        # fingerprint.
+        self.weather_cache.execute("CHECKPOINT")
+        shutil.copyfile(
+            weather_cache_file, self._file("sources/weather_cache")
+        )
+        return limit_reached
+
+    def build_warehouse(self):
+        # dbt runs in process too. It reads the sources written above.
+        from dbt.cli.main import dbtRunner
+
+        logger.info("Building mini warehouse.")
+        project_dir = PIPELINE_DIR / "bfro_mini_warehouse"
+        os.environ.setdefault(
+            "BFRO_WAREHOUSE_PATH",
+            str(self.data_dir / "interim" / "bfro_mini_warehouse.duckdb"),
+        )
+        with self.report.stage("build_warehouse") as metrics:
+            for source in [
+                "bfro_reports",
+                "geocoded_reports",
+                "weather_cache",
+            ]:
+                metrics.read_file(self._file(f"sources/{source}"))
+            clear_rollups(self.data_dir)
+            result = dbtRunner().invoke(
+                [
+                    "build",
+                    "--project-dir",
+                    str(project_dir),
+                    "--profiles-dir",
+                    str(project_dir),
+                    "--vars",
+                    json.dumps(
+                        {
+                            "data_dir": str(self.data_dir),
+                            "storage_format": self.storage_format,
+                        }
+                    ),
+                ]
+            )
+            if not result.success:
+                raise RuntimeError("dbt build failed.") from result.exception
+            # How long each model and test took, as dbt reports it.
+            for node_result in result.result or []:
+                metrics.details[node_result.node.name] = round(
+                    node_result.execution_time, 3
+                )
+            metrics.wrote_file(self._file("interim/weather"))
+            metrics.wrote_file(
+                self.data_dir / "processed" / "bfro_reports_geocoded.csv"
+            )
+            for rollup in ROLLUP_PARTITIONS:
+                for file in (self.data_dir / "processed" / rollup).rglob("*"):
+                    metrics.wrote_file(file)
+
+    def build_spatial_index(self):
+        logger.info("Building spatial index.")
+        reports_file = (
+            self.data_dir / "processed" / "bfro_reports_geocoded.csv"
+        )
+        index_dir = self.data_dir / "processed" / "spatial_index"
+        with self.report.stage("build_spatial_index") as metrics:
+            metrics.read_file(reports_file)
+            rows = build_index(reports_file, index_dir, con=self.weather_cache)
+            metrics.add(rows_out=rows)
+            for file in index_dir.rglob("*"):
+                metrics.wrote_file(file)
+
+    def build_text_index(self):
+        logger.info("Updating text index.")
+        reports_file = self._file("raw/reports/bfro_reports")
+        index_file = self.data_dir / "interim" / "text_index.duckdb"
+        with self.report.stage("build_text_index") as metrics:
+            con = open_text_index(index_file)
+            # The reports stage leaves its table behind when it ran.
+            if self.reports is not None:
+                con.register("reports", self.reports)
+                reports = "reports"
+            else:
+                metrics.read_file(reports_file)
+                reports = reports_file
+            changed = update_text_index(con, reports)
+            con.close()
+            metrics.add(rows_out=changed)
+            metrics.wrote_file(index_file)
+
+    def _run_stage(
+        self,
+        stage: str,
+        inputs: List[Path],
+        code: List[Path],
+        params: Dict[str, Any],
+        outputs: List[Path],
+        run_stage: Callable[[], Optional[bool]],
+        updates_inputs: bool = False,
+        pending: Optional[Callable[[], bool]] = None,
+    ):
+        # If run_stage returns True its outputs aren't final, so no manifest
+        # is saved and it runs again. A stage with pending work its inputs
+        # don't show (weather keys still to pull) decides that from pending()
+        # instead: it runs when nothing changed only if pending() is True,
+        # and its manifest is always saved. A stage that updates_inputs (the
+        # weather cache) is fingerprinted again after it runs, so what it
+        # wrote doesn't count as a change.
+        fingerprint = stage_fingerprint(
+            inputs, code, {"storage_format": self.storage_format, **params}
+        )
+        manifest = load_manifest(self.manifest_dir, stage)
+        if not self.force and is_up_to_date(manifest, fingerprint, outputs):
+            if pending is None or not pending():
+                logger.info(f"Nothing changed for {stage}, skipping.")
+                self.report.skipped(stage)
+                return
+            logger.info(f"Nothing changed for {stage}, but it has work left.")
+        if not run_stage() or pending is not None:
+            if updates_inputs:
+                fingerprint = stage_fingerprint(
+                    inputs,
+                    code,
+                    {"storage_format": self.storage_format, **params},
+                )
+            save_manifest(self.manifest_dir, stage, fingerprint, outputs)
+
+    def run(
+        self,
+        test_run: str = "False",
+        incremental: str = "False",
+        weather_limit: int = 900,
+        resumable_crawl: bool = True,
+        weather_reuse_resolution: Optional[int] = None,
+        weather_reuse_k_ring: int = 0,
+        **pull_kwargs,
+    ):
+        self.crawl_reports(test_run, incremental, resumable_crawl)
+        self._run_stage(
+            "reports",
+            inputs=[self.new_reports_file],
+            code=[
+                SCRIPTS_DIR / "combine_raw_reports.py",
+                SCRIPTS_DIR / "report_schema.py",
+            ],
+            params={},
+            outputs=[
+                self._file("raw/reports/bfro_reports"),
+                self._file("sources/bfro_reports"),
+            ],
+            run_stage=self.combine_raw_reports,
+        )
+        self._run_stage(
+            "text_index",
+            inputs=[self._file("raw/reports/bfro_reports")],
+            code=[
+                SCRIPTS_DIR / "text_index.py",
+                SCRIPTS_DIR / "report_schema.py",
+            ],
+            params={},
+            outputs=[self.data_dir / "interim" / "text_index.duckdb"],
+            run_stage=self.build_text_index,
+        )
+        self.download_kml()
+
+        def extract_and_combine_geocoded_reports():
+            self.extract_geocoded_reports()
+            self.combine_geocoded_reports()
+
+        self._run_stage(
+            "geocoded_reports",
+            inputs=[self.kmz_file],
+            code=[
+                SCRIPTS_DIR / "extract_locations_from_kml.py",
+                SCRIPTS_DIR / "combine_geocoded_reports.py",
+                SCRIPTS_DIR / "report_schema.py",
+            ],
+            params={},
+            outputs=[
+                self._file("raw/geocoder/geocoded_reports"),
+                self._file("sources/geocoded_reports"),
+            ],
+            run_stage=extract_and_combine_geocoded_reports,
+        )
+        # The pull also depends on the cache itself. Keys it couldn't pull
+        # for the daily limit, and failed pulls that come due again, don't
+        # change either, so it also runs when there are keys to pull and
+        # billed days left today to pull them with.
+        self._run_stage(
+            "weather",
+            inputs=[
+                self._file("raw/geocoder/geocoded_reports"),
+                self.weather_cache_db,
+            ],
+            code=[SCRIPTS_DIR / "pull_weather.py"],
+            params={
+                "weather_limit": weather_limit,
+                "weather_reuse_resolution": weather_reuse_resolution,
+                "weather_reuse_k_ring": weather_reuse_k_ring,
+            },
+            outputs=[
+                self._file("raw/weather/weather_cache"),
+                self._file("sources/weather_cache"),
+            ],
+            run_stage=lambda: self.pull_missing_weather(
+                weather_limit,
+                reuse_resolution=weather_reuse_resolution,
+                reuse_k_ring=weather_reuse_k_ring,
+                **pull_kwargs,
+            ),
+            updates_inputs=True,
+            pending=lambda: weather_pull_pending(
+                self.weather_cache,
+                self._file("raw/geocoder/geocoded_reports"),
+                weather_limit,
+            ),
+        )
+        project_dir = PIPELINE_DIR / "bfro_mini_warehouse"
+        self._run_stage(
+            "warehouse",
+            inputs=[
+                self._file("sources/bfro_reports"),
+                self._file("sources/geocoded_reports"),
+                self._file("sources/weather_cache"),
+            ],
+            code=[
+                file
+                for pattern in ["*.yml", "models/**/*", "macros/**/*"]
+                for file in project_dir.glob(pattern)
+                if file.is_file()
+            ],
+            params={},
+            outputs=[
+                self._file("interim/weather"),
+                self.data_dir / "processed" / "bfro_reports_geocoded.csv",
+                *[
+                    self.data_dir / "processed" / rollup
+                    for rollup in ROLLUP_PARTITIONS
+                ],
+            ],
+            run_stage=self.build_warehouse,
+        )
+        self._run_stage(
+            "spatial_index",
+            inputs=[self.data_dir / "processed" / "bfro_reports_geocoded.csv"],
+            code=[SCRIPTS_DIR / "spatial_index.py"],
+            params={},
+            outputs=[self.data_dir / "processed" / "spatial_index"],
+            run_stage=self.build_spatial_index,
+        )
+
+    def write_report(self, report_file: Optional[Path] = None):
+        if report_file is None:
+            report_file = (
+                self.report_dir
+                / f"run_{self.report.started:%Y%m%dT%H%M%S}.json"
+            )
+        self.report.write(report_file)
+
+    def close(self):
+        self.weather_cache.close()
+
+
+def main(
+    test_run: str = "False",
+    incremental: str = "False",
+    storage_format: str = "csv",
+    checkpoints: bool = False,
+    force: bool = False,
+    data_dir: Path = PIPELINE_DIR / "data",
+    weather_limit: int = 900,
+    resumable_crawl: bool = True,
+    weather_reuse_resolution: Optional[int] = None,
+    weather_reuse_k_ring: int = 0,
+    concurrency: int = 8,
+    requests_per_second: float = 5.0,
+    report_file: Optional[Path] = None,
+):
+    # Run from anywhere:
+    #   python pipeline/scripts/run_pipeline.py --test-run True
+    # The run report goes to report_file, or data/interim/run_reports.
+    logger.info(f"storage_format: {storage_format}")
+    logger.info(f"checkpoints: {checkpoints}")
+    logger.info(f"force: {force}")
+    pipeline = LocalPipeline(data_dir, storage_format, checkpoints, force)
+    try:
+        pipeline.run(
+            test_run,
+            incremental,
+            weather_limit,
+            resumable_crawl,
+            weather_reuse_resolution,
+            weather_reuse_k_ring,
+            concurrency=concurrency,
+            requests_per_second=requests_per_second,
+        )
+    finally:
+        pipeline.write_report(report_file)
+        pipeline.close()
+    logger.info("👣 all done 👣")
+
+
+if __name__ == "__main__":
+    typer.run(main)
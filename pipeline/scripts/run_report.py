@@ -0,0 +1,231 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import typer
+from loguru import logger
+
+# Lightweight per-stage instrumentation. Each stage records its wall and CPU
+# time, peak RSS, rows in / out, bytes read / written, API calls, and cache
+# hits / misses, and the stages of a run are written out together as a JSON
+# run report. Run this file to compare two reports:
+#
+#   python scripts/run_report.py old_report.json new_report.json
+#
+# The spider writes the same format from bfro_scrape/extensions.py.
+
+COUNTERS = [
+    "rows_in",
+    "rows_out",
+    "bytes_read",
+    "bytes_written",
+    "api_calls",
+    "cache_hits",
+    "cache_misses",
+]
+
+
+def _reset_peak_rss() -> bool:
+    # Linux lets a process reset its high water mark, which makes the peak
+    # per stage rather than per process.
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageMetrics:
+    # The counters for one stage. add() is thread safe, since the weather
+    # pull counts API calls from its fetch threads.
+    def __init__(self, name: str):
+        self.name = name
+        self.counters: Dict[str, int] = {counter: 0 for counter in COUNTERS}
+        self.details: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def add(self, **counts: int):
+        with self.lock:
+            for counter, count in counts.items():
+                self.counters[counter] += count
+
+    def read_file(self, file: Path):
+        if file.exists():
+            self.add(bytes_read=file.stat().st_size)
+
+    def wrote_file(self, file: Path):
+        if file.exists():
+            self.add(bytes_written=file.stat().st_size)
+
+
+def stage_record(
+    metrics: StageMetrics,
+    wall_seconds: float,
+    cpu_seconds: float,
+    peak_rss_bytes: int,
+) -> Dict[str, Any]:
+    lookups = metrics.counters["cache_hits"] + metrics.counters["cache_misses"]
+    return {
+        "name": metrics.name,
+        "wall_seconds": round(wall_seconds, 3),
+        "cpu_seconds": round(cpu_seconds, 3),
+        "peak_rss_bytes": peak_rss_bytes,
+        **metrics.counters,
+        "cache_hit_rate": (
+            round(metrics.counters["cache_hits"] / lookups, 4)
+            if lookups
+            else None
+        ),
+        **({"details": metrics.details} if metrics.details else {}),
+    }
+
+
+class RunReport:
+    def __init__(self, name: str):
+        self.name = name
+        self.started = datetime.now()
+        self.stages: List[Dict[str, Any]] = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        metrics = StageMetrics(name)
+        per_stage_rss = _reset_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield metrics
+        finally:
+            record = stage_record(
+                metrics,
+                time.perf_counter() - wall_start,
+                time.process_time() - cpu_start,
+                _peak_rss_bytes(),
+            )
+            if not per_stage_rss:
+                record["peak_rss_is_process_peak"] = True
+            self.stages.append(record)
+            logger.info(
+                f"{name}: {record['wall_seconds']}s wall, "
+                f"{record['cpu_seconds']}s cpu, "
+                f"{record['peak_rss_bytes'] / 2**20:.0f}MB peak rss, "
+                f"{record['rows_in']} rows in, {record['rows_out']} rows out."
+            )
+
+    def skipped(self, name: str):
+        self.stages.append({"name": name, "skipped": True})
+
+    def add_stages(self, report_file: Path):
+        # Pulls in the stages from another process's report (the crawl).
+        if report_file.exists():
+            self.stages.extend(json.loads(report_file.read_text())["stages"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "started": self.started.isoformat(timespec="seconds"),
+            "pid": os.getpid(),
+            "stages": self.stages,
+        }
+
+    def write(self, report_file: Path):
+        report_file.parent.mkdir(parents=True, exist_ok=True)
+        report_file.write_text(json.dumps(self.to_dict(), indent=2))
+        logger.info(f"Wrote run report to {report_file}.")
+
+
+@contextmanager
+def script_report(
+    name: str, report_file: Optional[Path] = None
+) -> Iterator[StageMetrics]:
+    # For the standalone scripts: a run report with a single stage, written
+    # to report_file if there is one.
+    report = RunReport(name)
+    with report.stage(name) as metrics:
+        yield metrics
+    if report_file is not None:
+        report.write(report_file)
+
+
+# A stage regresses when a metric grows by more than the threshold, and by
+# more than these absolute amounts so tiny stages don't flap.
+REGRESSION_FLOORS = {
+    "wall_seconds": 1.0,
+    "cpu_seconds": 1.0,
+    "peak_rss_bytes": 50 * 2**20,
+    "bytes_read": 10 * 2**20,
+    "bytes_written": 10 * 2**20,
+    "api_calls": 10,
+}
+
+
+def compare_reports(
+    old_report: Dict[str, Any],
+    new_report: Dict[str, Any],
+    threshold: float = 0.2,
+) -> List[str]:
+    # Returns a description of each regression.
+    old_stages = {
+        stage["name"]: stage
+        for stage in old_report["stages"]
+        if not stage.get("skipped")
+    }
+    regressions = []
+    for stage in new_report["stages"]:
+        old_stage = old_stages.get(stage["name"])
+        if old_stage is None or stage.get("skipped"):
+            continue
+        for metric, floor in REGRESSION_FLOORS.items():
+            old_value = old_stage.get(metric) or 0
+            new_value = stage.get(metric) or 0
+            grew = new_value - old_value
+            if grew > floor and grew > old_value * threshold:
+                regressions.append(
+                    f"{stage['name']} {metric}: {old_value} -> {new_value}"
+                )
+        old_rate = old_stage.get("cache_hit_rate")
+        new_rate = stage.get("cache_hit_rate")
+        if (
+            old_rate is not None
+            and new_rate is not None
+            and old_rate - new_rate > threshold
+        ):
+            regressions.append(
+                f"{stage['name']} cache_hit_rate: {old_rate} -> {new_rate}"
+            )
+    return regressions
+
+
+def main(old_report_file: Path, new_report_file: Path, threshold: float = 0.2):
+    regressions = compare_reports(
+        json.loads(old_report_file.read_text()),
+        json.loads(new_report_file.read_text()),
+        threshold,
+    )
+    for regression in regressions:
+        logger.warning(f"Regression: {regression}")
+    if regressions:
+        raise typer.Exit(code=1)
+    logger.info("No regressions.")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,440 @@
+import json
+import math
+import shutil
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import duckdb
+import h3
+import pyarrow as pa
+import typer
+from loguru import logger
+
+# A spatial and temporal index over the geocoded reports, for questions like
+# "Class A reports within 50km of here between 1990 and 2000" without reading
+# the whole of bfro_reports_geocoded.csv.
+#
+# The index is the located reports rewritten as parquet, hive partitioned by
+# their H3 cell at a coarse resolution (cell=<hexid>/data_0.parquet) and
+# sorted by sighting date within each cell. A query works out which cells
+# could hold a match from the geometry alone, opens only those partitions,
+# and does the exact distance / box / date filtering on what's in them.
+# Reports without a location aren't in the index.
+INDEX_RESOLUTION = 2
+INDEX_METADATA = "index.json"
+EARTH_RADIUS_KM = 6371.0088
+
+app = typer.Typer()
+
+
+def _index_cells(
+    hexids: Iterable[str], resolution: int
+) -> Dict[str, List[str]]:
+    cells = {"hexid": [], "cell": []}
+    for hexid in hexids:
+        cells["hexid"].append(hexid)
+        cells["cell"].append(h3.h3_to_parent(hexid, resolution))
+    return cells
+
+
+def build_index(
+    reports_file: Path,
+    index_dir: Path,
+    resolution: int = INDEX_RESOLUTION,
+    con: Optional[duckdb.DuckDBPyConnection] = None,
+) -> int:
+    # Rebuilds the index from the reports file (csv or parquet), returning
+    # the number of reports in it. It's written next to index_dir and
+    # swapped in at the end, so queries never see half an index.
+    if con is None:
+        con = duckdb.default_connection
+    hexids = [
+        hexid
+        for (hexid,) in con.sql(
+            f"SELECT DISTINCT hexid FROM '{reports_file}' "
+            "WHERE hexid IS NOT NULL"
+        ).fetchall()
+    ]
+    index_cells = _index_cells(hexids, resolution)
+    # Typed, so the cell column is still a string with no reports.
+    con.register(
+        "index_cells",
+        pa.table(
+            index_cells,
+            schema=pa.schema([("hexid", pa.string()), ("cell", pa.string())]),
+        ),
+    )
+    tmp_dir = index_dir.with_name(index_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    indexed_reports = f"""
+        SELECT
+            reports.*,
+            TRY_CAST(reports.date AS DATE) AS sighting_date,
+            index_cells.cell
+        FROM '{reports_file}' AS reports
+        INNER JOIN index_cells
+            ON reports.hexid = index_cells.hexid
+        ORDER BY index_cells.cell, sighting_date
+    """
+    try:
+        # Kept in the metadata, for queries of an index with no reports.
+        columns = [
+            (column, column_type)
+            for column, column_type, *_ in con.sql(
+                f"DESCRIBE {indexed_reports}"
+            ).fetchall()
+        ]
+        con.execute(
+            f"""
+            COPY ({indexed_reports}) TO '{tmp_dir}'
+            (
+                FORMAT PARQUET,
+                COMPRESSION ZSTD,
+                PARTITION_BY (cell),
+                OVERWRITE_OR_IGNORE true
+            )
+            """
+        )
+    finally:
+        con.unregister("index_cells")
+    # A partitioned COPY doesn't report its row count, and writes no files
+    # at all for no reports.
+    rows = 0
+    if any(tmp_dir.glob("*/*.parquet")):
+        (rows,) = con.sql(
+            f"SELECT COUNT(*) FROM READ_PARQUET('{tmp_dir}/*/*.parquet')"
+        ).fetchone()
+    with open(tmp_dir / INDEX_METADATA, "w") as f:
+        json.dump(
+            {
+                "resolution": resolution,
+                "reports": rows,
+                "columns": columns,
+                "cells": len(set(index_cells["cell"])),
+                "source": str(reports_file),
+                "built": datetime.now().isoformat(timespec="seconds"),
+            },
+            f,
+            indent=2,
+        )
+    shutil.rmtree(index_dir, ignore_errors=True)
+    tmp_dir.rename(index_dir)
+    return rows
+
+
+def load_index_metadata(index_dir: Path) -> Dict:
+    metadata_file = index_dir / INDEX_METADATA
+    if not metadata_file.exists():
+        raise FileNotFoundError(
+            f"No index in {index_dir}, build it with spatial_index.py build."
+        )
+    with open(metadata_file, "r") as f:
+        return json.load(f)
+
+
+def _sample_line(
+    start: Tuple[float, float], end: Tuple[float, float], spacing_km: float
+) -> List[Tuple[float, float]]:
+    # Points along a (short, so treated as flat) segment, no further apart
+    # than spacing_km.
+    steps = max(1, math.ceil(_distance_km(*start, *end) / spacing_km))
+    return [
+        (
+            start[0] + (end[0] - start[0]) * step / steps,
+            start[1] + (end[1] - start[1]) * step / steps,
+        )
+        for step in range(steps + 1)
+    ]
+
+
+def covering_cells(
+    boundary: List[Tuple[float, float]], resolution: int
+) -> Set[str]:
+    # The cells that could overlap a polygon given as (latitude, longitude)
+    # points. polyfill only has the cells whose centers are inside, so the
+    # cells along the boundary, and their neighbours, are added too. The
+    # boundary is sampled at a quarter of the average edge length (the cells
+    # vary in size across the globe), so a cell the boundary only clips the
+    # corner of is next to one a sample falls in.
+    spacing_km = h3.edge_length(resolution, unit="km") / 4
+    cells = set(
+        h3.polyfill(
+            {
+                "type": "Polygon",
+                "coordinates": [
+                    [(lon, lat) for lat, lon in boundary + boundary[:1]]
+                ],
+            },
+            resolution,
+            geo_json_conformant=True,
+        )
+    )
+    for start, end in zip(boundary, boundary[1:] + boundary[:1]):
+        for latitude, longitude in _sample_line(start, end, spacing_km):
+            cells.update(
+                h3.k_ring(h3.geo_to_h3(latitude, longitude, resolution), 1)
+            )
+    return cells
+
+
+def _distance_km(
+    latitude1: float, longitude1: float, latitude2: float, longitude2: float
+) -> float:
+    # Haversine.
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1)
+        * math.cos(phi2)
+        * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _distance_sql(latitude: float, longitude: float) -> str:
+    # The same, from each report to the given point.
+    return f"""
+        2 * {EARTH_RADIUS_KM} * ASIN(SQRT(
+            POW(SIN(RADIANS(latitude - {latitude}) / 2), 2)
+            + COS(RADIANS({latitude})) * COS(RADIANS(latitude))
+            * POW(SIN(RADIANS(longitude - {longitude}) / 2), 2)
+        ))
+    """
+
+
+def radius_cells(
+    latitude: float, longitude: float, radius_km: float, resolution: int
+) -> Set[str]:
+    # The circle as a polygon of points radius_km from the center.
+    phi, lam = math.radians(latitude), math.radians(longitude)
+    delta = radius_km / EARTH_RADIUS_KM
+    circumference_km = 2 * math.pi * radius_km
+    num_points = max(
+        16, math.ceil(circumference_km / h3.edge_length(resolution, "km"))
+    )
+    boundary = []
+    for point in range(num_points):
+        bearing = 2 * math.pi * point / num_points
+        phi2 = math.asin(
+            math.sin(phi) * math.cos(delta)
+            + math.cos(phi) * math.sin(delta) * math.cos(bearing)
+        )
+        lam2 = lam + math.atan2(
+            math.sin(bearing) * math.sin(delta) * math.cos(phi),
+            math.cos(delta) - math.sin(phi) * math.sin(phi2),
+        )
+        boundary.append((math.degrees(phi2), math.degrees(lam2)))
+    return covering_cells(boundary, resolution) | {
+        h3.geo_to_h3(latitude, longitude, resolution)
+    }
+
+
+def bbox_cells(
+    min_latitude: float,
+    min_longitude: float,
+    max_latitude: float,
+    max_longitude: float,
+    resolution: int,
+) -> Set[str]:
+    return covering_cells(
+        [
+            (min_latitude, min_longitude),
+            (min_latitude, max_longitude),
+            (max_latitude, max_longitude),
+            (max_latitude, min_longitude),
+        ],
+        resolution,
+    )
+
+
+def query_index(
+    index_dir: Path,
+    cells: Optional[Set[str]] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    classification: Optional[str] = None,
+    where: Optional[str] = None,
+    con: Optional[duckdb.DuckDBPyConnection] = None,
+) -> duckdb.DuckDBPyRelation:
+    # The reports in the given cells (all of them if None) whose sighting
+    # date is between start and end, inclusive. Reports whose date doesn't
+    # parse are left out of any time range query.
+    if con is None:
+        con = duckdb.default_connection
+    metadata = load_index_metadata(index_dir)
+    if cells is None:
+        files = sorted(index_dir.glob("cell=*/*.parquet"))
+    else:
+        files = sorted(
+            file
+            for cell in cells
+            for file in (index_dir / f"cell={cell}").glob("*.parquet")
+        )
+    if not files:
+        # Nothing to read, but the result still needs the index's columns.
+        files = sorted(index_dir.glob("cell=*/*.parquet"))[:1]
+        where = "false"
+    if not files:
+        # The index has no reports at all, so the columns come from its
+        # metadata.
+        columns = ", ".join(
+            f'NULL::{column_type} AS "{column}"'
+            for column, column_type in metadata["columns"]
+        )
+        return con.sql(f"SELECT {columns} LIMIT 0")
+    reports = con.read_parquet(
+        [str(file) for file in files], hive_partitioning=True
+    )
+    conditions = []
+    if start is not None:
+        conditions.append(f"sighting_date >= DATE '{start:%Y-%m-%d}'")
+    if end is not None:
+        conditions.append(f"sighting_date <= DATE '{end:%Y-%m-%d}'")
+    if classification is not None:
+        classification = classification.replace("'", "''")
+        conditions.append(f"classification = '{classification}'")
+    if where is not None:
+        conditions.append(where)
+    if conditions:
+        reports = reports.filter(" AND ".join(conditions))
+    return reports
+
+
+def query_radius(
+    index_dir: Path,
+    latitude: float,
+    longitude: float,
+    radius_km: float,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    classification: Optional[str] = None,
+    con: Optional[duckdb.DuckDBPyConnection] = None,
+) -> duckdb.DuckDBPyRelation:
+    # Nearest first, with the distance in distance_km.
+    resolution = load_index_metadata(index_dir)["resolution"]
+    distance = _distance_sql(latitude, longitude)
+    return (
+        query_index(
+            index_dir,
+            radius_cells(latitude, longitude, radius_km, resolution),
+            start,
+            end,
+            classification,
+            where=f"{distance} <= {radius_km}",
+            con=con,
+        )
+        .project(f"*, {distance} AS distance_km")
+        .order("distance_km")
+    )
+
+
+def query_bbox(
+    index_dir: Path,
+    min_latitude: float,
+    min_longitude: float,
+    max_latitude: float,
+    max_longitude: float,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    classification: Optional[str] = None,
+    con: Optional[duckdb.DuckDBPyConnection] = None,
+) -> duckdb.DuckDBPyRelation:
+    resolution = load_index_metadata(index_dir)["resolution"]
+    return query_index(
+        index_dir,
+        bbox_cells(
+            min_latitude,
+            min_longitude,
+            max_latitude,
+            max_longitude,
+            resolution,
+        ),
+        start,
+        end,
+        classification,
+        where=(
+            f"latitude BETWEEN {min_latitude} AND {max_latitude} AND "
+            f"longitude BETWEEN {min_longitude} AND {max_longitude}"
+        ),
+        con=con,
+    ).order("sighting_date")
+
+
+def _write_results(reports: duckdb.DuckDBPyRelation, output: Optional[Path]):
+    # To a csv file, or a summary of the first few to the terminal.
+    if output is None:
+        reports.project(
+            "number, classification, sighting_date, latitude, longitude, title"
+        ).show()
+    else:
+        reports.write_csv(str(output), header=True)
+        logger.info(f"Wrote results to {output}.")
+
+
+@app.command()
+def build(
+    reports_file: Path = Path("data/processed/bfro_reports_geocoded.csv"),
+    index_dir: Path = Path("data/processed/spatial_index"),
+    resolution: int = INDEX_RESOLUTION,
+):
+    logger.info(f"Indexing {reports_file.name} at resolution {resolution}.")
+    rows = build_index(reports_file, index_dir, resolution)
+    logger.info(f"Indexed {rows} reports in {index_dir}.")
+
+
+@app.command()
+def radius(
+    latitude: float = typer.Option(...),
+    longitude: float = typer.Option(...),
+    radius_km: float = typer.Option(...),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    classification: Optional[str] = None,
+    index_dir: Path = Path("data/processed/spatial_index"),
+    output: Optional[Path] = None,
+):
+    _write_results(
+        query_radius(
+            index_dir,
+            latitude,
+            longitude,
+            radius_km,
+            start,
+            end,
+            classification,
+        ),
+        output,
+    )
+
+
+@app.command()
+def bbox(
+    min_latitude: float = typer.Option(...),
+    min_longitude: float = typer.Option(...),
+    max_latitude: float = typer.Option(...),
+    max_longitude: float = typer.Option(...),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    classification: Optional[str] = None,
+    index_dir: Path = Path("data/processed/spatial_index"),
+    output: Optional[Path] = None,
+):
+    _write_results(
+        query_bbox(
+            index_dir,
+            min_latitude,
+            min_longitude,
+            max_latitude,
+            max_longitude,
+            start,
+            end,
+            classification,
+        ),
+        output,
+    )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,39 @@
+import duckdb
+import polars as pl
+from pathlib import Path
+
+# Intermediate files can be either CSV or zstd compressed parquet. The format
+# is picked from the file extension, so the scripts just pass paths around.
+
+
+def read_frame(file: Path) -> pl.DataFrame:
+    if file.suffix == ".parquet":
+        return pl.read_parquet(file)
+    return pl.read_csv(file)
+
+
+def write_frame(frame: pl.DataFrame, file: Path):
+    if file.suffix == ".parquet":
+        frame.write_parquet(file, compression="zstd")
+    else:
+        frame.write_csv(file)
+
+
+def copy_to_file(
+    con: duckdb.DuckDBPyConnection, query: str, file: Path
+) -> int:
+    # Streams a DuckDB query straight into a file, without pulling the
+    # result into Python. It's written to a temporary file and moved into
+    # place so a failed write doesn't leave a partial one. Returns the
+    # number of rows written.
+    options = (
+        "FORMAT PARQUET, COMPRESSION ZSTD"
+        if file.suffix == ".parquet"
+        else "FORMAT CSV, HEADER"
+    )
+    tmp_file = file.with_name(file.name + ".tmp")
+    (rows,) = con.execute(
+        f"COPY ({query}) TO '{tmp_file}' ({options})"
+    ).fetchone()
+    tmp_file.replace(file)
+    return rows
@@ -0,0 +1,450 @@
+import re
+import time
+from pathlib import Path
+from typing import List, Union
+
+import duckdb
+import polars as pl
+import typer
+from loguru import logger
+
+from report_schema import REPORT_KEY, REPORT_VERSION, read_reports
+
+# A BM25 full text index over the report narratives, kept in its own DuckDB
+# file. It's the same layout DuckDB's fts extension builds (a postings table
+# of term, document and term count, plus the document lengths) but kept up
+# to date report by report: each update only tokenizes the reports that are
+# new or were pulled again since they were indexed. The fts extension can
+# only rebuild its index from scratch, and has to be downloaded.
+#
+# The narratives are stored in the index too, so a search never goes back to
+# the reports file.
+TEXT_FIELDS = [
+    "observed",
+    "also_noticed",
+    "environment",
+    "time_and_conditions",
+    "location_details",
+]
+
+# Bumped whenever the fields or the tokenizer change, which rebuilds the
+# index on the next update.
+INDEX_VERSION = 1
+
+# The share of the reports that can have their postings out of order before
+# an update sorts them again.
+RESORT_FRACTION = 0.1
+
+# BM25 parameters, the usual defaults.
+K1 = 1.2
+B = 0.75
+
+STOPWORDS = [
+    "a", "about", "after", "all", "also", "an", "and", "any", "are", "as",
+    "at", "be", "been", "but", "by", "can", "could", "did", "do", "for",
+    "from", "had", "has", "have", "he", "her", "him", "his", "i", "if", "in",
+    "into", "is", "it", "its", "me", "my", "no", "not", "of", "on", "or",
+    "our", "out", "she", "so", "that", "the", "their", "them", "then",
+    "there", "they", "this", "to", "up", "was", "we", "were", "what", "when",
+    "which", "while", "who", "with", "would", "you", "your",
+]  # fmt: skip
+
+# Words ending in these keep their s ("grass", "campus", "this").
+SKIP_S = ("ss", "us", "is")
+
+app = typer.Typer()
+
+
+def _create_tokenizer(con: duckdb.DuckDBPyConnection):
+    # See _terms_sql. Plurals are cut back ("footprints" -> "footprint",
+    # "bodies" -> "body") so a search for either finds both.
+    con.execute(
+        f"""
+        CREATE OR REPLACE TEMP MACRO bfro_term(word) AS CASE
+            WHEN LENGTH(word) > 4 AND word LIKE '%ies'
+                THEN LEFT(word, LENGTH(word) - 3) || 'y'
+            WHEN LENGTH(word) > 3 AND word LIKE '%s'
+                AND RIGHT(word, 2) NOT IN {SKIP_S}
+                THEN LEFT(word, LENGTH(word) - 1)
+            ELSE word
+        END
+        """
+    )
+    con.execute("CREATE OR REPLACE TEMP TABLE stopwords (word VARCHAR)")
+    con.executemany(
+        "INSERT INTO stopwords VALUES (?)", [[word] for word in STOPWORDS]
+    )
+
+
+def _terms_sql(source: str, key: str, text: str) -> str:
+    # The terms in each row of source, one row per occurrence: lower case
+    # alphanumeric words, minus the stopwords and single characters, through
+    # bfro_term. The same query tokenizes the reports and the searches.
+    return f"""
+        SELECT words.{key}, bfro_term(words.word) AS term
+        FROM (
+            SELECT
+                {key},
+                UNNEST(REGEXP_EXTRACT_ALL(LOWER({text}), '[a-z0-9]+'))
+                    AS word
+            FROM {source}
+        ) AS words
+        ANTI JOIN stopwords ON words.word = stopwords.word
+        WHERE LENGTH(words.word) > 1
+    """
+
+
+def open_text_index(index_file: Path) -> duckdb.DuckDBPyConnection:
+    # Creates the index tables if they aren't there, and empties them if
+    # they were built by a different version of this script.
+    con = duckdb.connect(str(index_file))
+    _create_tokenizer(con)
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS text_index (
+            version INTEGER, unsorted_reports INTEGER
+        )
+        """
+    )
+    (indexed_version,) = con.sql(
+        "SELECT MAX(version) FROM text_index"
+    ).fetchone()
+    if indexed_version != INDEX_VERSION:
+        if indexed_version is not None:
+            logger.info("Text index is out of date, rebuilding it.")
+        for table in ["documents", "postings", "terms"]:
+            con.execute(f"DROP TABLE IF EXISTS {table}")
+        con.execute("DELETE FROM text_index")
+        con.execute("INSERT INTO text_index VALUES (?, 0)", [INDEX_VERSION])
+    fields = ",\n".join(f"{field} VARCHAR" for field in TEXT_FIELDS)
+    con.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS documents (
+            {REPORT_KEY} BIGINT,
+            {REPORT_VERSION} TIMESTAMP,
+            length INTEGER,
+            {fields}
+        )
+        """
+    )
+    con.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS postings (
+            term VARCHAR,
+            {REPORT_KEY} BIGINT,
+            tf INTEGER,
+            length INTEGER
+        )
+        """
+    )
+    con.execute("CREATE TABLE IF NOT EXISTS terms (term VARCHAR, df INTEGER)")
+    return con
+
+
+def _count_unsorted_reports(con: duckdb.DuckDBPyConnection):
+    con.execute(
+        """
+        UPDATE text_index
+        SET unsorted_reports = unsorted_reports
+            + (SELECT COUNT(*) FROM changed_reports)
+        """
+    )
+    (unsorted_fraction,) = con.sql(
+        "SELECT MAX(unsorted_reports) / (SELECT COUNT(*) FROM documents) "
+        "FROM text_index"
+    ).fetchone()
+    if unsorted_fraction > RESORT_FRACTION:
+        con.execute(
+            f"""
+            CREATE OR REPLACE TABLE postings AS
+            SELECT * FROM postings ORDER BY term, {REPORT_KEY}
+            """
+        )
+        con.execute("UPDATE text_index SET unsorted_reports = 0")
+
+
+def _index_changed_reports(con: duckdb.DuckDBPyConnection):
+    # Replaces the changed_reports' documents and postings.
+    fields = ", ".join(TEXT_FIELDS)
+    terms = _terms_sql(
+        "changed_reports", REPORT_KEY, f"CONCAT_WS(' ', {fields})"
+    )
+    con.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE changed_postings AS
+        SELECT term, {REPORT_KEY}, COUNT(*)::INTEGER AS tf
+        FROM ({terms})
+        GROUP BY term, {REPORT_KEY}
+        """
+    )
+    con.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE changed_lengths AS
+        SELECT {REPORT_KEY}, SUM(tf)::INTEGER AS length
+        FROM changed_postings
+        GROUP BY {REPORT_KEY}
+        """
+    )
+    con.execute(
+        f"""
+        DELETE FROM documents
+        WHERE {REPORT_KEY} IN (SELECT {REPORT_KEY} FROM changed_reports)
+        """
+    )
+    con.execute(
+        f"""
+        INSERT INTO documents
+        SELECT
+            reports.{REPORT_KEY},
+            reports.{REPORT_VERSION},
+            COALESCE(lengths.length, 0),
+            {", ".join(f"reports.{field}" for field in TEXT_FIELDS)}
+        FROM changed_reports AS reports
+        LEFT JOIN changed_lengths AS lengths
+            ON reports.{REPORT_KEY} = lengths.{REPORT_KEY}
+        """
+    )
+    # The postings are kept sorted by term, so a search only reads the row
+    # groups its terms are in. A handful of reports' postings tacked on the
+    # end only adds a row group or so to each search; a lot of them and the
+    # whole table is sorted again.
+    con.execute(
+        f"""
+        DELETE FROM postings
+        WHERE {REPORT_KEY} IN (SELECT {REPORT_KEY} FROM changed_reports)
+        """
+    )
+    (appending,) = con.sql("SELECT COUNT(*) > 0 FROM postings").fetchone()
+    con.execute(
+        f"""
+        INSERT INTO postings
+        SELECT postings.*, lengths.length
+        FROM changed_postings AS postings
+        INNER JOIN changed_lengths AS lengths
+            ON postings.{REPORT_KEY} = lengths.{REPORT_KEY}
+        ORDER BY postings.term, postings.{REPORT_KEY}
+        """
+    )
+    if appending:
+        _count_unsorted_reports(con)
+    con.execute(
+        """
+        CREATE OR REPLACE TABLE terms AS
+        SELECT term, COUNT(*)::INTEGER AS df FROM postings GROUP BY term
+        """
+    )
+    con.execute("DROP TABLE changed_postings")
+    con.execute("DROP TABLE changed_lengths")
+
+
+def update_text_index(
+    con: duckdb.DuckDBPyConnection, reports: Union[Path, str]
+) -> int:
+    # Indexes the reports (a file, or a table on con) that aren't in the
+    # index yet or were pulled again since, returning how many there were.
+    reports_source = (
+        read_reports(reports) if isinstance(reports, Path) else reports
+    )
+    fields = ", ".join(TEXT_FIELDS)
+    con.execute("BEGIN TRANSACTION")
+    try:
+        con.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE changed_reports AS
+            SELECT reports.{REPORT_KEY}, reports.{REPORT_VERSION}, {fields}
+            FROM {reports_source} AS reports
+            ANTI JOIN documents
+                ON reports.{REPORT_KEY} = documents.{REPORT_KEY}
+                AND reports.{REPORT_VERSION}
+                    IS NOT DISTINCT FROM documents.{REPORT_VERSION}
+            """
+        )
+        (changed,) = con.sql("SELECT COUNT(*) FROM changed_reports").fetchone()
+        if changed:
+            _index_changed_reports(con)
+        con.execute("DROP TABLE changed_reports")
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return changed
+
+
+def query_terms(con: duckdb.DuckDBPyConnection, query: str) -> List[str]:
+    terms = con.execute(
+        _terms_sql("(SELECT 0 AS id, ?::VARCHAR AS text)", "id", "text"),
+        [query],
+    ).fetchall()
+    return list(dict.fromkeys(term for _, term in terms))
+
+
+def _term(word: str) -> str:
+    # bfro_term in Python, for finding the matches in a snippet.
+    word = word.lower()
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and word[-2:] not in SKIP_S:
+        return word[:-1]
+    return word
+
+
+def _matches(text: str, terms: List[str]) -> List[re.Match]:
+    return [
+        word
+        for word in re.finditer(r"[A-Za-z0-9]+", text)
+        if _term(word.group()) in terms
+    ]
+
+
+def _snippet(text: str, terms: List[str], width: int) -> str:
+    # About width words of text around the first match of the earliest of
+    # terms the text has, with all the matches in [brackets].
+    matches = _matches(text, terms)
+    if not matches:
+        return ""
+    center = min(matches, key=lambda match: terms.index(_term(match.group())))
+    start = max(0, text.rfind(" ", 0, max(0, center.start() - width * 3)))
+    end = text.find(" ", center.end() + width * 3)
+    end = len(text) if end == -1 else end
+    snippet = ""
+    position = start
+    for match in matches:
+        if match.start() < start or match.end() > end:
+            continue
+        snippet += text[position : match.start()] + f"[{match.group()}]"
+        position = match.end()
+    snippet = (snippet + text[position:end]).strip()
+    prefix = "..." if start > 0 else ""
+    suffix = "..." if end < len(text) else ""
+    return f"{prefix}{snippet}{suffix}"
+
+
+SEARCH_RESULT_SCHEMA = {
+    REPORT_KEY: pl.Int64,
+    "score": pl.Float64,
+    "field": pl.Utf8,
+    "snippet": pl.Utf8,
+}
+
+
+def search(
+    con: duckdb.DuckDBPyConnection,
+    query: str,
+    limit: int = 10,
+    match_all: bool = False,
+    snippet_words: int = 30,
+) -> pl.DataFrame:
+    # The best matching reports by BM25 score, with the field the query
+    # terms turn up in most and a snippet of it. With match_all, only the
+    # reports that have every term.
+    #
+    # The terms are only ever letters and digits, so they go in the query
+    # as literals. Each is its own equality filter on the postings, which
+    # lets DuckDB skip every row group that can't have it (an IN list
+    # doesn't, yet).
+    terms = query_terms(con, query)
+    if not terms:
+        return pl.DataFrame(schema=SEARCH_RESULT_SCHEMA)
+    matches = " UNION ALL ".join(
+        f"SELECT * FROM postings WHERE term = '{term}'" for term in terms
+    )
+    ranked = con.execute(
+        f"""
+        WITH
+        collection AS (
+            SELECT COUNT(*) AS num_documents, AVG(length) AS avg_length
+            FROM documents
+        )
+        SELECT
+            matches.{REPORT_KEY},
+            SUM(
+                LN(
+                    1 + (collection.num_documents - terms.df + 0.5)
+                    / (terms.df + 0.5)
+                )
+                * matches.tf * ({K1} + 1)
+                / (
+                    matches.tf + {K1} * (
+                        1 - {B} + {B} * matches.length
+                        / collection.avg_length
+                    )
+                )
+            ) AS score
+        FROM ({matches}) AS matches
+        INNER JOIN terms
+            ON matches.term = terms.term
+        CROSS JOIN collection
+        GROUP BY matches.{REPORT_KEY}
+        {f"HAVING COUNT(*) = {len(terms)}" if match_all else ""}
+        ORDER BY score DESC, matches.{REPORT_KEY}
+        LIMIT {int(limit)}
+        """
+    ).fetchall()
+    if not ranked:
+        return pl.DataFrame(schema=SEARCH_RESULT_SCHEMA)
+
+    # Only the top reports' text is read, for the snippets. These are
+    # centered on the rarest term in the field.
+    term_list = ", ".join(f"'{term}'" for term in terms)
+    terms = [
+        term
+        for term, _ in con.execute(
+            f"SELECT term, df FROM terms WHERE term IN ({term_list}) "
+            "ORDER BY df, term"
+        ).fetchall()
+    ]
+    # Equality filters again, for the same reason.
+    documents = " UNION ALL ".join(
+        f"SELECT {REPORT_KEY}, {', '.join(TEXT_FIELDS)} FROM documents "
+        f"WHERE {REPORT_KEY} = {int(report_number)}"
+        for report_number, _ in ranked
+    )
+    texts = {
+        report_number: fields
+        for report_number, *fields in con.execute(documents).fetchall()
+    }
+    results = {column: [] for column in SEARCH_RESULT_SCHEMA}
+    for report_number, score in ranked:
+        fields = [text or "" for text in texts[report_number]]
+        hits = [len(_matches(text, terms)) for text in fields]
+        best = max(range(len(fields)), key=lambda index: hits[index])
+        results[REPORT_KEY].append(report_number)
+        results["score"].append(score)
+        results["field"].append(TEXT_FIELDS[best])
+        results["snippet"].append(_snippet(fields[best], terms, snippet_words))
+    return pl.DataFrame(results, schema=SEARCH_RESULT_SCHEMA)
+
+
+@app.command()
+def update(
+    reports_file: Path = Path("data/raw/reports/bfro_reports.csv"),
+    index_file: Path = Path("data/interim/text_index.duckdb"),
+):
+    con = open_text_index(index_file)
+    changed = update_text_index(con, reports_file)
+    logger.info(f"Indexed {changed} new or updated reports.")
+    con.close()
+
+
+@app.command("search")
+def search_command(
+    query: str,
+    limit: int = 10,
+    match_all: bool = False,
+    index_file: Path = Path("data/interim/text_index.duckdb"),
+):
+    con = open_text_index(index_file)
+    start = time.perf_counter()
+    results = search(con, query, limit, match_all)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    for row in results.iter_rows(named=True):
+        typer.echo(
+            f"{row[REPORT_KEY]}  {row['score']:.2f}  ({row['field']})\n"
+            f"    {row['snippet']}"
+        )
+    logger.info(f"{results.height} results in {elapsed_ms:.0f}ms.")
+    con.close()
+
+
+if __name__ == "__main__":
+    app()
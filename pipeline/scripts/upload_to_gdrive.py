@@ -1,12 +1,30 @@
 import typer
 from pathlib import Path
-from typing import Optional, List
+from typing import Any, Callable, Dict, Optional, List, Set
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mimetypes
+import threading
 from googleapiclient import discovery
 from googleapiclient.http import MediaFileUpload
 from google.oauth2 import service_account
 import os
 from dotenv import load_dotenv, find_dotenv
 from loguru import logger
+from run_report import StageMetrics, script_report
+
+
+# Drive's default, and what MediaFileUpload uses. Chunks have to be a
+# multiple of 256KB.
+DEFAULT_CHUNK_SIZE = 100 * 1024 * 1024
+
+
+def file_md5(file: Path, block_size: int = 2**20) -> str:
+    md5 = hashlib.md5()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
 
 
 def upload_to_gdrive(
@@ -14,42 +32,85 @@ def upload_to_gdrive(
     file: Path,
     destination_folder_id: str,
     owner_emails: List[str] = [],
-):
-    logger.info("Determining if file exists.")
+    metrics: Optional[StageMetrics] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> str:
+    # Returns the file's Drive id. A file that's already there with the
+    # same MD5 isn't uploaded again, and owners who can already see it
+    # aren't shared it again. google_drive_service is anything with the
+    # files() and permissions() resources of a Drive v3 service. metrics
+    # counts the Drive API calls, the upload as bytes written, and skipped
+    # uploads as cache hits.
+    if metrics is None:
+        metrics = StageMetrics("upload_to_gdrive")
+    logger.info(f"Determining if {file.name} exists.")
     file_id: Optional[str] = None
+    file_name = file.name.replace("'", "\\'")
     file_search_response = (
         google_drive_service.files()
         .list(
-            q=f"name='{file.name}' and '{destination_folder_id}' in parents",
-            fields="files(id, name)",
+            q=f"name='{file_name}' and '{destination_folder_id}' in parents",
+            fields="files(id, name, md5Checksum)",
         )
         .execute()
     )
+    metrics.add(api_calls=1)
 
+    existing_file: Dict[str, Any] = {}
     if file_search_response.get("files", []):
-        logger.info("File exists.")
-        file_id = file_search_response["files"][0].get("id", None)
-
-    metadata = {
-        "name": file.name,
-        "mimeType": "text/csv",
-    }
-    media = MediaFileUpload(file, mimetype="text/csv", resumable=True)
-    logger.info("Uploading file.")
-    if file_id:
-        google_drive_service.files().update(
-            fileId=file_id, body=metadata, media_body=media
-        ).execute()
+        logger.info(f"{file.name} exists.")
+        existing_file = file_search_response["files"][0]
+        file_id = existing_file.get("id", None)
+
+    if file_id and existing_file.get("md5Checksum") == file_md5(file):
+        logger.info(f"{file.name} is unchanged, skipping the upload.")
+        metrics.add(cache_hits=1)
     else:
-        metadata["parents"] = [destination_folder_id]
-        file_response = (
-            google_drive_service.files()
-            .create(body=metadata, media_body=media, fields="id")
+        mimetype = (
+            mimetypes.guess_type(file.name)[0] or "application/octet-stream"
+        )
+        metadata = {
+            "name": file.name,
+            "mimeType": mimetype,
+        }
+        media = MediaFileUpload(
+            file, mimetype=mimetype, chunksize=chunk_size, resumable=True
+        )
+        logger.info(f"Uploading {file.name}.")
+        if file_id:
+            google_drive_service.files().update(
+                fileId=file_id, body=metadata, media_body=media
+            ).execute()
+        else:
+            metadata["parents"] = [destination_folder_id]
+            file_response = (
+                google_drive_service.files()
+                .create(body=metadata, media_body=media, fields="id")
+                .execute()
+            )
+            file_id = file_response["id"]
+        metrics.add(api_calls=1, rows_out=1, cache_misses=1)
+        metrics.wrote_file(file)
+
+    # A file that was just created is only shared with the service account.
+    shared_emails: Set[str] = set()
+    if existing_file:
+        permissions_response = (
+            google_drive_service.permissions()
+            .list(fileId=file_id, fields="permissions(emailAddress)")
             .execute()
         )
-        file_id = file_response["id"]
-    logger.info("Setting file permissions.")
+        metrics.add(api_calls=1)
+        shared_emails = {
+            permission["emailAddress"].lower()
+            for permission in permissions_response.get("permissions", [])
+            if permission.get("emailAddress")
+        }
+    logger.info(f"Setting {file.name} permissions.")
     for owner_email in owner_emails:
+        if owner_email.lower() in shared_emails:
+            continue
+        metrics.add(api_calls=1)
         try:
             permission = {
                 "type": "user",
@@ -62,13 +123,49 @@ def upload_to_gdrive(
             ).execute()
         except Exception:
             logger.exception("Encountered error with sharing.")
+    return file_id
+
+
+def upload_files_to_gdrive(
+    build_google_drive_service: Callable[[], Any],
+    files: List[Path],
+    destination_folder_id: str,
+    owner_emails: List[str] = [],
+    concurrency: int = 4,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    metrics: Optional[StageMetrics] = None,
+) -> Dict[Path, str]:
+    # Uploads the files concurrently, returning their Drive ids. The Drive
+    # client's HTTP connection isn't thread safe, so
+    # build_google_drive_service is called once per upload thread.
+    thread_local = threading.local()
+    if metrics is None:
+        metrics = StageMetrics("upload_to_gdrive")
+
+    def upload(file: Path) -> str:
+        if not hasattr(thread_local, "google_drive_service"):
+            thread_local.google_drive_service = build_google_drive_service()
+        return upload_to_gdrive(
+            thread_local.google_drive_service,
+            file,
+            destination_folder_id,
+            owner_emails,
+            metrics=metrics,
+            chunk_size=chunk_size,
+        )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return dict(zip(files, executor.map(upload, files)))
 
 
 def main(
-    file: Path,
+    files: List[Path],
     sa_credentials_location: Optional[str] = None,
     gdrive_folder_id: Optional[str] = None,
     owner_email: Optional[str] = None,
+    concurrency: int = 4,
+    chunk_size_mb: int = DEFAULT_CHUNK_SIZE // 2**20,
+    report_file: Optional[Path] = None,
 ):
     if sa_credentials_location is None:
         logger.info(
@@ -101,16 +198,25 @@ def main(
         sa_credentials_location, scopes=scopes
     )
     logger.info("Authenticating to google cloud.")
-    google_drive_service = discovery.build(
-        "drive",
-        "v3",
-        credentials=creds,
-    )
+
+    def build_google_drive_service():
+        return discovery.build(
+            "drive",
+            "v3",
+            credentials=creds,
+        )
 
     logger.info("Performing upload task.")
-    upload_to_gdrive(
-        google_drive_service, file, gdrive_folder_id, [owner_email]
-    )
+    with script_report("upload_to_gdrive", report_file) as metrics:
+        upload_files_to_gdrive(
+            build_google_drive_service,
+            files,
+            gdrive_folder_id,
+            [owner_email],
+            concurrency=concurrency,
+            chunk_size=chunk_size_mb * 2**20,
+            metrics=metrics,
+        )
     logger.info("Done!")
 
 